@@ -48,6 +48,8 @@ from requests_toolbelt import exceptions
 from requests_toolbelt.downloadutils import stream
 
 import allensdk.core.json_utilities as json_utilities
+import allensdk.api.revalidation as revalidation
+import allensdk.api.instrumentation as instrumentation
 
 
 class Api(object):
@@ -316,11 +318,23 @@ class Api(object):
 
         self._file_download_log.info("Downloading URL: %s", url)
 
+        # validators are only stored for files cached with the 'revalidate'
+        # strategy
+        revalidating = not zipped and revalidation.is_revalidating(file_path)
+
+        if revalidating and os.path.exists(file_path):
+            validators = revalidation.read_validators(file_path)
+            if validators is not None and validators.get('url') == url:
+                return self._revalidate_file_over_http(file_path)
+
         try:
             if zipped:
                 stream_zip_directory_over_http(url, os.path.dirname(file_path))
             else:
-                stream_file_over_http(url, file_path)
+                response = stream_file_over_http(url, file_path)
+                if revalidating:
+                    revalidation.write_validators(file_path, url,
+                                                  response.headers)
 
         except exceptions.StreamingError as e:
             self._file_download_log.error("Couldn't retrieve file %s from %s (streaming)." % (file_path,url))
@@ -347,6 +361,17 @@ class Api(object):
             self.cleanup_truncated_file(file_path)
             raise
 
+    def _revalidate_file_over_http(self, file_path):
+        '''Download a cached file again only if it changed on the server.  On 
+        failure the cached copy is left in place.
+        '''
+        try:
+            status = revalidation.revalidate_file(file_path)
+        except Exception as e:
+            self._file_download_log.error("Couldn't revalidate file %s: %s" % (file_path, e))
+            raise
+
+        self._file_download_log.info("Revalidated %s: %s", file_path, status)
 
     def retrieve_parsed_json_over_http(self, url, post=False):
         '''Get the document and put it in a Python data structure
@@ -364,13 +389,16 @@ class Api(object):
             Result document as parsed by the JSON library.
         '''
         self._log.info("Downloading URL: %s", url)
-        
-        if post is False:
-            data = json_utilities.read_url_get(
-                requests.utils.quote(url,
-                                     ';/?:@&=+$,'))
-        else:
-            data = json_utilities.read_url_post(url)
+
+        with instrumentation.measure(instrumentation.REQUEST,
+                                     'retrieve_parsed_json_over_http',
+                                     url=url):
+            if post is False:
+                data = json_utilities.read_url_get(
+                    requests.utils.quote(url,
+                                         ';/?:@&=+$,'))
+            else:
+                data = json_utilities.read_url_post(url)
 
         return data
 
@@ -413,15 +441,20 @@ def stream_zip_directory_over_http(url, directory, members=None, timeout=(9.05,
 
     buf = io.BytesIO()
 
-    with closing( requests.get(url, stream=True, timeout=timeout) ) as request:
-        stream.stream_response_to_file( request, buf )
+    with instrumentation.measure(instrumentation.DOWNLOAD,
+                                 'stream_zip_directory_over_http',
+                                 url=url) as measurement:
+        with closing( requests.get(url, stream=True, timeout=timeout) ) as request:
+            stream.stream_response_to_file( request, buf )
+
+        measurement.nbytes = buf.tell()
 
     zipper = zipfile.ZipFile(buf)
     zipper.extractall(path=directory, members=members)
     zipper.close()
 
 
-def stream_file_over_http(url, file_path, timeout=(9.05, 31.1)):
+def stream_file_over_http(url, file_path, timeout=(9.05, 31.1), headers=None):
     ''' Supply an http get request and stream the response to a file.
 
     Parameters
@@ -433,11 +466,33 @@ def stream_file_over_http(url, file_path, timeout=(9.05, 31.1)):
     timeout : float or tuple of float, optional
         Specify a timeout for the request. If a tuple, specify seperate connect 
         and read timeouts.
+    headers : dict, optional
+        Additional request headers. If these make the request conditional and 
+        the server responds 304 (Not Modified), nothing is written.
+
+    Returns
+    -------
+    requests.Response
+        The (closed) response, for its status code and headers.
 
     '''
 
-    with closing(requests.get(url, stream=True, timeout=timeout)) as response:
+    request_kwargs = {'stream': True, 'timeout': timeout}
+    if headers:
+        request_kwargs['headers'] = headers
+
+    with instrumentation.measure(instrumentation.DOWNLOAD,
+                                 'stream_file_over_http',
+                                 url=url) as measurement:
+        with closing(requests.get(url, **request_kwargs)) as response:
+
+            if response.status_code == 304:
+                measurement.outcome = 'not_modified'
+                return response
+
+            response.raise_for_status()
+            with open(file_path, 'wb') as fil:
+                stream.stream_response_to_file(response, path=fil)
+                measurement.nbytes = int(fil.tell())
 
-        response.raise_for_status()
-        with open(file_path, 'wb') as fil:
-            stream.stream_response_to_file(response, path=fil)
+    return response
@@ -0,0 +1,215 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' asyncio front ends for the query apis.
+
+The synchronous apis do the work: each call runs in a bounded thread pool
+and is returned as an asyncio future, so it can be awaited or gathered from
+a coroutine.  URL builders, response caching and file download behavior are
+those of the wrapped api.
+
+    >>> api = AsyncMouseConnectivityApi(max_concurrency=16)
+    >>> async def details(ids):
+    ...     return await asyncio.gather(*[api.get_experiment_detail(i)
+    ...                                   for i in ids])
+'''
+import functools
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from allensdk.api.api import Api
+from allensdk.api.queries.rma_api import RmaApi
+from allensdk.api.queries.mouse_connectivity_api import MouseConnectivityApi
+from allensdk.api.queries.cell_types_api import CellTypesApi
+from allensdk.api.queries.brain_observatory_api import BrainObservatoryApi
+
+
+_log = logging.getLogger('allensdk.api.async_api')
+
+
+def _async_method(name):
+    ''' Make an AsyncApi method that runs the wrapped api's method of the
+    same name in the thread pool.
+    '''
+    def method(self, *args, **kwargs):
+        return self.submit(getattr(self.api, name), *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = ("Awaitable version of the wrapped api's %s; see it "
+                      "for parameters." % name)
+
+    return method
+
+
+class AsyncApi(object):
+    ''' Run Api queries concurrently from asyncio code.
+
+    Parameters
+    ----------
+    api : Api, optional
+        synchronous api that does the work.  Defaults to a new instance of
+        api_class.
+    max_concurrency : int, optional
+        maximum number of requests in flight at once.  Default 8.
+    base_uri : string, optional
+        passed to api_class if api is not given.
+    '''
+    api_class = Api
+
+    def __init__(self, api=None, max_concurrency=8, base_uri=None):
+        if asyncio is None:
+            raise ImportError("asyncio is required for %s" %
+                              type(self).__name__)
+
+        if api is None:
+            api = self.api_class(base_uri)
+
+        self.api = api
+        self.max_concurrency = max_concurrency
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency)
+        return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        ''' Run fn(*args, **kwargs) in the thread pool.
+
+        Returns
+        -------
+        asyncio.Future
+            resolves to the return value of fn
+        '''
+        future = self.executor.submit(functools.partial(fn, *args, **kwargs))
+        return asyncio.wrap_future(future)
+
+    def close(self):
+        ''' Shut down the thread pool, waiting for requests in flight.
+        '''
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    do_query = _async_method('do_query')
+    do_rma_query = _async_method('do_rma_query')
+    json_msg_query = _async_method('json_msg_query')
+    retrieve_file_over_http = _async_method('retrieve_file_over_http')
+    retrieve_parsed_json_over_http = \
+        _async_method('retrieve_parsed_json_over_http')
+
+
+class AsyncRmaApi(AsyncApi):
+    ''' Awaitable RmaApi queries.  Query building (model_stage, filters, ...)
+    is synchronous and available through the api attribute.
+    '''
+    api_class = RmaApi
+
+    model_query = _async_method('model_query')
+    service_query = _async_method('service_query')
+    get_schema = _async_method('get_schema')
+
+
+class AsyncMouseConnectivityApi(AsyncRmaApi):
+    ''' Awaitable MouseConnectivityApi queries and downloads.
+    '''
+    api_class = MouseConnectivityApi
+
+    get_experiments = _async_method('get_experiments')
+    get_experiment_detail = _async_method('get_experiment_detail')
+    get_projection_image_info = _async_method('get_projection_image_info')
+    get_manual_injection_summary = \
+        _async_method('get_manual_injection_summary')
+    get_structure_unionizes = _async_method('get_structure_unionizes')
+    experiment_source_search = _async_method('experiment_source_search')
+    experiment_spatial_search = _async_method('experiment_spatial_search')
+    experiment_injection_coordinate_search = \
+        _async_method('experiment_injection_coordinate_search')
+    experiment_correlation_search = \
+        _async_method('experiment_correlation_search')
+    download_injection_density = _async_method('download_injection_density')
+    download_projection_density = \
+        _async_method('download_projection_density')
+    download_injection_fraction = \
+        _async_method('download_injection_fraction')
+    download_data_mask = _async_method('download_data_mask')
+
+
+class AsyncCellTypesApi(AsyncRmaApi):
+    ''' Awaitable CellTypesApi queries and downloads.
+    '''
+    api_class = CellTypesApi
+
+    list_cells_api = _async_method('list_cells_api')
+    get_cell = _async_method('get_cell')
+    get_ephys_sweeps = _async_method('get_ephys_sweeps')
+    get_ephys_features = _async_method('get_ephys_features')
+    get_morphology_features = _async_method('get_morphology_features')
+    save_ephys_data = _async_method('save_ephys_data')
+    save_reconstruction = _async_method('save_reconstruction')
+    save_reconstruction_markers = \
+        _async_method('save_reconstruction_markers')
+
+
+class AsyncBrainObservatoryApi(AsyncRmaApi):
+    ''' Awaitable BrainObservatoryApi queries and downloads.
+    '''
+    api_class = BrainObservatoryApi
+
+    get_ophys_experiments = _async_method('get_ophys_experiments')
+    get_isi_experiments = _async_method('get_isi_experiments')
+    get_experiment_containers = _async_method('get_experiment_containers')
+    get_cell_metrics = _async_method('get_cell_metrics')
+    get_stimulus_mappings = _async_method('get_stimulus_mappings')
+    get_column_definitions = _async_method('get_column_definitions')
+    save_ophys_experiment_data = _async_method('save_ophys_experiment_data')
+    save_ophys_experiment_analysis_data = \
+        _async_method('save_ophys_experiment_analysis_data')
+    save_ophys_experiment_event_data = \
+        _async_method('save_ophys_experiment_event_data')
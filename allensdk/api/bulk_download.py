@@ -0,0 +1,197 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Run many cacheable downloads concurrently.
+
+Each task names a destination path and a function that fills it (normally a
+@cacheable method called with strategy='lazy').  Tasks whose path is already
+on disk are reported as cached without being run, duplicate paths are run
+once, and the number of simultaneous requests to any one host is capped.
+'''
+import os
+import time
+import logging
+import threading
+from collections import namedtuple, OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from six.moves.urllib.parse import urlparse
+
+
+_log = logging.getLogger('allensdk.api.bulk_download')
+
+CACHED = 'cached'
+DOWNLOADED = 'downloaded'
+FAILED = 'failed'
+
+DownloadTask = namedtuple('DownloadTask', ['key', 'kind', 'path', 'fn', 'url'])
+'''key : hashable
+    identifies the item (e.g. an experiment id) in the returned status map
+kind : string
+    which file of the item this is (e.g. 'data', 'events')
+path : string
+    where the file will be written
+fn : function
+    no-argument callable that writes the file at path
+url : string
+    url (or just the base url of the api) that fn downloads from.  Only the
+    host is used, to apply the per-host limit.
+'''
+
+DownloadProgress = namedtuple('DownloadProgress',
+                              ['completed', 'total', 'failed',
+                               'bytes', 'elapsed', 'bytes_per_second'])
+
+
+class HostLimiter(object):
+    ''' Cap the number of concurrent requests to each host.
+
+    Parameters
+    ----------
+    max_per_host : int or None
+        maximum concurrent requests per host.  None for no limit.
+    '''
+
+    def __init__(self, max_per_host=None):
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def semaphore(self, url):
+        host = urlparse(url).netloc if url else ''
+
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = \
+                    threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+    def run(self, url, fn, *args, **kwargs):
+        ''' Call fn while holding a slot for the host of url.
+        '''
+        if self.max_per_host is None:
+            return fn(*args, **kwargs)
+
+        with self.semaphore(url):
+            return fn(*args, **kwargs)
+
+
+def download_all(tasks,
+                 max_workers=4,
+                 max_per_host=None,
+                 progress=None):
+    ''' Run download tasks concurrently, skipping files that already exist.
+
+    Parameters
+    ----------
+    tasks : iterable of DownloadTask
+    max_workers : int, optional
+        size of the thread pool.  Default 4.
+    max_per_host : int, optional
+        maximum concurrent downloads from one host.  Default is max_workers.
+    progress : function, optional
+        called with a DownloadProgress after each task finishes.
+
+    Returns
+    -------
+    OrderedDict
+        key -> {kind: status} where status is 'cached', 'downloaded' or
+        'failed'.  Keys are in the order first seen in tasks.
+    '''
+    if max_per_host is None:
+        max_per_host = max_workers
+
+    statuses = OrderedDict()
+    pending = OrderedDict()
+
+    for task in tasks:
+        statuses.setdefault(task.key, OrderedDict())
+
+        if task.path is not None and os.path.exists(task.path):
+            statuses[task.key][task.kind] = CACHED
+        else:
+            statuses[task.key][task.kind] = None
+            # tasks without a path can't be deduplicated
+            group = task.path if task.path is not None else object()
+            pending.setdefault(group, []).append(task)
+
+    total = len(pending)
+    completed = 0
+    failed = 0
+    nbytes = 0
+    start = time.time()
+
+    if total == 0:
+        return statuses
+
+    limiter = HostLimiter(max_per_host)
+
+    _log.info("Downloading %d files with %d workers", total, max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(limiter.run, same[0].url, same[0].fn): group
+                   for group, same in pending.items()}
+
+        for future in as_completed(futures):
+            group = futures[future]
+            path = pending[group][0].path
+
+            try:
+                future.result()
+                status = DOWNLOADED
+                if path is not None and os.path.exists(path):
+                    nbytes += os.path.getsize(path)
+            except Exception as e:
+                _log.error("Failed to download %s: %s", path, e)
+                status = FAILED
+                failed += 1
+
+            for task in pending[group]:
+                statuses[task.key][task.kind] = status
+
+            completed += 1
+            elapsed = time.time() - start
+            report = DownloadProgress(completed, total, failed, nbytes,
+                                      elapsed,
+                                      nbytes / elapsed if elapsed > 0 else 0.0)
+
+            _log.info("Downloaded %d/%d files (%d failed), %.1f MB at %.2f MB/s",
+                      completed, total, failed, nbytes / 1e6,
+                      report.bytes_per_second / 1e6)
+
+            if progress is not None:
+                progress(report)
+
+    return statuses
@@ -36,31 +36,240 @@
 from allensdk.config.manifest import Manifest, ManifestVersionError
 from allensdk.config.manifest_builder import ManifestBuilder
 import allensdk.core.json_utilities as ju
+import allensdk.core.columnar_utilities as columnar
+import allensdk.api.cache_manager as cache_manager
+import allensdk.api.revalidation as revalidation
+import allensdk.api.instrumentation as instrumentation
 from allensdk.deprecated import deprecated
 
 import pandas as pd
 import pandas.io.json as pj
 
+import numpy as np
+
 import functools
 from functools import wraps
+from collections import namedtuple, OrderedDict
 import os
+import sys
 import logging
+import time
 import csv
+import threading
+import weakref
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions',
+                                     'maxsize', 'currsize',
+                                     'maxbytes', 'nbytes'])
+
+
+def estimate_nbytes(value, _depth=0):
+    '''Rough size in bytes of a memoized return value.  Array-like objects
+    report their buffer size; containers are summed a few levels deep.
+    '''
+    if hasattr(value, 'nbytes'):
+        try:
+            return int(value.nbytes)
+        except TypeError:
+            pass
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index=True)))
+
+    size = sys.getsizeof(value, 0)
+
+    if _depth < 3:
+        if isinstance(value, dict):
+            size += sum(estimate_nbytes(k, _depth + 1) +
+                        estimate_nbytes(v, _depth + 1)
+                        for k, v in value.items())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            size += sum(estimate_nbytes(v, _depth + 1) for v in value)
+
+    return size
+
+
+class _MemoStore(object):
+    '''LRU storage for one memoized function.  Entries belonging to a
+    weak-referenceable first argument (usually ``self``) are dropped as soon as
+    that object is garbage collected, so the cache never keeps it alive.
+    '''
+
+    def __init__(self, maxsize, maxbytes):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.owners = {}
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.nbytes = 0
+
+    def owner_token(self, owner):
+        '''Key entries for owner by identity, holding only a weak reference.
+        Returns None if owner cannot be weakly referenced.'''
+        token = id(owner)
+
+        with self.lock:
+            if token in self.owners:
+                if self.owners[token][0]() is owner:
+                    return token
+                # a dead owner whose id has been reused
+                self.discard_owner(token)
+
+            try:
+                ref = weakref.ref(owner, self._make_finalizer(token))
+            except TypeError:
+                return None
+
+            self.owners[token] = (ref, set())
+
+        return token
+
+    def _make_finalizer(self, token):
+        store_ref = weakref.ref(self)
+
+        def finalize(ref):
+            store = store_ref()
+            if store is not None:
+                store.discard_owner(token, ref)
+        return finalize
+
+    def discard_owner(self, token, ref=None):
+        with self.lock:
+            owner = self.owners.get(token)
+            if owner is None or (ref is not None and owner[0] is not ref):
+                return
+
+            del self.owners[token]
+            for key in owner[1]:
+                _, nbytes = self.entries.pop(key)
+                self.nbytes -= nbytes
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        nbytes = estimate_nbytes(value) if self.maxbytes is not None else 0
+
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+
+            if self.maxbytes is not None and nbytes > self.maxbytes:
+                return
+
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
 
+            token = key[0]
+            if token is not None and token in self.owners:
+                self.owners[token][1].add(key)
 
-def memoize(f):
-   memodict = dict()
+            while self.entries and (
+                    (self.maxsize is not None and
+                     len(self.entries) > self.maxsize) or
+                    (self.maxbytes is not None and
+                     self.nbytes > self.maxbytes)):
+                old_key, (_, old_nbytes) = self.entries.popitem(last=False)
+                self.nbytes -= old_nbytes
+                self.evictions += 1
 
-   @wraps(f)
-   def wrapper(*args, **kwargs):
-       key = (args, tuple(kwargs.items()))
+                if old_key[0] in self.owners:
+                    self.owners[old_key[0]][1].discard(old_key)
 
-       if key not in memodict:
-           memodict[key] = f(*args, **kwargs)
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self.entries),
+                             self.maxbytes, self.nbytes)
 
-       return memodict[key]
 
-   return wrapper
+def _hashed_by_identity(value):
+    '''True if value is hashed by identity (object.__hash__), as instances
+    of classes that define neither __eq__ nor __hash__ are.'''
+    return getattr(type(value), '__hash__', None) is object.__hash__
+
+
+def memoize(f=None, max_entries=128, max_bytes=None):
+    '''Cache return values of a function or method in memory.
+
+    Can be used bare (``@memoize``) or with arguments
+    (``@memoize(max_entries=4, max_bytes=2**30)``).
+
+    If the first argument is hashed by identity and can be weakly referenced
+    (``self`` of most methods, or an object such as a data set), results are
+    stored per first argument and discarded when it is garbage collected, so
+    the cache never keeps it alive.  Other arguments, and first arguments
+    hashed by value, are used as the key by value.  Least recently used
+    results are evicted once either bound is exceeded.  Calls with
+    unhashable arguments are passed through without caching.
+
+    Parameters
+    ----------
+    f : function
+        function to memoize
+    max_entries : int or None, optional
+        maximum number of cached results across all instances.  Default 128;
+        None for no limit.
+    max_bytes : int or None, optional
+        maximum estimated size of the cached results.  Default None, no limit.
+
+    Notes
+    -----
+    The wrapper exposes ``cache_info()``, returning hit/miss/eviction counts
+    and current sizes, and ``cache_clear()``.
+    '''
+    if f is None:
+        return functools.partial(memoize,
+                                 max_entries=max_entries,
+                                 max_bytes=max_bytes)
+
+    store = _MemoStore(max_entries, max_bytes)
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        token = None
+        rest = args
+
+        if args and _hashed_by_identity(args[0]):
+            token = store.owner_token(args[0])
+            if token is not None:
+                rest = args[1:]
+
+        key = (token, rest, tuple(sorted(kwargs.items())))
+
+        try:
+            return store.get(key)
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable arguments
+            return f(*args, **kwargs)
+
+        with store.lock:
+            store.misses += 1
+
+        value = f(*args, **kwargs)
+        store.put(key, value)
+
+        return value
+
+    wrapper.cache_info = store.info
+    wrapper.cache_clear = store.clear
+
+    return wrapper
+
 
 class Cache(object):
     _log = logging.getLogger('allensdk.api.cache')
@@ -142,8 +351,99 @@ class Cache(object):
 
             self.manifest_path = file_name
 
+            # a quota set by any process applies to this one too
+            index_path = os.path.join(os.path.dirname(os.path.abspath(file_name)),
+                                      cache_manager.INDEX_FILE_NAME)
+            if os.path.isfile(index_path):
+                self.cache_index = cache_manager.open_index(file_name)
+                cache_manager.register(self.cache_index)
+            else:
+                self.cache_index = None
+
         else:
             self.manifest = None
+            self.cache_index = None
+
+    def set_cache_quota(self, quota, policy=None):
+        '''Limit the disk space used by files in the manifest directory.
+        Least recently (or least frequently) used files are removed when the
+        quota is exceeded.  The quota is stored next to the manifest and
+        applies to every process using it.
+
+        Parameters
+        ----------
+        quota : int or string
+            maximum bytes, e.g. 50000000000 or '50G'.
+        policy : string, optional
+            'lru' (default) or 'lfu'
+
+        Returns
+        -------
+        list of strings
+            files removed to meet the quota
+        '''
+        self.cache_index = cache_manager.open_index(self.manifest_path,
+                                                    quota=quota,
+                                                    policy=policy)
+        self.cache_index.pin(self.manifest_path)
+        self.cache_index.scan()
+        cache_manager.register(self.cache_index)
+
+        return self.cache_index.prune()
+
+    def pin_cache_file(self, path, pinned=True):
+        '''Protect a file in the manifest directory from quota eviction.
+        '''
+        if self.cache_index is None:
+            raise ValueError("No cache quota has been set for %s" %
+                             self.manifest_path)
+
+        self.cache_index.pin(path, pinned)
+
+    def cache_usage(self):
+        '''Disk usage of the manifest directory, as reported by
+        allensdk.api.cache_manager.CacheIndex.usage.
+        '''
+        index = self.cache_index
+        if index is None:
+            index = cache_manager.open_index(self.manifest_path)
+            index.pin(self.manifest_path)
+
+        index.scan()
+
+        return index.usage()
+
+    def revalidate(self, max_workers=4, max_per_host=None):
+        '''Check every file in the manifest directory that was downloaded with
+        strategy='revalidate' against the server and download again the ones
+        that changed.  Requests are
+        conditional (If-None-Match / If-Modified-Since), so unchanged files
+        cost one round trip and no body.
+
+        Parameters
+        ----------
+        max_workers : int, optional
+            number of concurrent requests.  Default 4.
+        max_per_host : int, optional
+            maximum concurrent requests to one host.  Default is max_workers.
+
+        Returns
+        -------
+        OrderedDict
+            path -> 'unchanged', 'updated' or 'failed'
+        '''
+        base_dir = os.path.dirname(os.path.abspath(self.manifest_path))
+        paths = revalidation.find_validated_files(base_dir)
+
+        statuses = revalidation.revalidate_all(paths,
+                                               max_workers=max_workers,
+                                               max_per_host=max_per_host)
+
+        for path, status in statuses.items():
+            if status == revalidation.UPDATED:
+                cache_manager.record_create(path)
+
+        return statuses
 
     def build_manifest(self, file_name):
         '''Creation of default path specifications.
@@ -291,6 +591,8 @@ class Cache(object):
             'create' always generates the data,
             'file' loads from disk,
             'lazy' queries the server if no file exists,
+            'revalidate' downloads the file again only if it changed on the
+            server (query results without stored validators are regenerated),
             None generates the data and bypasses all caching behavior
         pre : function
             df|json->df|json, takes one data argument and returns filtered version, None for pass-through
@@ -321,29 +623,57 @@ class Cache(object):
             else:
                 strategy = 'pass_through'
 
-        if not strategy in ['lazy', 'pass_through', 'file', 'create']:
+        if not strategy in ['lazy', 'pass_through', 'file', 'create',
+                            'revalidate']:
             raise ValueError("Unknown query strategy: {}.".format(strategy))
 
-        if 'lazy' == strategy:
-            if os.path.exists(path):
-                strategy = 'file'
-            else:
-                strategy = 'create'
-
-        if strategy == 'pass_through':
-                data = fn(*args, **kwargs)
-        elif strategy in ['create']:
-            Manifest.safe_make_parent_dirs(path)
-
-            if writer:
-                data = fn(*args, **kwargs)
-                data = pre(data)
-                writer(path, data)
-            else:
-                data = fn(*args, **kwargs)
-
-        if reader:
-            data = reader(path)
+        # a lease keeps quota enforcement from evicting the file between the
+        # existence check and the read.
+        with cache_manager.reading(path), \
+                instrumentation.measure(instrumentation.CACHE,
+                                        getattr(fn, '__name__', 'cacher'),
+                                        path=path) as measurement:
+            measurement.outcome = 'hit' if strategy == 'file' else strategy
+
+            if 'lazy' == strategy:
+                if os.path.exists(path):
+                    strategy = 'file'
+                    measurement.outcome = 'hit'
+                else:
+                    strategy = 'create'
+                    measurement.outcome = 'miss'
+
+            if 'revalidate' == strategy:
+                if writer:
+                    strategy = 'create'
+
+            if strategy == 'pass_through':
+                    data = fn(*args, **kwargs)
+            elif strategy in ['create']:
+                Manifest.safe_make_parent_dirs(path)
+
+                if writer:
+                    data = fn(*args, **kwargs)
+                    data = pre(data)
+                    writer(path, data)
+                else:
+                    data = fn(*args, **kwargs)
+
+                cache_manager.record_create(path)
+            elif strategy == 'revalidate':
+                Manifest.safe_make_parent_dirs(path)
+
+                with revalidation.revalidating(path):
+                    data = fn(*args, **kwargs)
+
+                cache_manager.record_create(path)
+            elif strategy == 'file':
+                cache_manager.record_access(path)
+
+            if reader:
+                start = time.time()
+                data = reader(path)
+                measurement.parse_time += time.time() - start
 
         # Note: don't provide post if fn or reader doesn't return data
         if post:
@@ -425,6 +755,80 @@ class Cache(object):
             'reader': lambda f: pd.read_csv(f, parse_dates=True)
         }
 
+    @staticmethod
+    def cache_columnar_dataframe(columns=None,
+                                 filters=None,
+                                 drop_columns=None):
+        '''Store query results in a columnar file (HDF5 table, Parquet or
+        Feather, selected by the path extension) and read back a dataframe.
+
+        Parameters
+        ----------
+        columns : list of strings, optional
+            only read these columns
+        filters : list of dicts, optional
+            filter dictionaries as used by BrainObservatoryApi.dataframe_query.
+            Simple numeric comparisons are pushed down to the storage layer.
+        drop_columns : list of strings, optional
+            columns to leave out of the result
+        '''
+        return {
+            'writer': columnar.write,
+            'reader': lambda p: columnar.read(p,
+                                              columns=columns,
+                                              filters=filters,
+                                              drop_columns=drop_columns)
+        }
+
+    @staticmethod
+    def cache_columnar_json(columns=None,
+                            filters=None,
+                            drop_columns=None):
+        '''Store query results in a columnar file and read back a list of
+        dicts, as cache_json would.  See cache_columnar_dataframe.
+        '''
+        return {
+            'writer': columnar.write,
+            'reader': lambda p: columnar.read_records(p,
+                                                      columns=columns,
+                                                      filters=filters,
+                                                      drop_columns=drop_columns)
+        }
+
+    @staticmethod
+    def migrate_to_columnar(legacy_path, path):
+        '''Convert an existing json or csv cache file to a columnar file,
+        so that lazy queries against the columnar path find it on disk
+        instead of querying the server again.
+
+        Parameters
+        ----------
+        legacy_path : string
+            json or csv file written by cache_json, cache_csv, etc.
+        path : string
+            columnar file to create if it does not exist yet
+
+        Returns
+        -------
+        boolean
+            True if a file was converted
+        '''
+        if legacy_path is None or path is None:
+            return False
+
+        if os.path.exists(path) or not os.path.exists(legacy_path):
+            return False
+
+        if legacy_path.lower().endswith('.csv'):
+            data = pd.read_csv(legacy_path, parse_dates=True)
+        else:
+            data = ju.read(legacy_path)
+
+        Cache._log.info('migrating %s to %s', legacy_path, path)
+        columnar.write(path, data)
+
+        return True
+
     @staticmethod
     def pathfinder(file_name_position,
                    secondary_file_name_position=None,
@@ -604,9 +1008,11 @@ def cacheable(strategy=None,
             if decor.post and not 'post in kwargs':
                 kwargs['post'] = decor.post
 
-            result = Cache.cacher(func,
-                                  *args,
-                                  **kwargs)
+            with instrumentation.operation(
+                    getattr(func, '__qualname__', func.__name__)):
+                result = Cache.cacher(func,
+                                      *args,
+                                      **kwargs)
             return result
 
         return w
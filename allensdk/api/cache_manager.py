@@ -0,0 +1,537 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Size-bounded eviction for manifest cache directories.
+
+A CacheIndex is a small SQLite database kept in a cache's manifest directory.
+It records the size, last access time and access count of every cached file,
+whether the file is pinned, and read leases held by running processes.  When
+the total size of the directory exceeds the quota, unpinned, unleased files are
+removed in least-recently-used (or least-frequently-used) order.
+
+Cache.cacher reports file creation and reads to any registered index whose
+directory contains the file, so quotas apply to every @cacheable download.
+
+Command line usage::
+
+    python -m allensdk.api.cache_manager usage path/to/manifest.json
+    python -m allensdk.api.cache_manager prune path/to/manifest.json --quota 50G
+    python -m allensdk.api.cache_manager pin path/to/manifest.json some/file.nwb
+'''
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+import sqlite3
+import threading
+from contextlib import contextmanager, closing
+
+from allensdk.api.revalidation import VALIDATORS_SUFFIX, remove_validators
+
+
+_log = logging.getLogger('allensdk.api.cache_manager')
+
+INDEX_FILE_NAME = '.allensdk_cache_index.sqlite'
+POLICIES = ('lru', 'lfu')
+DEFAULT_LEASE_SECONDS = 3600.0
+
+_SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+_registry_lock = threading.Lock()
+_registry = {}
+
+
+def parse_size(size):
+    ''' Convert a size like 500M, 20G or 1024 into bytes.
+    '''
+    if size is None or isinstance(size, int):
+        return size
+
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$', str(size),
+                     re.IGNORECASE)
+    if match is None:
+        raise ValueError("Can't parse size: %s" % size)
+
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(nbytes):
+    for unit in ['T', 'G', 'M', 'K']:
+        if nbytes >= _SIZE_UNITS[unit]:
+            return '%.1f%sB' % (float(nbytes) / _SIZE_UNITS[unit], unit)
+    return '%dB' % nbytes
+
+
+class CacheIndex(object):
+    ''' Track and bound the disk usage of a cache directory.
+
+    Parameters
+    ----------
+    base_dir : string
+        directory holding the cache's manifest and files
+    quota : int or string, optional
+        maximum total bytes, e.g. 50G.  Stored in the index, so it persists
+        for other processes using the same directory.  Default keeps the
+        stored value (no limit if none was set).
+    policy : string, optional
+        'lru' or 'lfu'.  Default keeps the stored value ('lru' if none was set).
+    '''
+
+    def __init__(self, base_dir, quota=None, policy=None):
+        self.base_dir = os.path.abspath(base_dir)
+        self.index_path = os.path.join(self.base_dir, INDEX_FILE_NAME)
+
+        if not os.path.exists(self.base_dir):
+            os.makedirs(self.base_dir)
+
+        with self._transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                       'path TEXT PRIMARY KEY, '
+                       'size INTEGER NOT NULL, '
+                       'last_access REAL NOT NULL, '
+                       'access_count INTEGER NOT NULL DEFAULT 0, '
+                       'pinned INTEGER NOT NULL DEFAULT 0)')
+            db.execute('CREATE TABLE IF NOT EXISTS leases ('
+                       'path TEXT NOT NULL, '
+                       'pid INTEGER NOT NULL, '
+                       'expires REAL NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS settings ('
+                       'key TEXT PRIMARY KEY, value TEXT)')
+
+        if quota is not None:
+            self.quota = quota
+        if policy is not None:
+            self.policy = policy
+
+    def _connect(self):
+        db = sqlite3.connect(self.index_path, timeout=60.0,
+                             isolation_level=None)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            pass
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except:
+                db.execute('ROLLBACK')
+                raise
+            else:
+                db.execute('COMMIT')
+
+    def _setting(self, key, default=None):
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT value FROM settings WHERE key=?',
+                             (key,)).fetchone()
+        return default if row is None or row[0] is None else row[0]
+
+    def _set_setting(self, key, value):
+        with self._transaction() as db:
+            db.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)',
+                       (key, None if value is None else str(value)))
+
+    @property
+    def quota(self):
+        value = self._setting('quota')
+        return None if value is None else int(value)
+
+    @quota.setter
+    def quota(self, value):
+        self._set_setting('quota', parse_size(value))
+
+    @property
+    def policy(self):
+        return self._setting('policy', 'lru')
+
+    @policy.setter
+    def policy(self, value):
+        if value not in POLICIES:
+            raise ValueError("Unknown eviction policy: %s" % value)
+        self._set_setting('policy', value)
+
+    def relative_path(self, path):
+        path = os.path.relpath(os.path.abspath(path), self.base_dir)
+        return path.replace(os.sep, '/')
+
+    def contains(self, path):
+        path = os.path.abspath(path)
+        return path.startswith(self.base_dir + os.sep)
+
+    def record_access(self, path):
+        ''' Note that a file was read or written, updating its size.
+        '''
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO entries '
+                       '(path, size, last_access) VALUES (?, ?, ?)',
+                       (self.relative_path(path), size, time.time()))
+            db.execute('UPDATE entries SET size=?, last_access=?, '
+                       'access_count=access_count+1 WHERE path=?',
+                       (size, time.time(), self.relative_path(path)))
+
+    def pin(self, path, pinned=True):
+        ''' Protect a file from eviction (or remove the protection).
+        '''
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO entries '
+                       '(path, size, last_access) VALUES (?, ?, ?)',
+                       (self.relative_path(path), size, time.time()))
+            db.execute('UPDATE entries SET pinned=? WHERE path=?',
+                       (int(pinned), self.relative_path(path)))
+
+    def unpin(self, path):
+        self.pin(path, pinned=False)
+
+    @contextmanager
+    def lease(self, path, seconds=DEFAULT_LEASE_SECONDS):
+        ''' Keep a file from being evicted while a block of code reads it.
+        Leases expire after a timeout so a crashed process can't hold a file
+        forever.
+        '''
+        key = self.relative_path(path)
+        pid = os.getpid()
+
+        with self._transaction() as db:
+            cursor = db.execute('INSERT INTO leases VALUES (?, ?, ?)',
+                                (key, pid, time.time() + seconds))
+            lease_id = cursor.lastrowid
+
+        try:
+            yield
+        finally:
+            with self._transaction() as db:
+                db.execute('DELETE FROM leases WHERE rowid=?', (lease_id,))
+
+    def scan(self):
+        ''' Bring the index up to date with the files on disk.  Untracked
+        files are added using their modification time as last access; entries
+        for files that no longer exist are dropped.
+        '''
+        on_disk = {}
+        for root, dirs, files in os.walk(self.base_dir):
+            for file_name in files:
+                # validators sidecars belong to (and are evicted with) their
+                # files
+                if file_name.startswith(INDEX_FILE_NAME) or \
+                        file_name.endswith(VALIDATORS_SUFFIX):
+                    continue
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                on_disk[self.relative_path(path)] = stat
+
+        with self._transaction() as db:
+            known = set(r[0] for r in db.execute('SELECT path FROM entries'))
+
+            for key in known - set(on_disk):
+                db.execute('DELETE FROM entries WHERE path=? AND pinned=0',
+                           (key,))
+
+            for key, stat in on_disk.items():
+                if key in known:
+                    db.execute('UPDATE entries SET size=? WHERE path=?',
+                               (stat.st_size, key))
+                else:
+                    db.execute('INSERT INTO entries (path, size, last_access) '
+                               'VALUES (?, ?, ?)',
+                               (key, stat.st_size, stat.st_mtime))
+
+    def usage(self):
+        ''' Summarize disk usage of the cache directory.
+
+        Returns
+        -------
+        dict
+            total_bytes, file_count, pinned_bytes, pinned_count, quota, policy
+        '''
+        with closing(self._connect()) as db:
+            total, count = db.execute(
+                'SELECT COALESCE(SUM(size), 0), COUNT(*) FROM entries').fetchone()
+            pinned, pinned_count = db.execute(
+                'SELECT COALESCE(SUM(size), 0), COUNT(*) FROM entries '
+                'WHERE pinned=1').fetchone()
+
+        return {'total_bytes': total,
+                'file_count': count,
+                'pinned_bytes': pinned,
+                'pinned_count': pinned_count,
+                'quota': self.quota,
+                'policy': self.policy}
+
+    def entries(self):
+        ''' List indexed files as dicts, most recently used first.
+        '''
+        with closing(self._connect()) as db:
+            rows = db.execute('SELECT path, size, last_access, access_count, '
+                              'pinned FROM entries '
+                              'ORDER BY last_access DESC').fetchall()
+
+        return [{'path': os.path.join(self.base_dir, r[0]),
+                 'size': r[1],
+                 'last_access': r[2],
+                 'access_count': r[3],
+                 'pinned': bool(r[4])} for r in rows]
+
+    def prune(self, quota=None, policy=None, keep=None, dry_run=False):
+        ''' Remove files until the cache fits in its quota.
+
+        Pinned files, files with an unexpired lease and files in keep are
+        never removed.
+
+        Parameters
+        ----------
+        quota : int or string, optional
+            target size.  Default is the stored quota.
+        policy : string, optional
+            'lru' or 'lfu'.  Default is the stored policy.
+        keep : list of strings, optional
+            paths to leave in place regardless of policy
+        dry_run : boolean, optional
+            only report what would be removed
+
+        Returns
+        -------
+        list of strings
+            paths that were (or would be) removed
+        '''
+        quota = self.quota if quota is None else parse_size(quota)
+        policy = self.policy if policy is None else policy
+
+        if quota is None:
+            return []
+        if policy not in POLICIES:
+            raise ValueError("Unknown eviction policy: %s" % policy)
+
+        if policy == 'lru':
+            order = 'last_access ASC, access_count ASC'
+        else:
+            order = 'access_count ASC, last_access ASC'
+
+        keep = set(self.relative_path(p) for p in (keep or []))
+        removed = []
+
+        with self._transaction() as db:
+            db.execute('DELETE FROM leases WHERE expires < ?', (time.time(),))
+
+            total = db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+            if total <= quota:
+                return removed
+
+            candidates = db.execute(
+                'SELECT path, size FROM entries WHERE pinned=0 AND path NOT IN '
+                '(SELECT path FROM leases) ORDER BY ' + order).fetchall()
+
+            for key, size in candidates:
+                if total <= quota:
+                    break
+                if key in keep:
+                    continue
+
+                path = os.path.join(self.base_dir, key)
+
+                if not dry_run:
+                    try:
+                        if os.path.exists(path):
+                            os.remove(path)
+                        remove_validators(path)
+                    except OSError as e:
+                        # e.g. open by another process on Windows
+                        _log.warning("Could not evict %s: %s", path, e)
+                        continue
+                    db.execute('DELETE FROM entries WHERE path=?', (key,))
+
+                _log.info("Evicting %s (%s)", path, format_size(size))
+                removed.append(path)
+                total -= size
+
+        return removed
+
+    def enforce_quota(self, path=None):
+        ''' Record an access to path, if given, then prune to the quota while
+        keeping path.
+        '''
+        if path is not None:
+            self.record_access(path)
+
+        if self.quota is not None:
+            return self.prune(keep=[path] if path is not None else None)
+
+        return []
+
+
+def register(index):
+    ''' Make Cache.cacher report accesses under index.base_dir to index.
+    '''
+    with _registry_lock:
+        _registry[index.base_dir] = index
+
+
+def unregister(index):
+    with _registry_lock:
+        _registry.pop(index.base_dir, None)
+
+
+def index_for(path):
+    ''' The registered index with the deepest directory containing path.
+    '''
+    if not _registry or path is None:
+        return None
+
+    with _registry_lock:
+        indexes = [i for i in _registry.values() if i.contains(path)]
+
+    if not indexes:
+        return None
+
+    return max(indexes, key=lambda i: len(i.base_dir))
+
+
+def record_access(path):
+    index = index_for(path)
+    if index is not None:
+        index.record_access(path)
+
+
+def record_create(path):
+    index = index_for(path)
+    if index is not None:
+        index.enforce_quota(path)
+
+
+@contextmanager
+def reading(path):
+    ''' Hold a lease on path, if it is in a registered cache, while reading.
+    '''
+    index = index_for(path)
+    if index is None:
+        yield
+    else:
+        with index.lease(path):
+            yield
+
+
+def open_index(manifest_file, quota=None, policy=None):
+    return CacheIndex(os.path.dirname(os.path.abspath(manifest_file)),
+                      quota=quota, policy=policy)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Report and limit the disk usage of an AllenSDK cache.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    usage_parser = subparsers.add_parser('usage', help='report disk usage')
+    usage_parser.add_argument('manifest_file')
+    usage_parser.add_argument('--top', type=int, default=0,
+                              help='also list the N largest files')
+
+    prune_parser = subparsers.add_parser('prune',
+                                         help='evict files over the quota')
+    prune_parser.add_argument('manifest_file')
+    prune_parser.add_argument('--quota', help='e.g. 500M, 50G.  Stored for '
+                              'future use.')
+    prune_parser.add_argument('--policy', choices=POLICIES)
+    prune_parser.add_argument('--dry_run', action='store_true')
+
+    for command in ['pin', 'unpin']:
+        pin_parser = subparsers.add_parser(command,
+                                           help='%s cached files' % command)
+        pin_parser.add_argument('manifest_file')
+        pin_parser.add_argument('paths', nargs='+')
+
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'prune' and not args.dry_run:
+        index = open_index(args.manifest_file, args.quota, args.policy)
+    else:
+        index = open_index(args.manifest_file)
+
+    index.pin(args.manifest_file)
+    index.scan()
+
+    if args.command == 'usage':
+        usage = index.usage()
+        quota = usage['quota']
+        print('%s: %s in %d files (%s pinned), quota %s, policy %s' % (
+            index.base_dir,
+            format_size(usage['total_bytes']),
+            usage['file_count'],
+            format_size(usage['pinned_bytes']),
+            'none' if quota is None else format_size(quota),
+            usage['policy']))
+
+        if args.top:
+            largest = sorted(index.entries(), key=lambda e: -e['size'])
+            for entry in largest[:args.top]:
+                print('%10s  %s%s' % (format_size(entry['size']),
+                                      entry['path'],
+                                      ' (pinned)' if entry['pinned'] else ''))
+    elif args.command == 'prune':
+        removed = index.prune(quota=args.quota, policy=args.policy,
+                              dry_run=args.dry_run)
+        print('%s %d files' % ('would remove' if args.dry_run else 'removed',
+                               len(removed)))
+    else:
+        for path in args.paths:
+            index.pin(path, pinned=(args.command == 'pin'))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,383 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Timing, byte and cache metrics for api requests and cached queries.
+
+Every json request, file download and Cache.cacher call emits an Event to
+the module registry.  The registry keeps running totals per (kind, method,
+endpoint) and passes each event to any hooks that have been added, e.g. to
+forward them to a monitoring system.  To see where the time goes in a block
+of code, collect a report:
+
+    >>> with instrumentation.collect() as report:
+    ...     mcc.get_structure_unionizes(experiment_ids)
+    >>> print(report)
+'''
+import re
+import time
+import logging
+import threading
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+
+import pandas as pd
+from six.moves.urllib.parse import urlparse
+
+import allensdk.core.json_utilities as json_utilities
+
+
+_log = logging.getLogger('allensdk.api.instrumentation')
+
+REQUEST = 'request'
+DOWNLOAD = 'download'
+CACHE = 'cache'
+
+Event = namedtuple('Event', ['kind', 'method', 'endpoint', 'outcome',
+                             'elapsed', 'nbytes', 'parse_time', 'retries',
+                             'timestamp'])
+'''kind : string
+    'request' (json query), 'download' (file) or 'cache' (Cache.cacher call)
+method : string
+    the innermost @cacheable method (or operation block) that was running,
+    else the name of the transport function
+endpoint : string
+    host and path of the url with numeric path segments replaced by {id}
+    (requests and downloads), or the cached file's name with digits replaced
+    by {id} (cache)
+outcome : string
+    requests and downloads: 'ok', 'error', 'not_modified' or 'cached'
+    (answered by the RmaApi response cache).
+    cache: 'hit', 'miss' (lazy, file was absent), 'create', 'revalidate' or
+    'pass_through'
+elapsed : float
+    seconds from start to finish, including parse_time
+nbytes : int
+    response body size in bytes
+parse_time : float
+    seconds spent parsing the response or reading the cached file
+retries : int
+    failed attempts repeated before this one (see note_retry)
+timestamp : float
+    time.time() at the end of the event
+'''
+
+_ID_SEGMENT = re.compile(r'(?<=/)\d+(?=/|$)')
+_DIGITS = re.compile(r'\d+')
+
+_context = threading.local()
+
+
+def endpoint(url):
+    ''' Group urls that differ only in query string or numeric ids.
+    '''
+    if url is None:
+        return None
+
+    parsed = urlparse(url)
+    return parsed.netloc + _ID_SEGMENT.sub('{id}', parsed.path)
+
+
+def cache_endpoint(path):
+    if path is None:
+        return None
+
+    return _DIGITS.sub('{id}', path.replace('\\', '/').rsplit('/', 1)[-1])
+
+
+class MetricsRegistry(object):
+    ''' Running totals of events, plus hooks called with each event.
+    '''
+
+    COLUMNS = ['count', 'errors', 'hits', 'misses', 'creates', 'elapsed',
+               'max_elapsed', 'nbytes', 'parse_time', 'retries']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks = []
+        self._totals = OrderedDict()
+
+    def add_hook(self, hook):
+        ''' Call hook(event) for every event from now on.  Hooks are called
+        on the thread that did the work and must be thread safe; exceptions
+        they raise are logged and ignored.
+        '''
+        with self._lock:
+            self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks = [h for h in self._hooks if h is not hook]
+
+    def emit(self, event):
+        with self._lock:
+            key = (event.kind, event.method, event.endpoint)
+            totals = self._totals.get(key)
+            if totals is None:
+                totals = self._totals[key] = dict.fromkeys(self.COLUMNS, 0)
+            accumulate(totals, event)
+            hooks = self._hooks
+
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                _log.warning("Instrumentation hook %r failed: %s", hook, e)
+
+    def summary(self):
+        ''' Totals so far, one row per (kind, method, endpoint).
+
+        Returns
+        -------
+        pandas.DataFrame
+        '''
+        with self._lock:
+            rows = [dict(totals, kind=k[0], method=k[1], endpoint=k[2])
+                    for k, totals in self._totals.items()]
+
+        return summary_frame(rows, self.COLUMNS)
+
+    def reset(self):
+        with self._lock:
+            self._totals = OrderedDict()
+
+
+def accumulate(totals, event):
+    totals['count'] += 1
+    totals['errors'] += event.outcome == 'error'
+    totals['hits'] += event.outcome in ('hit', 'cached', 'not_modified')
+    totals['misses'] += event.outcome == 'miss'
+    totals['creates'] += event.outcome in ('miss', 'create')
+    totals['elapsed'] += event.elapsed
+    totals['max_elapsed'] = max(totals['max_elapsed'], event.elapsed)
+    totals['nbytes'] += event.nbytes or 0
+    totals['parse_time'] += event.parse_time or 0.0
+    totals['retries'] += event.retries or 0
+
+
+def summary_frame(rows, columns):
+    index = ['kind', 'method', 'endpoint']
+    df = pd.DataFrame(rows, columns=index + columns)
+    df['mean_elapsed'] = df['elapsed'] / df['count'].clip(lower=1)
+
+    return df.set_index(index).sort_index()
+
+
+registry = MetricsRegistry()
+
+
+class MetricsReport(object):
+    ''' Events collected by collect().
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events = []
+        self.start = time.time()
+        self.wall_time = None
+
+    def add(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def summary(self):
+        ''' Totals per (kind, method, endpoint).
+
+        Returns
+        -------
+        pandas.DataFrame
+        '''
+        totals = OrderedDict()
+        with self._lock:
+            events = list(self.events)
+
+        for event in events:
+            key = (event.kind, event.method, event.endpoint)
+            if key not in totals:
+                totals[key] = dict.fromkeys(MetricsRegistry.COLUMNS, 0)
+            accumulate(totals[key], event)
+
+        rows = [dict(t, kind=k[0], method=k[1], endpoint=k[2])
+                for k, t in totals.items()]
+
+        return summary_frame(rows, MetricsRegistry.COLUMNS)
+
+    def totals(self):
+        ''' Overall totals per kind of event.
+
+        Returns
+        -------
+        dict
+            kind -> dict of the summary columns
+        '''
+        df = self.summary().groupby(level='kind').agg(
+            {'count': 'sum', 'errors': 'sum', 'hits': 'sum', 'misses': 'sum',
+             'creates': 'sum', 'elapsed': 'sum', 'max_elapsed': 'max',
+             'nbytes': 'sum', 'parse_time': 'sum', 'retries': 'sum'})
+
+        return {kind: row.to_dict() for kind, row in df.iterrows()}
+
+    def __str__(self):
+        wall_time = self.wall_time
+        if wall_time is None:
+            wall_time = time.time() - self.start
+
+        with pd.option_context('display.width', 200,
+                               'display.max_columns', 20):
+            return "%d events in %.3f s\n%s" % (len(self.events), wall_time,
+                                                self.summary())
+
+
+@contextmanager
+def collect(metrics=None):
+    ''' Collect the events emitted (by any thread) while the block runs.
+
+    Parameters
+    ----------
+    metrics : MetricsRegistry, optional
+        defaults to the module registry
+
+    Yields
+    ------
+    MetricsReport
+    '''
+    if metrics is None:
+        metrics = registry
+
+    report = MetricsReport()
+    metrics.add_hook(report.add)
+
+    try:
+        yield report
+    finally:
+        metrics.remove_hook(report.add)
+        report.wall_time = time.time() - report.start
+
+
+@contextmanager
+def operation(name):
+    ''' Attribute the events emitted by this thread within the block to name.
+    '''
+    stack = getattr(_context, 'operations', None)
+    if stack is None:
+        stack = _context.operations = []
+
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def current_operation(default=None):
+    stack = getattr(_context, 'operations', None)
+    return stack[-1] if stack else default
+
+
+class Measurement(object):
+    ''' Fields of an event being measured; see Event.
+    '''
+
+    def __init__(self):
+        self.outcome = 'ok'
+        self.nbytes = 0
+        self.parse_time = 0.0
+        self.retries = 0
+
+
+@contextmanager
+def measure(kind, default_method, url=None, path=None):
+    ''' Time the block and emit an Event when it ends.  The block can fill in
+    the yielded Measurement; an exception sets the outcome to 'error'.
+    Transport functions called within the block can add to it with note().
+    '''
+    measurement = Measurement()
+    measurement.retries = getattr(_context, 'retries', 0)
+    _context.retries = 0
+
+    stack = getattr(_context, 'measurements', None)
+    if stack is None:
+        stack = _context.measurements = []
+
+    stack.append(measurement)
+    start = time.time()
+
+    try:
+        yield measurement
+    except BaseException:
+        measurement.outcome = 'error'
+        raise
+    finally:
+        stack.pop()
+        record(kind, default_method, measurement.outcome,
+               time.time() - start, url=url, path=path,
+               nbytes=measurement.nbytes,
+               parse_time=measurement.parse_time,
+               retries=measurement.retries)
+
+
+def record(kind, default_method, outcome, elapsed, url=None, path=None,
+           nbytes=0, parse_time=0.0, retries=0):
+    ''' Emit a single Event to the module registry.
+    '''
+    registry.emit(Event(kind,
+                        current_operation(default_method),
+                        endpoint(url) if path is None else cache_endpoint(path),
+                        outcome,
+                        elapsed,
+                        nbytes,
+                        parse_time,
+                        retries,
+                        time.time()))
+
+
+def note(nbytes=0, parse_time=0.0):
+    ''' Add bytes and parse time to the innermost measurement on this thread,
+    if there is one.
+    '''
+    stack = getattr(_context, 'measurements', None)
+    if stack:
+        stack[-1].nbytes += nbytes
+        stack[-1].parse_time += parse_time
+
+
+def note_retry():
+    ''' Count a failed attempt that is about to be repeated.  The count is
+    reported by the next event measured on this thread.
+    '''
+    _context.retries = getattr(_context, 'retries', 0) + 1
+
+
+json_utilities.add_url_read_hook(
+    lambda nbytes, parse_time: note(nbytes=nbytes, parse_time=parse_time))
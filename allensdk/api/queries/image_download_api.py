@@ -36,6 +36,26 @@
 from .rma_template import RmaTemplate
 from ..cache import cacheable
 from six import string_types
+import os
+import math
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import requests
+
+from allensdk.config.manifest import Manifest
+import allensdk.api.instrumentation as instrumentation
+import allensdk.api.revalidation as revalidation
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+_log = logging.getLogger('allensdk.api.queries.image_download_api')
 
 
 class ImageDownloadApi(RmaTemplate):
@@ -443,6 +463,189 @@ class ImageDownloadApi(RmaTemplate):
         self.retrieve_file_over_http(image_url, file_path)
 
 
+    def download_image_tiled(self,
+                             image_id,
+                             file_path,
+                             width=None,
+                             height=None,
+                             top=None,
+                             left=None,
+                             downsample=0,
+                             tile_size=2048,
+                             output='memmap',
+                             tile_dir=None,
+                             keep_tiles=False,
+                             max_workers=4,
+                             retries=3,
+                             endpoint=None,
+                             **kwargs):
+        ''' Download a large image as a grid of tiles, concurrently, and
+        stitch them together on disk.
+
+        Tiles are saved in tile_dir as they arrive, so an interrupted
+        download can be resumed by calling this again with the same
+        arguments; only missing tiles are requested.
+
+        Parameters
+        ----------
+        image_id : integer
+            SubImage to download.
+        file_path : string
+            where to write the stitched image: a .npy file (output='memmap')
+            or a tiled TIFF (output='tiff').
+        width, height : int, optional
+            Size of the region of interest in tier-resolution pixels.
+            Defaults to the full image.
+        top, left : int, optional
+            Origin of the region of interest in full-resolution pixels.
+            Defaults to SectionImage.y and SectionImage.x.
+        downsample : int, optional
+            Number of times to downsample the original image.  Default 0.
+        tile_size : int, optional
+            Width and height of the tiles requested, in tier-resolution
+            pixels.  Default 2048.
+        output : string, optional
+            'memmap' (default) or 'tiff'.  'tiff' requires tifffile.
+        tile_dir : string, optional
+            where to keep tiles until they are stitched.  Defaults to
+            file_path + '.tiles'.
+        keep_tiles : bool, optional
+            If False (default), remove the tiles after stitching.
+        max_workers : int, optional
+            Number of tiles downloaded at once.  Default 4.
+        retries : int, optional
+            Number of times a failed tile is requested again.  Default 3.
+        endpoint : string, optional
+            Image download service.  Defaults to the section image service.
+        kwargs : objects
+            Passed through to download_image (e.g. range, quality).
+
+        Returns
+        -------
+        string
+            file_path
+
+        '''
+        if output not in ('memmap', 'tiff'):
+            raise ValueError("output must be 'memmap' or 'tiff'")
+
+        if output == 'tiff' and tifffile is None:
+            raise ImportError("tifffile is required to write tiled TIFFs")
+
+        if endpoint is None:
+            endpoint = self.section_image_download_endpoint
+
+        if None in (width, height, top, left):
+            record = self.model_query(
+                'SectionImage', criteria='[id$eq%d]' % image_id,
+                only=['id', 'x', 'y', 'width', 'height'])[0]
+
+            if width is None:
+                width = _tier_size(record['width'], downsample)
+            if height is None:
+                height = _tier_size(record['height'], downsample)
+            if top is None:
+                top = record['y']
+            if left is None:
+                left = record['x']
+
+        if tile_dir is None:
+            tile_dir = file_path + '.tiles'
+        Manifest.safe_mkdir(tile_dir)
+
+        tiles = _tile_grid(width, height, tile_size)
+        scale = 2 ** downsample
+
+        def fetch(tile):
+            row, col, tile_height, tile_width = tile
+            tile_path = _tile_path(tile_dir, row, col)
+            if os.path.exists(tile_path):
+                return tile_path
+
+            partial_path = tile_path + '.partial'
+            _retry(lambda: self.download_image(
+                       image_id, partial_path, endpoint=endpoint,
+                       top=top + row * scale, left=left + col * scale,
+                       width=tile_width, height=tile_height,
+                       downsample=downsample, downsample_dimensions=False,
+                       **kwargs),
+                   retries)
+            os.rename(partial_path, tile_path)
+            # validators are only written for revalidated files, but don't
+            # leave one behind for a name that no longer exists
+            revalidation.remove_validators(partial_path)
+
+            return tile_path
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fetch, tile) for tile in tiles]
+            for future in as_completed(futures):
+                future.result()
+
+        _stitch_tiles(tile_dir, tiles, width, height, file_path, output,
+                      tile_size)
+
+        if not keep_tiles:
+            for row, col, _, _ in tiles:
+                os.remove(_tile_path(tile_dir, row, col))
+            try:
+                os.rmdir(tile_dir)
+            except OSError as e:
+                _log.warning("Could not remove tile directory %s: %s",
+                             tile_dir, e)
+
+        return file_path
+
+    def download_section_images_tiled(self,
+                                      section_data_set_id,
+                                      directory,
+                                      downsample=0,
+                                      output='memmap',
+                                      **kwargs):
+        ''' Download every image of a section data set with
+        download_image_tiled.  Images that have already been stitched are
+        skipped, so this can be resumed.
+
+        Parameters
+        ----------
+        section_data_set_id : integer
+            Download the images returned by section_image_query for this
+            data set.
+        directory : string
+            Images are saved here as <section image id>.npy or .tif
+        downsample : int, optional
+            Number of times to downsample the original images.  Default 0.
+        output : string, optional
+            'memmap' (default) or 'tiff'
+        kwargs : objects
+            Passed through to download_image_tiled.
+
+        Returns
+        -------
+        dict
+            section image id -> file path
+        '''
+        extension = '.npy' if output == 'memmap' else '.tif'
+        Manifest.safe_mkdir(directory)
+
+        paths = {}
+        for record in self.section_image_query(section_data_set_id):
+            image_id = record['id']
+            file_path = os.path.join(directory, '%d%s' % (image_id, extension))
+
+            if not os.path.exists(file_path):
+                _log.info("Downloading section image %d", image_id)
+                self.download_image_tiled(
+                    image_id, file_path,
+                    width=_tier_size(record['width'], downsample),
+                    height=_tier_size(record['height'], downsample),
+                    top=record['y'], left=record['x'],
+                    downsample=downsample, output=output, **kwargs)
+
+            paths[image_id] = file_path
+
+        return paths
+
     def atlas_image_query(self, atlas_id, image_type_name=None):
         '''List atlas images belonging to a specified atlas
 
@@ -498,3 +701,72 @@ class ImageDownloadApi(RmaTemplate):
 
         return self.json_msg_query(
             self.build_query_url(stages))
+
+
+def _tier_size(full_size, downsample):
+    return int(math.ceil(full_size / float(2 ** downsample)))
+
+
+def _tile_grid(width, height, tile_size):
+    ''' (row, column, height, width) of each tile, in tier pixels.
+    '''
+    return [(row, col, min(tile_size, height - row), min(tile_size, width - col))
+            for row in range(0, height, tile_size)
+            for col in range(0, width, tile_size)]
+
+
+def _tile_path(tile_dir, row, col):
+    return os.path.join(tile_dir, '%d_%d.jpg' % (row, col))
+
+
+def _retry(fn, retries, backoff=1.0):
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except (requests.exceptions.RequestException, IOError) as e:
+            if attempt == retries:
+                raise
+            _log.warning("Retrying tile download (%s)", e)
+            instrumentation.note_retry()
+            time.sleep(backoff * 2 ** attempt)
+
+
+def _stitch_tiles(tile_dir, tiles, width, height, file_path, output,
+                  tile_size):
+    ''' Paste tiles into an array on disk.  Tiles the server returned
+    slightly smaller or larger than requested are cropped to fit.
+    '''
+    import skimage.io
+
+    partial_path = file_path + '.partial'
+    stitched = None
+
+    for row, col, tile_height, tile_width in tiles:
+        tile = skimage.io.imread(_tile_path(tile_dir, row, col))
+
+        if stitched is None:
+            shape = (height, width) + tile.shape[2:]
+            stitched = np.lib.format.open_memmap(
+                partial_path if output == 'memmap' else partial_path + '.npy',
+                mode='w+', dtype=tile.dtype, shape=shape)
+
+        rows = min(tile.shape[0], tile_height)
+        cols = min(tile.shape[1], tile_width)
+        stitched[row:row + rows, col:col + cols] = tile[:rows, :cols]
+
+    stitched.flush()
+
+    if output == 'tiff':
+        # tiff tiles must be a multiple of 16 pixels
+        tiff_tile = max(16, (min(tile_size, 512) // 16) * 16)
+        imwrite = getattr(tifffile, 'imwrite', None) or tifffile.imsave
+        imwrite(partial_path, stitched, tile=(tiff_tile, tiff_tile))
+        memmap_path = stitched.filename
+        del stitched
+        os.remove(memmap_path)
+    else:
+        del stitched
+
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    os.rename(partial_path, file_path)
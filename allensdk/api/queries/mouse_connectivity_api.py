@@ -35,7 +35,10 @@
 #
 from .reference_space_api import ReferenceSpaceApi
 from .grid_data_api import GridDataApi
+from .rma_api import in_clause_chunks
+from .rma_pager import RmaPager
 from ..cache import cacheable, Cache
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import nrrd
 import six
@@ -49,6 +52,12 @@ class MouseConnectivityApi(ReferenceSpaceApi, GridDataApi):
     '''
     PRODUCT_IDS = [5, 31]
 
+    # experiments per structure unionize query.  Each experiment has
+    # several thousand unionize records, which are requested in pages of
+    # UNIONIZE_PAGE_SIZE rows.
+    UNIONIZE_CHUNK_SIZE = 10
+    UNIONIZE_PAGE_SIZE = 10000
+
     def __init__(self, base_uri=None):
         super(MouseConnectivityApi, self).__init__(base_uri=base_uri)
 
@@ -398,7 +407,51 @@ class MouseConnectivityApi(ReferenceSpaceApi, GridDataApi):
                                 normalized_projection_volume_limit=None,
                                 include=None,
                                 debug=None,
-                                order=None):
+                                order=None,
+                                chunk_size=None,
+                                max_workers=4):
+        ''' Query the ProjectionStructureUnionize records of many
+        experiments.  Large lists of experiments are split into several
+        queries (of at most chunk_size experiments, with url-length-safe
+        id lists) which run concurrently.  Queries for more than one
+        experiment are paged, UNIONIZE_PAGE_SIZE rows at a time.
+
+        Parameters
+        ----------
+        experiment_ids : list of int
+            section_data_set_ids of the experiments
+        chunk_size : int, optional
+            experiments per query.  Default UNIONIZE_CHUNK_SIZE.
+        max_workers : int, optional
+            number of queries run at once.  Default 4.
+
+        Returns
+        -------
+        list of dict
+            unionize records, in the order of the chunks
+        '''
+        if chunk_size is None:
+            chunk_size = self.UNIONIZE_CHUNK_SIZE
+
+        chunks = in_clause_chunks(list(experiment_ids), max_count=chunk_size)
+
+        if len(chunks) > 1:
+            query = lambda chunk: self.get_structure_unionizes(
+                chunk,
+                is_injection=is_injection,
+                structure_name=structure_name,
+                structure_ids=structure_ids,
+                hemisphere_ids=hemisphere_ids,
+                normalized_projection_volume_limit=normalized_projection_volume_limit,
+                include=include,
+                debug=debug,
+                order=order,
+                chunk_size=len(chunk))
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(query, chunks))
+
+            return [record for result in results for record in result]
 
         experiment_filter = '[section_data_set_id$in%s]' %\
                             ','.join(str(i) for i in experiment_ids)
@@ -430,18 +483,34 @@ class MouseConnectivityApi(ReferenceSpaceApi, GridDataApi):
         else:
             structure_filter = ''
 
-        return self.model_query(
-            'ProjectionStructureUnionize',
-            criteria=''.join([experiment_filter,
-                              is_injection_filter,
-                              volume_filter,
-                              hemisphere_filter,
-                              structure_filter]),
-            include=include,
-            order=order,
-            num_rows='all',
-            debug=debug,
-            count=False)
+        criteria = ''.join([experiment_filter,
+                            is_injection_filter,
+                            volume_filter,
+                            hemisphere_filter,
+                            structure_filter])
+
+        if len(experiment_ids) == 1:
+            return self.model_query(
+                'ProjectionStructureUnionize',
+                criteria=criteria,
+                include=include,
+                order=order,
+                num_rows='all',
+                debug=debug,
+                count=False)
+
+        # pages need a stable order
+        if order is None:
+            order = ['id']
+
+        return list(RmaPager.pager(self.model_query,
+                                   'ProjectionStructureUnionize',
+                                   criteria=criteria,
+                                   include=include,
+                                   order=order,
+                                   num_rows=self.UNIONIZE_PAGE_SIZE,
+                                   total_rows='all',
+                                   debug=debug))
 
     @cacheable(strategy='create', 
                pathfinder=Cache.pathfinder(file_name_position=1,
@@ -34,7 +34,10 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 from ..api import Api
+from ..response_cache import ResponseCache
+from .. import instrumentation
 import warnings
+import time
 
 
 class RmaApi(Api):
@@ -63,9 +66,82 @@ class RmaApi(Api):
     IS = '$is'
     EQ = '$eq'
 
+    # shared by all RmaApi instances unless set on an instance.
+    # None disables response caching.
+    response_cache = None
+
     def __init__(self, base_uri=None):
         super(RmaApi, self).__init__(base_uri)
 
+    @classmethod
+    def enable_response_cache(cls, ttl=3600.0, max_entries=1024, path=None):
+        '''Cache RMA responses by url for every RmaApi in this process, and
+        send concurrent identical queries over the wire only once.
+
+        Parameters
+        ----------
+        ttl : float or None, optional
+            seconds a response stays fresh.  Default 3600; None never expires.
+        max_entries : int or None, optional
+            responses kept in memory.  Default 1024.
+        path : string, optional
+            SQLite file to also store responses in, so they persist across
+            processes.
+
+        Returns
+        -------
+        ResponseCache
+        '''
+        RmaApi.response_cache = ResponseCache(ttl=ttl,
+                                              max_entries=max_entries,
+                                              path=path)
+        return RmaApi.response_cache
+
+    @classmethod
+    def disable_response_cache(cls):
+        RmaApi.response_cache = None
+
+    def retrieve_parsed_json_over_http(self, url, post=False):
+        '''Get the document and put it in a Python data structure, from the
+        response cache if one is enabled.  POST queries are never cached.
+
+        Parameters
+        ----------
+        url : string
+            Full API query url.
+        post : boolean
+            True does an HTTP POST, False (default) encodes the URL and does a GET
+
+        Returns
+        -------
+        dict
+            Result document as parsed by the JSON library.
+        '''
+        parent = super(RmaApi, self)
+
+        if self.response_cache is None or post:
+            return parent.retrieve_parsed_json_over_http(url, post)
+
+        fetched = []
+
+        def fetch():
+            fetched.append(True)
+            return parent.retrieve_parsed_json_over_http(url, post)
+
+        start = time.time()
+        data = self.response_cache.fetch(
+            url,
+            fetch,
+            storable=lambda data: not (isinstance(data, dict) and
+                                       data.get('success') is False))
+
+        if not fetched:
+            instrumentation.record(instrumentation.REQUEST,
+                                   'retrieve_parsed_json_over_http',
+                                   'cached', time.time() - start, url=url)
+
+        return data
+
     def build_query_url(self,
                         stage_clauses,
                         fmt='json'):
@@ -598,3 +674,41 @@ class RmaApi(Api):
                                     clazz)
 
         return schema_data
+
+
+def in_clause_chunks(values, max_count=None, max_length=2000):
+    ''' Split values into lists small enough to use in one $in filter.
+
+    Parameters
+    ----------
+    values : list
+        the values of the filter
+    max_count : int, optional
+        most values in one chunk.  Default is no limit.
+    max_length : int, optional
+        most characters of the comma-separated values in one chunk, to keep
+        the query url to a size servers and proxies accept.  Default 2000.
+
+    Returns
+    -------
+    list of lists
+    '''
+    chunks = []
+    chunk = []
+    length = 0
+
+    for value in values:
+        value_length = len(str(value)) + 1
+        if chunk and ((max_count is not None and len(chunk) >= max_count) or
+                      length + value_length > max_length):
+            chunks.append(chunk)
+            chunk = []
+            length = 0
+
+        chunk.append(value)
+        length += value_length
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
@@ -0,0 +1,381 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Record api.brain-map.org traffic and replay it from a local server.
+
+In record mode the server forwards every request to an upstream api server and
+saves the response in an archive directory, keyed by the normalized request.
+In replay mode it answers from the archive, optionally adding latency and
+limiting bandwidth, so cache and pager throughput can be benchmarked without
+network access.  Point any Api at it with
+``Api(api_base_url_string=server.url)``.
+
+Command line usage::
+
+    python -m allensdk.api.replay_server record archive_dir --port 8080
+    python -m allensdk.api.replay_server replay archive_dir --port 8080 \\
+        --latency 0.05 --bandwidth 20M
+'''
+import os
+import sys
+import time
+import json
+import hashlib
+import logging
+import argparse
+import threading
+
+import requests
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import unquote, quote
+
+from allensdk.api.api import Api
+from allensdk.api.cache_manager import parse_size
+from allensdk.api.response_cache import normalize_url
+
+
+_log = logging.getLogger('allensdk.api.replay_server')
+
+# response headers stored with each recorded body
+RECORDED_HEADERS = ('Content-Type', 'Content-Disposition',
+                    'ETag', 'Last-Modified')
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ResponseArchive(object):
+    ''' Recorded responses stored as one body file per request plus a json
+    index of status codes and headers.
+
+    Parameters
+    ----------
+    directory : string
+        where the archive lives.  Created if it does not exist.
+    '''
+    INDEX_FILE_NAME = 'index.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.index_path = os.path.join(directory, self.INDEX_FILE_NAME)
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    @staticmethod
+    def key(method, url, body=None):
+        key = method.upper() + ' ' + normalize_url(url)
+        if body:
+            key += ' ' + hashlib.sha1(body).hexdigest()
+        return key
+
+    def body_path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key):
+        ''' Look up a recorded response.
+
+        Returns
+        -------
+        entry : dict
+            status and headers
+        body_path : string
+            file holding the response body
+        '''
+        entry = self.index[key]
+        return entry, self.body_path(key)
+
+    def put(self, key, status, headers, body):
+        with open(self.body_path(key), 'wb') as f:
+            f.write(body)
+
+        with self._lock:
+            self.index[key] = {'status': status,
+                               'headers': dict(headers),
+                               'size': len(body)}
+
+            temp_path = self.index_path + '.partial'
+            with open(temp_path, 'w') as f:
+                json.dump(self.index, f, indent=2, sort_keys=True)
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            os.rename(temp_path, self.index_path)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        _log.debug(format, *args)
+
+    def do_GET(self):
+        self._respond(include_body=True)
+
+    def do_HEAD(self):
+        self._respond(include_body=False)
+
+    def do_POST(self):
+        self._respond(include_body=True)
+
+    def _respond(self, include_body):
+        server = self.server.replay_server
+
+        length = int(self.headers.get('Content-Length') or 0)
+        request_body = self.rfile.read(length) if length else None
+        method = 'GET' if self.command == 'HEAD' else self.command
+        key = ResponseArchive.key(method, self.path, request_body)
+
+        if key not in server.archive:
+            if server.mode == 'record':
+                try:
+                    server.record(key, method, self.path, request_body)
+                except requests.exceptions.RequestException as e:
+                    self._send_error(502, 'upstream request failed: %s' % e)
+                    return
+            else:
+                self._send_error(404, 'not in archive: %s' % key)
+                return
+
+        entry, body_path = server.archive.get(key)
+        headers = entry['headers']
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if entry['status'] == 200 and self._not_modified(headers):
+            self.send_response(304)
+            for name in ('ETag', 'Last-Modified'):
+                if name in headers:
+                    self.send_header(name, headers[name])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(entry['status'])
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(entry['size']))
+        self.end_headers()
+
+        if include_body:
+            with open(body_path, 'rb') as f:
+                server.send_throttled(f, self.wfile)
+
+    def _not_modified(self, headers):
+        etag = self.headers.get('If-None-Match')
+        if etag is not None and headers.get('ETag') is not None:
+            return etag == headers['ETag']
+
+        since = self.headers.get('If-Modified-Since')
+        if since is not None and headers.get('Last-Modified') is not None:
+            return since == headers['Last-Modified']
+
+        return False
+
+    def _send_error(self, status, message):
+        body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ReplayServer(object):
+    ''' Local HTTP stand-in for the Allen Brain Atlas api.
+
+    Parameters
+    ----------
+    archive_dir : string
+        directory of recorded responses
+    mode : string, optional
+        'replay' (default) answers only from the archive and returns 404 for
+        unknown requests; 'record' forwards unknown requests upstream and
+        saves the responses.
+    upstream : string, optional
+        api server to record from.  Default is Api.default_api_url.
+    latency : float, optional
+        seconds to wait before each response.  Default 0.
+    bandwidth : int or string, optional
+        maximum bytes per second for each response body, e.g. '20M'.
+        Default is unlimited.
+    host : string, optional
+        interface to listen on.  Default 127.0.0.1.
+    port : int, optional
+        port to listen on.  Default 0 picks a free port.
+    '''
+
+    def __init__(self, archive_dir,
+                 mode='replay',
+                 upstream=None,
+                 latency=0.0,
+                 bandwidth=None,
+                 host='127.0.0.1',
+                 port=0):
+        if mode not in ('replay', 'record'):
+            raise ValueError("Unknown replay server mode: %s" % mode)
+
+        self.archive = ResponseArchive(archive_dir)
+        self.mode = mode
+        self.upstream = (upstream or Api.default_api_url).rstrip('/')
+        self.latency = latency
+        self.bandwidth = parse_size(bandwidth)
+
+        self.httpd = _ThreadingHTTPServer((host, port), _ReplayHandler)
+        self.httpd.replay_server = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def record(self, key, method, path, body=None):
+        url = self.upstream + quote(unquote(path), safe=";/?:@&=+$,%")
+        _log.info("Recording %s", url)
+
+        response = requests.request(method, url, data=body,
+                                    timeout=(9.05, 300))
+
+        headers = {name: response.headers[name]
+                   for name in RECORDED_HEADERS if name in response.headers}
+
+        self.archive.put(key, response.status_code, headers, response.content)
+
+    def send_throttled(self, source, destination):
+        chunk_size = CHUNK_SIZE
+        if self.bandwidth:
+            chunk_size = max(1, min(CHUNK_SIZE, self.bandwidth // 10))
+
+        start = time.time()
+        sent = 0
+
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+
+            sent += len(chunk)
+
+            if self.bandwidth:
+                delay = sent / float(self.bandwidth) - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            destination.write(chunk)
+
+    def start(self):
+        ''' Serve requests on a background thread.
+        '''
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Record or replay Allen Brain Atlas api responses.')
+    parser.add_argument('mode', choices=['record', 'replay'])
+    parser.add_argument('archive_dir')
+    parser.add_argument('--upstream', default=Api.default_api_url)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added before each response')
+    parser.add_argument('--bandwidth', default=None,
+                        help='bytes per second per response, e.g. 20M')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = ReplayServer(args.archive_dir,
+                          mode=args.mode,
+                          upstream=args.upstream,
+                          latency=args.latency,
+                          bandwidth=args.bandwidth,
+                          host=args.host,
+                          port=args.port)
+
+    _log.info("%s server for %s listening at %s (%d responses archived)",
+              args.mode, args.archive_dir, server.url, len(server.archive))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
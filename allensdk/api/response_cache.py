@@ -0,0 +1,251 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Cache parsed query responses by url, and coalesce identical requests
+made concurrently from several threads so that only one goes over the wire.
+'''
+import time
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import closing
+
+import simplejson as json
+from six.moves.urllib.parse import urlsplit, parse_qsl, unquote
+
+
+_log = logging.getLogger('allensdk.api.response_cache')
+
+
+def normalize_url(url):
+    ''' Reduce a url to a host-independent key.  Percent-encoding is undone and
+    query parameters are sorted, so the same query built by different code
+    paths maps to one key.
+    '''
+    parts = urlsplit(url)
+    path = unquote(parts.path) or '/'
+    query = sorted(parse_qsl(parts.query, keep_blank_values=True))
+
+    if query:
+        return path + '?' + '&'.join('%s=%s' % (unquote(k), unquote(v))
+                                     for k, v in query)
+    return path
+
+
+def response_key(url):
+    ''' normalize_url, qualified by scheme and host.
+    '''
+    parts = urlsplit(url)
+    return '%s://%s%s' % (parts.scheme, parts.netloc.lower(),
+                          normalize_url(url))
+
+
+class _InFlight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.text = None
+        self.error = None
+
+
+class ResponseCache(object):
+    ''' Url-keyed store of json responses with a time to live.
+
+    Responses are kept as json text and parsed on every hit, so callers that
+    modify the returned data can't affect later hits.
+
+    Parameters
+    ----------
+    ttl : float or None, optional
+        seconds a response stays fresh.  Default 3600; None never expires.
+    max_entries : int or None, optional
+        maximum responses kept in memory, least recently used evicted first.
+        Default 1024.
+    path : string, optional
+        SQLite file in which responses are also stored, so they survive the
+        process and are shared with other processes.
+    '''
+
+    def __init__(self, ttl=3600.0, max_entries=1024, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._in_flight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        if path is not None:
+            with closing(self._connect()) as db:
+                db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                           'key TEXT PRIMARY KEY, '
+                           'expires REAL, '
+                           'body TEXT NOT NULL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+
+    def _expires(self):
+        return None if self.ttl is None else time.time() + self.ttl
+
+    def _get_text(self, key):
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                expires, text = entry
+                if expires is None or expires > now:
+                    self._memory[key] = entry
+                    return text
+
+        if self.path is not None:
+            with closing(self._connect()) as db:
+                row = db.execute('SELECT expires, body FROM responses '
+                                 'WHERE key=?', (key,)).fetchone()
+            if row is not None and (row[0] is None or row[0] > now):
+                self._put_memory(key, row[0], row[1])
+                return row[1]
+
+        return None
+
+    def _put_memory(self, key, expires, text):
+        with self._lock:
+            self._memory.pop(key, None)
+            self._memory[key] = (expires, text)
+
+            while (self.max_entries is not None and
+                   len(self._memory) > self.max_entries):
+                self._memory.popitem(last=False)
+
+    def get(self, url):
+        ''' Return the cached parsed response for url, or None.
+        '''
+        text = self._get_text(response_key(url))
+        return None if text is None else json.loads(text)
+
+    def put(self, url, data):
+        ''' Store a parsed response for url.
+        '''
+        self._put_text(response_key(url), json.dumps(data))
+
+    def _put_text(self, key, text):
+        expires = self._expires()
+        self._put_memory(key, expires, text)
+
+        if self.path is not None:
+            with closing(self._connect()) as db:
+                db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                           (key, expires, text))
+
+    def fetch(self, url, fn, storable=None):
+        ''' Return the cached response for url, or call fn to get it.
+
+        If another thread is already calling fn for the same url, wait for it
+        and share its result instead.
+
+        Parameters
+        ----------
+        url : string
+            query url
+        fn : function
+            no-argument callable returning the parsed response
+        storable : function, optional
+            parsed response -> boolean; responses for which it returns False
+            (e.g. error messages) are shared with waiting threads but not
+            cached.
+
+        Returns
+        -------
+        parsed json
+        '''
+        key = response_key(url)
+
+        text = self._get_text(key)
+        if text is not None:
+            with self._lock:
+                self.hits += 1
+            return json.loads(text)
+
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = _InFlight()
+                self._in_flight[key] = in_flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            in_flight.event.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return json.loads(in_flight.text)
+
+        try:
+            data = fn()
+            in_flight.text = json.dumps(data)
+            if storable is None or storable(data):
+                self._put_text(key, in_flight.text)
+            return data
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.event.set()
+
+    def clear(self):
+        ''' Drop all cached responses, including the SQLite store.
+        '''
+        with self._lock:
+            self._memory.clear()
+
+        if self.path is not None:
+            with closing(self._connect()) as db:
+                db.execute('DELETE FROM responses')
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'coalesced': self.coalesced,
+                    'entries': len(self._memory)}
@@ -0,0 +1,292 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Conditional revalidation of downloaded cache files.
+
+When a file is downloaded with the 'revalidate' cache strategy the response's
+ETag and Last-Modified headers are stored next to it in a small json sidecar.
+Revalidating the file sends them back as If-None-Match / If-Modified-Since;
+the server answers 304 if the file is unchanged, and the body is only
+downloaded again when it has changed.
+'''
+import os
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import requests
+import six
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from allensdk.api.bulk_download import HostLimiter
+
+
+_log = logging.getLogger('allensdk.api.revalidation')
+
+VALIDATORS_SUFFIX = '.validators.json'
+
+UNCHANGED = 'unchanged'
+UPDATED = 'updated'
+FAILED = 'failed'
+
+_context = threading.local()
+
+
+def validators_path(path):
+    return path + VALIDATORS_SUFFIX
+
+
+def read_validators(path):
+    ''' Validators stored for a cached file.
+
+    Returns
+    -------
+    dict or None
+        url, etag and last_modified of the response that wrote the file, or
+        None if there is no (readable) sidecar.
+    '''
+    try:
+        with open(validators_path(path), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_validators(path, url, headers):
+    ''' Store the validators of a response next to the file it was saved to.
+    Nothing is written if the response carried neither an ETag nor a
+    Last-Modified header.
+
+    Parameters
+    ----------
+    path : string
+        the downloaded file
+    url : string
+        where it was downloaded from
+    headers : dict-like
+        response headers
+    '''
+    etag = headers.get('ETag')
+    last_modified = headers.get('Last-Modified')
+
+    if not isinstance(etag, six.string_types):
+        etag = None
+    if not isinstance(last_modified, six.string_types):
+        last_modified = None
+
+    if etag is None and last_modified is None:
+        remove_validators(path)
+        return
+
+    sidecar = validators_path(path)
+    partial = sidecar + '.partial'
+    with open(partial, 'w') as f:
+        json.dump({'url': url,
+                   'etag': etag,
+                   'last_modified': last_modified}, f)
+    _replace(partial, sidecar)
+
+
+def _replace(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # python 2: rename only overwrites on posix
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def remove_validators(path):
+    try:
+        os.remove(validators_path(path))
+    except OSError:
+        pass
+
+
+def conditional_headers(validators):
+    ''' Request headers that ask the server to send the body only if it has
+    changed since the validators were stored.
+    '''
+    headers = {}
+
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    return headers
+
+
+@contextmanager
+def revalidating(path):
+    ''' Within this context, downloads to path are conditional on the stored
+    validators (see allensdk.api.api.Api.retrieve_file_over_http).
+    '''
+    paths = getattr(_context, 'paths', None)
+    if paths is None:
+        paths = _context.paths = set()
+
+    key = os.path.abspath(path)
+    paths.add(key)
+    try:
+        yield
+    finally:
+        paths.discard(key)
+
+
+def is_revalidating(path):
+    paths = getattr(_context, 'paths', None)
+    return bool(paths) and os.path.abspath(path) in paths
+
+
+def revalidate_file(path, timeout=(9.05, 31.1)):
+    ''' Conditionally download a cached file again from the url it came from.
+
+    Parameters
+    ----------
+    path : string
+        a file with a validators sidecar
+    timeout : float or tuple of float, optional
+        passed to requests.get
+
+    Returns
+    -------
+    string
+        'unchanged' if the server answered 304, 'updated' if the file was
+        replaced.
+    '''
+    from allensdk.api.api import stream_file_over_http
+
+    validators = read_validators(path)
+    if validators is None or not validators.get('url'):
+        raise ValueError("No validators stored for %s" % path)
+
+    url = validators['url']
+    partial = path + '.partial'
+
+    try:
+        response = stream_file_over_http(url, partial, timeout=timeout,
+                                         headers=conditional_headers(validators))
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    if response.status_code == 304:
+        _log.info("Unchanged: %s", path)
+        return UNCHANGED
+
+    _replace(partial, path)
+    write_validators(path, url, response.headers)
+    _log.info("Updated: %s", path)
+
+    return UPDATED
+
+
+def find_validated_files(directory):
+    ''' Cached files under directory that have a validators sidecar.
+    Sidecars left behind by files that have since been removed are deleted.
+    '''
+    paths = []
+
+    for root, dirs, files in os.walk(directory):
+        for file_name in sorted(files):
+            if not file_name.endswith(VALIDATORS_SUFFIX):
+                continue
+
+            path = os.path.join(root, file_name[:-len(VALIDATORS_SUFFIX)])
+            if os.path.exists(path):
+                paths.append(path)
+            else:
+                remove_validators(path)
+
+    return paths
+
+
+def revalidate_all(paths,
+                   max_workers=4,
+                   max_per_host=None,
+                   timeout=(9.05, 31.1)):
+    ''' Revalidate many cached files concurrently.
+
+    Parameters
+    ----------
+    paths : iterable of strings
+        files with validators sidecars
+    max_workers : int, optional
+        size of the thread pool.  Default 4.
+    max_per_host : int, optional
+        maximum concurrent requests to one host.  Default is max_workers.
+    timeout : float or tuple of float, optional
+        passed to requests.get
+
+    Returns
+    -------
+    OrderedDict
+        path -> 'unchanged', 'updated' or 'failed', in the order of paths.
+    '''
+    if max_per_host is None:
+        max_per_host = max_workers
+
+    statuses = OrderedDict((path, None) for path in paths)
+
+    if not statuses:
+        return statuses
+
+    limiter = HostLimiter(max_per_host)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for path in statuses:
+            validators = read_validators(path) or {}
+            futures[executor.submit(limiter.run, validators.get('url'),
+                                    revalidate_file, path,
+                                    timeout=timeout)] = path
+
+        for future in as_completed(futures):
+            path = futures[future]
+
+            try:
+                statuses[path] = future.result()
+            except (requests.exceptions.RequestException,
+                    IOError, OSError, ValueError) as e:
+                _log.error("Couldn't revalidate %s: %s", path, e)
+                statuses[path] = FAILED
+
+    return statuses
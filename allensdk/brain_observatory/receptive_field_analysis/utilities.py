@@ -87,7 +87,7 @@ def convolve(img, sigma=4):
 
 
 
-@memoize
+@memoize(max_entries=4, max_bytes=2**30)
 def get_A(data, stimulus):
 
     stimulus_table = data.get_stimulus_table(stimulus)
@@ -102,7 +102,7 @@ def get_A(data, stimulus):
 
     return A
 
-@memoize
+@memoize(max_entries=4, max_bytes=2**30)
 def get_A_blur(data, stimulus):
 
     stimulus_table = data.get_stimulus_table(stimulus)
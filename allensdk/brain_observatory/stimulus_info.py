@@ -240,7 +240,7 @@ class StimulusSearch(object):
         self.epoch_bst = BinaryIntervalSearchTree.from_df(self.epoch_df)
         self.master_bst = BinaryIntervalSearchTree.from_df(self.master_df)
 
-    @memoize
+    @memoize(max_entries=2**16)
     def search(self, fi):
 
         try:
@@ -0,0 +1,298 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Coarser annotation volumes by majority vote, built block by block.
+'''
+from __future__ import division
+import os
+import logging
+import tempfile
+
+import numpy as np
+
+
+_log = logging.getLogger('allensdk.core.annotation_pyramid')
+
+
+def level_shape(shape, factors):
+    ''' Shape of a volume downsampled by some per-axis factors.
+    '''
+    return tuple(max(1, int(round(n / f))) for n, f in zip(shape, factors))
+
+
+def _target_indices(n_source, factor, n_target, start=0):
+    ''' The coarse index of each of n_source fine indices from start.
+    '''
+    indices = np.floor(np.arange(start, start + n_source) / factor)
+    return np.minimum(indices.astype(np.int64), n_target - 1)
+
+
+def mode_downsample_block(block, factors, target_shape, start=0):
+    ''' Majority vote of the labels of a block of whole planes (along the
+    first axis) of a volume, for each coarse voxel the block covers.
+
+    Parameters
+    ----------
+    block : numpy ndarray
+        planes start, start + 1, ... of the fine volume.
+    factors : tuple of float
+        coarse voxel size over fine voxel size, per axis.
+    target_shape : tuple of int
+        shape of the whole coarse volume.
+    start : int, optional
+        index of the block's first plane.
+
+    Returns
+    -------
+    first : int
+        index of the first coarse plane voted on.
+    votes : numpy ndarray
+        the coarse planes.  Ties go to the smaller label.
+    '''
+    axes = [_target_indices(n, f, t, s) for n, f, t, s
+            in zip(block.shape, factors, target_shape, (start, 0, 0))]
+    first = axes[0][0]
+    axes[0] = axes[0] - first
+    n_planes = axes[0][-1] + 1
+
+    coarse = np.ravel_multi_index(
+        np.ix_(*axes), (n_planes,) + tuple(target_shape[1:]))
+    ids, labels = np.unique(block, return_inverse=True)
+
+    keys = coarse.ravel().astype(np.int64) * len(ids) + labels.ravel()
+    keys, counts = np.unique(keys, return_counts=True)
+    voxels, labels = np.divmod(keys, len(ids))
+
+    # per coarse voxel: highest count, then smallest label
+    order = np.lexsort((labels, -counts, voxels))
+    winners = order[np.r_[True, voxels[order][1:] != voxels[order][:-1]]]
+
+    votes = np.zeros(n_planes * int(np.prod(target_shape[1:])),
+                     dtype=block.dtype)
+    votes[voxels[winners]] = ids[labels[winners]]
+
+    return first, votes.reshape((n_planes,) + tuple(target_shape[1:]))
+
+
+def mode_downsample(volume, factors, outputs=None, block_planes=16):
+    ''' Downsample a label volume to one or more coarser levels by majority
+    vote, in a single pass over blocks of planes of the volume.  Small
+    structures survive wherever they are the most common label of a coarse
+    voxel, where nearest neighbour sampling keeps them only if they happen
+    to hold a sampled voxel.
+
+    Parameters
+    ----------
+    volume : numpy ndarray
+        label volume.  May be a memory map; only block_planes planes (plus
+        a few carried over per level) are read at a time.  The planes are
+        along the first axis, or along the last if the volume is Fortran
+        ordered.
+    factors : list of tuple of float
+        per level, coarse voxel size over fine voxel size per axis.
+    outputs : list of numpy ndarray, optional
+        per level, where to write (e.g. memory maps of level_shape).
+        Default allocates arrays.
+    block_planes : int, optional
+        fine planes read at a time.  Default 16.
+
+    Returns
+    -------
+    list of numpy ndarray
+        the outputs.
+    '''
+    factors = [tuple(float(f) for f in np.broadcast_to(level, (3,)))
+               for level in factors]
+
+    if volume.flags.f_contiguous and not volume.flags.c_contiguous:
+        # planes along the last axis are contiguous: vote over the transpose
+        if outputs is not None:
+            outputs = [output.T for output in outputs]
+        outputs = mode_downsample(volume.T, [level[::-1] for level in factors],
+                                  outputs, block_planes=block_planes)
+        return [output.T for output in outputs]
+
+    shapes = [level_shape(volume.shape, level) for level in factors]
+    if outputs is None:
+        outputs = [np.zeros(shape, dtype=volume.dtype) for shape in shapes]
+
+    # fine planes of incomplete coarse planes, per level
+    pending = [(0, volume[:0]) for _ in factors]
+
+    n_planes = volume.shape[0]
+    for start in range(0, n_planes, block_planes):
+        stop = min(start + block_planes, n_planes)
+        slab = np.asarray(volume[start:stop])
+
+        for ii, (level, shape) in enumerate(zip(factors, shapes)):
+            first, carried = pending[ii]
+            block = np.concatenate([carried, slab]) if len(carried) else slab
+
+            if stop == n_planes:
+                complete = len(block)
+            else:
+                # planes up to the start of the coarse plane of the
+                # next unread fine plane
+                next_target = min(int(np.floor(stop / level[0])), shape[0] - 1)
+                complete = int(np.ceil(next_target * level[0])) - first
+
+            if complete > 0:
+                target, votes = mode_downsample_block(
+                    block[:complete], level, shape, start=first)
+                outputs[ii][target:target + len(votes)] = votes
+
+            pending[ii] = (first + complete, block[complete:])
+
+    return outputs
+
+
+class AnnotationPyramid(object):
+    ''' Coarser copies of an annotation volume, each a raw (.npy) file in
+    one directory, opened as read-only memory maps when first asked for.
+
+    Parameters
+    ----------
+    directory : string
+        where the levels are kept.
+    prefix : string, optional
+        level file names are <prefix>_<resolution>.npy.
+    '''
+
+    def __init__(self, directory, prefix='annotation'):
+        self.directory = directory
+        self.prefix = prefix
+        self._levels = {}
+
+    def path(self, resolution):
+        return os.path.join(self.directory,
+                            '%s_%s.npy' % (self.prefix, resolution))
+
+    def resolutions(self):
+        ''' Resolutions of the levels built so far, finest first.
+        '''
+        if not os.path.isdir(self.directory):
+            return []
+
+        found = []
+        for name in os.listdir(self.directory):
+            base, ext = os.path.splitext(name)
+            if ext == '.npy' and base.startswith(self.prefix + '_'):
+                try:
+                    found.append(int(base[len(self.prefix) + 1:]))
+                except ValueError:
+                    continue
+        return sorted(found)
+
+    def build(self, annotation, resolution, resolutions, block_planes=16):
+        ''' Write levels that do not exist yet, from one pass over a finer
+        annotation.
+
+        Parameters
+        ----------
+        annotation : numpy ndarray
+            the finest annotation (may be a memory map).
+        resolution : numeric
+            its isotropic voxel size in microns.
+        resolutions : list of numeric
+            coarser voxel sizes to build.
+        '''
+        missing = [r for r in resolutions
+                   if r != resolution and not os.path.exists(self.path(r))]
+        for r in missing:
+            if r < resolution:
+                raise ValueError("can not build a %s micron level from a "
+                                 "%s micron annotation" % (r, resolution))
+        if not missing:
+            return
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        factors = [r / resolution for r in missing]
+        partial_paths = [self._partial_path(r) for r in missing]
+        fortran = annotation.flags.f_contiguous and \
+            not annotation.flags.c_contiguous
+        try:
+            outputs = [np.lib.format.open_memmap(
+                           path, mode='w+', dtype=annotation.dtype,
+                           shape=level_shape(annotation.shape, [f] * 3),
+                           fortran_order=fortran)
+                       for path, f in zip(partial_paths, factors)]
+
+            mode_downsample(annotation, factors, outputs,
+                            block_planes=block_planes)
+        except:
+            for partial_path in partial_paths:
+                os.remove(partial_path)
+            raise
+
+        for output, partial_path, r in zip(outputs, partial_paths, missing):
+            output.flush()
+            del output
+            if os.path.exists(self.path(r)):
+                os.remove(self.path(r))
+            os.rename(partial_path, self.path(r))
+            self._levels.pop(r, None)
+
+        _log.info("Built %s micron annotation levels in %s",
+                  ', '.join(str(r) for r in missing), self.directory)
+
+    def _partial_path(self, resolution):
+        ''' A new, uniquely named file to build a level in, so that
+        concurrent builds do not write to the same file.
+        '''
+        handle, path = tempfile.mkstemp(
+            prefix='%s_%s.' % (self.prefix, resolution),
+            suffix='.partial', dir=self.directory)
+        os.close(handle)
+        return path
+
+    def get_level(self, resolution):
+        ''' A level, as a read-only memory map.
+        '''
+        if resolution not in self._levels:
+            path = self.path(resolution)
+            if not os.path.exists(path):
+                raise KeyError("no %s micron level in %s"
+                               % (resolution, self.directory))
+            self._levels[resolution] = np.load(path, mmap_mode='r')
+        return self._levels[resolution]
+
+    def coarsest(self, max_resolution):
+        ''' The resolution of the coarsest level no coarser than
+        max_resolution, or None.
+        '''
+        fitting = [r for r in self.resolutions() if r <= max_resolution]
+        return fitting[-1] if fitting else None
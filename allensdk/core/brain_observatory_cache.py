@@ -34,8 +34,12 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import os
+import functools
+from collections import OrderedDict
 from . import json_utilities as ju
+from . import columnar_utilities as columnar
 from allensdk.api.cache import Cache, get_default_manifest_file
+import allensdk.api.bulk_download as bulk_download
 from allensdk.api.queries.brain_observatory_api import BrainObservatoryApi
 from allensdk.config.manifest_builder import ManifestBuilder
 from .brain_observatory_nwb_data_set import BrainObservatoryNwbDataSet
@@ -93,6 +97,7 @@ class BrainObservatoryCache(Cache):
     ANALYSIS_DATA_KEY = 'ANALYSIS_DATA'
     EVENTS_DATA_KEY = 'EVENTS_DATA'
     STIMULUS_MAPPINGS_KEY = 'STIMULUS_MAPPINGS'
+    PREFETCH_KINDS = ('data', 'analysis', 'events')
     MANIFEST_VERSION='1.2'
 
     def __init__(self, cache=True, manifest_file=None, base_uri=None, api=None):
@@ -399,25 +404,39 @@ class BrainObservatoryCache(Cache):
 
         file_name = self.get_cache_path(file_name, self.CELL_SPECIMENS_KEY)
 
-        cell_specimens = self.api.get_cell_metrics(path=file_name,
-                                                   strategy='lazy',
-                                                   pre= lambda x: [y for y in x],
-                                                   **Cache.cache_json())
-
-        cell_specimens = self.api.filter_cell_specimens(cell_specimens,
-                                                        ids=ids,
-                                                        experiment_container_ids=experiment_container_ids,
-                                                        include_failed=include_failed,
-                                                        filters=filters)
+        # cell metrics are cached as a columnar table next to the manifest
+        # path; from an older json cache, a sibling columnar file is written
+        # on first use and the json file is left as it is.
+        columnar_file_name = None
+        if file_name is not None:
+            columnar_file_name = columnar.columnar_path(file_name)
+            Cache.migrate_to_columnar(file_name, columnar_file_name)
 
         # drop the thumbnail columns
+        thumbnails = None
         if simple:
             mappings = self._get_stimulus_mappings()
             thumbnails = [m['item'] for m in mappings if m[
                 'item_type'] == 'T' and m['level'] == 'R']
-            for cs in cell_specimens:
-                for t in thumbnails:
-                    del cs[t]
+
+        query_filters = list(filters) if filters is not None else []
+        if ids is not None:
+            query_filters.append({'field': 'cell_specimen_id',
+                                  'op': 'in',
+                                  'value': list(ids)})
+        if experiment_container_ids is not None:
+            query_filters.append({'field': 'experiment_container_id',
+                                  'op': 'in',
+                                  'value': list(experiment_container_ids)})
+
+        cell_specimens = self.api.get_cell_metrics(path=columnar_file_name,
+                                                   strategy='lazy',
+                                                   pre= lambda x: [y for y in x],
+                                                   **Cache.cache_columnar_json(filters=query_filters,
+                                                                               drop_columns=thumbnails))
+
+        cell_specimens = self.api.filter_cell_specimens(cell_specimens,
+                                                        include_failed=include_failed)
 
         return cell_specimens
 
@@ -509,6 +528,92 @@ class BrainObservatoryCache(Cache):
 
         return np.load(file_name, allow_pickle=False)["ev"]
 
+    def prefetch(self, experiment_ids,
+                 kinds=None,
+                 max_workers=4,
+                 max_per_host=None,
+                 progress=None):
+        """ Download files for many ophys experiments concurrently, so that
+        later calls to get_ophys_experiment_data, get_ophys_experiment_analysis
+        and get_ophys_experiment_events read from the local cache.
+
+        Parameters
+        ----------
+        experiment_ids: list
+            ids of the ophys experiments to download.  Duplicates are ignored.
+
+        kinds: list of strings
+            Which files to download: any of 'data' (NWB file), 'analysis'
+            (analysis h5 file) and 'events' (events npz file).  Default is all.
+
+        max_workers: int
+            Number of concurrent downloads.  Default 4.
+
+        max_per_host: int
+            Maximum concurrent downloads from the api server.  Default is
+            max_workers.
+
+        progress: function
+            Called with an allensdk.api.bulk_download.DownloadProgress
+            (completed, total, failed, bytes, elapsed, bytes_per_second) after
+            each file finishes.
+
+        Returns
+        -------
+        OrderedDict
+            experiment id -> {kind: status}, where status is 'cached' if the
+            file was already in the manifest location, 'downloaded' or 'failed'.
+        """
+        _assert_not_string(kinds, "kinds")
+
+        if kinds is None:
+            kinds = self.PREFETCH_KINDS
+
+        unknown = set(kinds) - set(self.PREFETCH_KINDS)
+        if unknown:
+            raise ValueError("Unknown prefetch kinds: %s" % sorted(unknown))
+
+        experiment_ids = list(OrderedDict.fromkeys(experiment_ids))
+
+        session_types = {}
+        if 'analysis' in kinds:
+            exps = self.get_ophys_experiments(ids=experiment_ids,
+                                              include_failed=True)
+            session_types = {e['id']: e['session_type'] for e in exps}
+
+        tasks = []
+        for experiment_id in experiment_ids:
+            for kind in kinds:
+                if kind == 'data':
+                    path = self.get_cache_path(
+                        None, self.EXPERIMENT_DATA_KEY, experiment_id)
+                    save = self.api.save_ophys_experiment_data
+                elif kind == 'events':
+                    path = self.get_cache_path(
+                        None, self.EVENTS_DATA_KEY, experiment_id)
+                    save = self.api.save_ophys_experiment_event_data
+                else:
+                    session_type = session_types.get(experiment_id)
+                    if session_type is None:
+                        path = None
+                        save = _missing_session_type(experiment_id)
+                    else:
+                        path = self.get_cache_path(
+                            None, self.ANALYSIS_DATA_KEY,
+                            experiment_id, session_type)
+                        save = self.api.save_ophys_experiment_analysis_data
+
+                tasks.append(bulk_download.DownloadTask(
+                    experiment_id, kind, path,
+                    functools.partial(save, experiment_id, path,
+                                      strategy='lazy'),
+                    self.api.api_url))
+
+        return bulk_download.download_all(tasks,
+                                          max_workers=max_workers,
+                                          max_per_host=max_per_host,
+                                          progress=progress)
+
     def build_manifest(self, file_name):
         """
         Construct a manifest for this Cache class and save it in a file.
@@ -542,6 +647,13 @@ class BrainObservatoryCache(Cache):
         mb.write_json_file(file_name)
 
 
+def _missing_session_type(experiment_id):
+    def fail(*args, **kwargs):
+        raise RuntimeError("ophys experiment %d has no session type" %
+                           experiment_id)
+    return fail
+
+
 def _assert_not_string(arg, name):
     if isinstance(arg, six.string_types):
         raise TypeError(
@@ -581,7 +581,7 @@ class BrainObservatoryNwbDataSet(object):
         raise IOError("Could not find a stimulus table named '%s'" % stimulus_name)
                 
 
-    @memoize
+    @memoize(max_entries=4)
     def get_stimulus_template(self, stimulus_name):
         ''' Return an array of the stimulus template for the specified stimulus.
 
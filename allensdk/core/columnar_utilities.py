@@ -0,0 +1,480 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Read and write tabular data in columnar on-disk formats.
+
+HDF5 tables (via PyTables) are always available.  Parquet and Feather files
+are supported when pyarrow is installed.  All formats support column
+projection and predicate pushdown of simple comparison filters, using the
+same filter dictionaries as BrainObservatoryApi.dataframe_query.
+'''
+import os
+import re
+import logging
+import warnings
+import numbers
+
+import numpy as np
+import pandas as pd
+import simplejson as json
+from six import string_types
+
+from .json_utilities import json_handler
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as pf
+except ImportError:
+    pa = None
+    pq = None
+    pf = None
+
+
+columnar_logger = logging.getLogger(__name__)
+
+HDF5_EXTENSIONS = ('.h5', '.hdf5')
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+FEATHER_EXTENSIONS = ('.feather',)
+
+DEFAULT_EXTENSION = '.h5'
+DEFAULT_KEY = 'data'
+
+_KINDS_ATTRIBUTE = 'allensdk_column_kinds'
+_NUMERIC_KINDS = ('numeric', 'bool', 'int_null')
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_ARROW_OPS = {'=': '==', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+
+
+def storage_format(file_name):
+    ''' Determine the columnar storage format from a file extension.
+
+    Parameters
+    ----------
+    file_name : string
+        path to a columnar file
+
+    Returns
+    -------
+    string
+        one of 'hdf5', 'parquet' or 'feather'
+    '''
+    extension = os.path.splitext(file_name)[1].lower()
+
+    if extension in HDF5_EXTENSIONS:
+        return 'hdf5'
+    elif extension in PARQUET_EXTENSIONS or extension in FEATHER_EXTENSIONS:
+        if pa is None:
+            raise ImportError('pyarrow is required to read and write %s' %
+                              file_name)
+        return 'parquet' if extension in PARQUET_EXTENSIONS else 'feather'
+
+    raise ValueError('Unknown columnar file extension: %s' % file_name)
+
+
+def columnar_path(file_name, extension=DEFAULT_EXTENSION):
+    ''' Path of the columnar sibling of a json or csv cache file.
+    '''
+    return os.path.splitext(file_name)[0] + extension
+
+
+def write(file_name, data, key=DEFAULT_KEY):
+    ''' Write a table to a columnar file.
+
+    Parameters
+    ----------
+    file_name : string
+        where to write; the extension selects the format.
+    data : DataFrame or iterable of dicts
+        records to store
+    key : string, optional
+        HDF5 node name.  Ignored for arrow formats.
+    '''
+    if not isinstance(data, pd.DataFrame):
+        data = pd.DataFrame.from_records(list(data))
+
+    fmt = storage_format(file_name)
+    encoded, kinds = encode(data)
+
+    temp_file_name = file_name + '.partial'
+
+    if fmt == 'hdf5':
+        data_columns = [c for c in encoded.columns
+                        if kinds[c] in _NUMERIC_KINDS]
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with pd.HDFStore(temp_file_name, mode='w',
+                             complevel=5, complib='blosc') as store:
+                store.put(key, encoded, format='table',
+                          data_columns=data_columns)
+                setattr(store.get_storer(key).attrs, _KINDS_ATTRIBUTE, kinds)
+    else:
+        table = pa.Table.from_pandas(encoded, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[_KINDS_ATTRIBUTE.encode('utf-8')] = \
+            json.dumps(kinds).encode('utf-8')
+        table = table.replace_schema_metadata(metadata)
+
+        if fmt == 'parquet':
+            pq.write_table(table, temp_file_name)
+        else:
+            pf.write_feather(table, temp_file_name)
+
+    # readers only ever see a complete file
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    os.rename(temp_file_name, file_name)
+
+
+def read(file_name,
+         columns=None,
+         filters=None,
+         drop_columns=None,
+         key=DEFAULT_KEY):
+    ''' Read a table from a columnar file.
+
+    Parameters
+    ----------
+    file_name : string
+        path to a file written by write()
+    columns : list of strings, optional
+        only read these columns.  Default is all columns.
+    filters : list of dicts, optional
+        { 'field': <field>, 'op': <operation>, 'value': <filter_value(s)> }
+        dictionaries as used by BrainObservatoryApi.dataframe_query.  Simple
+        comparisons on numeric columns are evaluated by the storage layer;
+        the rest are applied after reading.
+    drop_columns : list of strings, optional
+        columns to leave out of the result.  Filters may still refer to them.
+    key : string, optional
+        HDF5 node name.  Ignored for arrow formats.
+
+    Returns
+    -------
+    DataFrame
+    '''
+    fmt = storage_format(file_name)
+    filters = list(filters) if filters is not None else []
+
+    all_columns, kinds = read_schema(file_name, key=key)
+
+    if columns is None:
+        columns = list(all_columns)
+    else:
+        columns = [c for c in columns]
+
+    if drop_columns is not None:
+        drop_columns = set(drop_columns)
+        columns = [c for c in columns if c not in drop_columns]
+
+    filter_fields = [f['field'] for f in filters]
+    load_columns = columns + [c for c in filter_fields
+                              if c not in columns and c in kinds]
+    load_columns = list(pd.unique(load_columns))
+
+    pushed = [f for f in filters if _can_push_down(f, kinds)]
+
+    if fmt == 'hdf5':
+        terms = []
+        for f in pushed:
+            terms.extend(_hdf5_terms(f, kinds))
+
+        data = pd.read_hdf(file_name, key,
+                           columns=load_columns,
+                           where=terms if terms else None)
+        data.reset_index(drop=True, inplace=True)
+    else:
+        arrow_filters = []
+        for f in pushed:
+            arrow_filters.extend(_arrow_terms(f, kinds))
+
+        if fmt == 'parquet':
+            table = pq.read_table(file_name,
+                                  columns=load_columns,
+                                  filters=arrow_filters if arrow_filters
+                                  else None)
+        else:
+            table = pf.read_table(file_name, columns=load_columns)
+            pushed = []
+
+        data = table.to_pandas()
+
+    data = decode(data, kinds)
+
+    remaining = [f for f in filters if f not in pushed]
+    if remaining:
+        data = data[filter_mask(data, remaining)].reset_index(drop=True)
+
+    return data[columns]
+
+
+def read_records(file_name, **kwargs):
+    ''' Read a table from a columnar file as a list of dicts.
+
+    Missing values are returned as None, matching records read back from a
+    json cache file.  Keyword arguments are passed to read().
+    '''
+    return to_records(read(file_name, **kwargs))
+
+
+def read_schema(file_name, key=DEFAULT_KEY):
+    ''' Read the column names and stored column kinds without loading data.
+
+    Returns
+    -------
+    columns : list of strings
+    kinds : dict
+        column name -> encoding kind
+    '''
+    fmt = storage_format(file_name)
+
+    if fmt == 'hdf5':
+        with pd.HDFStore(file_name, mode='r') as store:
+            storer = store.get_storer(key)
+            kinds = getattr(storer.attrs, _KINDS_ATTRIBUTE, None)
+            columns = list(storer.non_index_axes[0][1])
+    else:
+        if fmt == 'parquet':
+            schema = pq.read_schema(file_name)
+        else:
+            schema = pf.read_table(file_name, columns=[]).schema
+        kinds = (schema.metadata or {}).get(_KINDS_ATTRIBUTE.encode('utf-8'))
+        if kinds is not None:
+            kinds = json.loads(kinds.decode('utf-8'))
+        columns = [c for c in schema.names if c in kinds] \
+            if kinds is not None else list(schema.names)
+
+    if kinds is None:
+        kinds = {c: 'numeric' for c in columns}
+
+    return columns, kinds
+
+
+def encode(data):
+    ''' Convert a DataFrame into one that every columnar format can store.
+
+    Columns of python objects with missing values cannot be stored directly
+    in an HDF5 table, so they are converted to a storable dtype and tagged
+    with a kind that decode() uses to restore them.
+
+    Returns
+    -------
+    encoded : DataFrame
+    kinds : dict
+        column name -> encoding kind
+    '''
+    encoded = pd.DataFrame(index=pd.RangeIndex(len(data)))
+    kinds = {}
+
+    for column in data.columns:
+        values = data[column].values
+        name = str(column)
+
+        if values.dtype.kind in 'biuf':
+            if (values.dtype.kind == 'f' and
+                    np.isnan(values).any() and
+                    _all_integral(values[~np.isnan(values)])):
+                kinds[name] = 'int_null'
+            else:
+                kinds[name] = 'numeric'
+            encoded[name] = values
+            continue
+
+        if values.dtype.kind == 'M':
+            kinds[name] = 'datetime'
+            encoded[name] = values
+            continue
+
+        notnull = pd.notnull(values)
+        present = values[notnull]
+
+        if len(present) == 0:
+            kinds[name] = 'null'
+            encoded[name] = np.full(len(values), np.nan)
+        elif all(isinstance(v, (bool, np.bool_)) for v in present):
+            kinds[name] = 'bool'
+            column_values = np.full(len(values), np.nan)
+            column_values[notnull] = present.astype(float)
+            encoded[name] = column_values
+        elif all(isinstance(v, string_types) for v in present):
+            kinds[name] = 'string'
+            encoded[name] = values.astype(object)
+        else:
+            kinds[name] = 'json'
+            column_values = np.empty(len(values), dtype=object)
+            column_values[:] = None
+            column_values[notnull] = [json.dumps(v, default=json_handler)
+                                      for v in present]
+            encoded[name] = column_values
+
+    return encoded, kinds
+
+
+def decode(data, kinds):
+    ''' Undo the conversions made by encode() on the columns present in data.
+    '''
+    for column in data.columns:
+        kind = kinds.get(column, 'numeric')
+
+        if kind in ('numeric', 'datetime'):
+            continue
+
+        values = data[column].values
+        notnull = pd.notnull(values)
+        decoded = np.empty(len(values), dtype=object)
+        decoded[:] = None
+
+        if kind == 'bool':
+            decoded[notnull] = values[notnull].astype(bool)
+        elif kind == 'int_null':
+            decoded[notnull] = values[notnull].astype(np.int64)
+        elif kind == 'string':
+            decoded[notnull] = values[notnull]
+        elif kind == 'json':
+            for ii in np.flatnonzero(notnull):
+                decoded[ii] = json.loads(values[ii])
+
+        data[column] = decoded
+
+    return data
+
+
+def to_records(data):
+    ''' Convert a DataFrame to a list of dicts with None for missing values.
+    '''
+    data = data.astype(object)
+    data = data.where(pd.notnull(data), None)
+
+    return data.to_dict('records')
+
+
+def filter_mask(data, filters):
+    ''' Evaluate filter dictionaries against a DataFrame.
+
+    Parameters
+    ----------
+    data : DataFrame
+    filters : list of dicts
+        see BrainObservatoryApi.dataframe_query
+
+    Returns
+    -------
+    numpy.ndarray
+        boolean mask of matching rows
+    '''
+    mask = np.ones(len(data), dtype=bool)
+
+    for f in filters:
+        field = data[f['field']]
+        op = f['op']
+        value = f['value']
+
+        if op == 'between':
+            match = (field >= value[0]) & (field <= value[1])
+        elif op in ('in', '=', 'is') and isinstance(value, (list, tuple)):
+            match = field.isin(value)
+        elif op in ('=', 'is', 'in'):
+            match = field == value
+        elif op == '<':
+            match = field < value
+        elif op == '>':
+            match = field > value
+        elif op == '<=':
+            match = field <= value
+        elif op == '>=':
+            match = field >= value
+        else:
+            raise ValueError('Unknown filter operation: %s' % op)
+
+        mask &= np.asarray(match, dtype=bool)
+
+    return mask
+
+
+def _all_integral(values):
+    return bool(np.all(np.mod(values, 1) == 0))
+
+
+def _is_number(value):
+    return (isinstance(value, (numbers.Number, np.bool_)) and
+            not isinstance(value, complex))
+
+
+def _can_push_down(f, kinds):
+    field = f['field']
+    value = f['value']
+
+    if kinds.get(field) not in _NUMERIC_KINDS:
+        return False
+    if not isinstance(field, string_types) or not _IDENTIFIER.match(field):
+        return False
+
+    if f['op'] == 'between':
+        return (isinstance(value, (list, tuple)) and
+                len(value) == 2 and all(_is_number(v) for v in value))
+    elif isinstance(value, (list, tuple)):
+        return (f['op'] in ('in', '=', 'is') and len(value) > 0 and
+                all(_is_number(v) for v in value))
+
+    return _is_number(value) and (f['op'] in _ARROW_OPS or
+                                  f['op'] in ('in', 'is'))
+
+
+def _hdf5_terms(f, kinds):
+    field = f['field']
+    value = f['value']
+
+    if f['op'] == 'between':
+        return ['%s >= %r' % (field, float(value[0])),
+                '%s <= %r' % (field, float(value[1]))]
+    elif isinstance(value, (list, tuple)):
+        return ['%s == %r' % (field, [float(v) for v in value])]
+
+    op = _ARROW_OPS.get(f['op'], '==')
+    return ['%s %s %r' % (field, op, float(value))]
+
+
+def _arrow_terms(f, kinds):
+    field = f['field']
+    value = f['value']
+
+    if f['op'] == 'between':
+        return [(field, '>=', float(value[0])),
+                (field, '<=', float(value[1]))]
+    elif isinstance(value, (list, tuple)):
+        return [(field, 'in', [float(v) for v in value])]
+
+    return [(field, _ARROW_OPS.get(f['op'], '=='), float(value))]
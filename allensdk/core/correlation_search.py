@@ -0,0 +1,242 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Experiment correlation search over local projection density volumes.
+'''
+from __future__ import division
+import logging
+
+import numpy as np
+
+
+_log = logging.getLogger('allensdk.core.correlation_search')
+
+
+class CorrelationSearch(object):
+    ''' Ranks experiments by the Pearson correlation of their projection
+    density within a domain, like the mouse_connectivity_correlation
+    service, but over local data.
+
+    Each experiment's domain voxels are centered and scaled to unit length
+    once, into an experiments x voxels float32 matrix, so that correlations
+    are plain dot products.  Queries for many seeds are answered as blocked
+    matrix products.
+
+    Parameters
+    ----------
+    vectors : numpy ndarray
+        experiments x domain voxels array.  Normalized in place if it is a
+        writeable float32 array.
+    experiment_ids : list of int
+        experiment of each row of vectors.
+    metadata : dict, optional
+        maps experiment ids to dicts of fields added to their result
+        records.
+    normalized : bool, optional
+        vectors are already centered and scaled (e.g. loaded from a file
+        written by save).  Default False.
+    '''
+
+    # seeds (and candidate experiments) per matrix product
+    BLOCK_SIZE = 256
+
+    def __init__(self, vectors, experiment_ids, metadata=None,
+                 normalized=False):
+        self.experiment_ids = np.array(experiment_ids, dtype=np.int64)
+        if len(self.experiment_ids) != len(vectors):
+            raise ValueError("%d experiment ids for %d vectors" %
+                             (len(self.experiment_ids), len(vectors)))
+
+        self.vectors = vectors if normalized else self.normalize(vectors)
+        self.metadata = metadata or {}
+        self._rows = dict((eid, row) for row, eid
+                          in enumerate(self.experiment_ids.tolist()))
+
+    @classmethod
+    def normalize(cls, vectors):
+        ''' Center each row and scale it to unit length, so that the dot
+        product of two rows is their Pearson correlation.  Constant rows
+        become zero.
+        '''
+        vectors = np.asarray(vectors)
+        if vectors.dtype != np.float32 or not vectors.flags.writeable:
+            vectors = vectors.astype(np.float32)
+
+        for start in range(0, len(vectors), cls.BLOCK_SIZE):
+            block = vectors[start:start + cls.BLOCK_SIZE]
+            block -= block.mean(axis=1, dtype=np.float64)[:, np.newaxis] \
+                .astype(np.float32)
+            norms = np.sqrt(np.einsum('ij,ij->i', block, block,
+                                      dtype=np.float64))
+            norms[norms == 0] = np.inf
+            block /= norms[:, np.newaxis].astype(np.float32)
+
+        return vectors
+
+    @classmethod
+    def from_volume_stack(cls, stack, domain_mask, experiment_ids=None,
+                          metadata=None):
+        ''' Search the experiments of a VolumeStack within a domain.
+
+        Parameters
+        ----------
+        stack : VolumeStack
+            projection density volumes.
+        domain_mask : numpy ndarray
+            volume of the stack's shape.  Correlations are computed over its
+            nonzero voxels.
+        experiment_ids : list of int, optional
+            defaults to every experiment of the stack.
+        metadata : dict, optional
+            as in the constructor.
+        '''
+        if experiment_ids is None:
+            experiment_ids = stack.experiment_ids
+
+        return cls(stack.get_masked(domain_mask, experiment_ids),
+                   experiment_ids, metadata=metadata)
+
+    def save(self, path):
+        ''' Write the normalized vectors and their experiment ids (.npz).
+        '''
+        with open(path, 'wb') as f:
+            np.savez(f, vectors=self.vectors,
+                     experiment_ids=self.experiment_ids)
+
+    @classmethod
+    def load(cls, path, metadata=None):
+        ''' Read a search written by save.
+        '''
+        with np.load(path) as data:
+            return cls(data['vectors'], data['experiment_ids'],
+                       metadata=metadata, normalized=True)
+
+    def correlations(self, seed_ids, experiment_ids=None):
+        ''' Correlations of seed experiments with candidate experiments.
+
+        Parameters
+        ----------
+        seed_ids : list of int
+        experiment_ids : list of int, optional
+            candidates.  Defaults to all experiments.
+
+        Returns
+        -------
+        numpy ndarray
+            seeds x candidates float32 array.
+        '''
+        seed_rows = self._lookup(seed_ids)
+        if experiment_ids is None:
+            candidates = self.vectors
+        else:
+            candidates = self.vectors[self._lookup(experiment_ids)]
+
+        out = np.empty((len(seed_rows), len(candidates)), dtype=np.float32)
+        for start in range(0, len(seed_rows), self.BLOCK_SIZE):
+            seeds = self.vectors[seed_rows[start:start + self.BLOCK_SIZE]]
+            for cstart in range(0, len(candidates), self.BLOCK_SIZE):
+                out[start:start + len(seeds),
+                    cstart:cstart + self.BLOCK_SIZE] = \
+                    seeds.dot(candidates[cstart:cstart + self.BLOCK_SIZE].T)
+
+        np.clip(out, -1, 1, out=out)
+        return out
+
+    def search(self, seed_ids, experiment_ids=None, num_rows=2000,
+               start_row=0):
+        ''' Experiments ranked by correlation with one or more seeds.
+
+        Parameters
+        ----------
+        seed_ids : int or list of int
+            seed experiment(s).
+        experiment_ids : list of int, optional
+            candidates.  Defaults to all experiments (including the seed).
+        num_rows : int or 'all', optional
+            page size.  Default 2000.
+        start_row : int, optional
+            page start.  Default 0.
+
+        Returns
+        -------
+        list of dict, or dict of lists of dict
+            records with 'id' and 'r' and the experiment's metadata, in
+            descending order of r.  For a list of seeds, the records of
+            each seed, keyed by seed id.
+        '''
+        single = np.isscalar(seed_ids)
+        seeds = [seed_ids] if single else list(seed_ids)
+
+        if experiment_ids is None:
+            candidate_ids = self.experiment_ids
+        else:
+            candidate_ids = np.array(experiment_ids, dtype=np.int64)
+
+        stop = len(candidate_ids) if num_rows == 'all' else \
+            min(start_row + num_rows, len(candidate_ids))
+
+        results = {}
+        for start in range(0, len(seeds), self.BLOCK_SIZE):
+            block = seeds[start:start + self.BLOCK_SIZE]
+            r = self.correlations(block, experiment_ids)
+
+            if stop <= start_row:
+                top = np.zeros((len(block), 0), dtype=np.int64)
+            elif stop < r.shape[1]:
+                top = np.argpartition(-r, stop - 1, axis=1)[:, :stop]
+            else:
+                top = np.tile(np.arange(r.shape[1]), (len(block), 1))
+
+            for seed, seed_r, seed_top in zip(block, r, top):
+                # stable, so ties keep the candidates' order
+                order = seed_top[np.argsort(-seed_r[seed_top],
+                                            kind='mergesort')]
+                results[seed] = [self._record(candidate_ids[ii], seed_r[ii])
+                                 for ii in order[start_row:stop]]
+
+        return results[seeds[0]] if single else results
+
+    def _record(self, experiment_id, r):
+        record = dict(self.metadata.get(experiment_id, {}))
+        record['id'] = int(experiment_id)
+        record['r'] = float(r)
+        return record
+
+    def _lookup(self, experiment_ids):
+        try:
+            return np.array([self._rows[eid] for eid in experiment_ids],
+                            dtype=np.int64)
+        except KeyError as e:
+            raise KeyError("experiment %s is not searched" % e.args[0])
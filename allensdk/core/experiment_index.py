@@ -0,0 +1,332 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Local spatial and injection coordinate search over experiments.
+'''
+from __future__ import division
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse
+from scipy.spatial import cKDTree
+
+
+_log = logging.getLogger('allensdk.core.experiment_index')
+
+
+def injection_centroid(injection_density, injection_fraction, resolution=25):
+    ''' The injection density weighted centroid of an injection site, in
+    microns.  Agrees with MouseConnectivityApi.calculate_injection_centroid,
+    from one weighted volume and its three marginal sums.
+
+    Returns
+    -------
+    numpy ndarray or None
+        None if the experiment has no injection density.
+    '''
+    weights = np.multiply(injection_density, injection_fraction,
+                          dtype=np.float64)
+    total = weights.sum()
+    if total <= 0:
+        return None
+
+    centroid = np.empty(weights.ndim)
+    for axis in range(weights.ndim):
+        others = tuple(a for a in range(weights.ndim) if a != axis)
+        marginal = weights.sum(axis=others)
+        centroid[axis] = np.dot(marginal, np.arange(len(marginal))) / total
+
+    return centroid * resolution
+
+
+class ExperimentIndex(object):
+    ''' Answers the questions of the spatial and injection coordinate
+    search services from local data:
+
+    * which experiments' injections are nearest a point (a KD-tree over
+      injection centroids), and
+    * which experiments project to a point (an inverted index from voxels
+      to the experiments whose projection density there is at least a
+      threshold, stored as a sparse experiments x voxels matrix in
+      compressed column form).
+
+    Parameters
+    ----------
+    experiment_ids : list of int
+    centroids : numpy ndarray
+        experiments x 3 injection centroids in microns.  Rows of NaN for
+        experiments without an injection site.
+    projections : scipy.sparse matrix
+        experiments x voxels thresholded projection densities.
+    shape : tuple of int
+        shape of the projection density volumes.
+    resolution : numeric
+        voxel size in microns.
+    metadata : dict, optional
+        maps experiment ids to dicts of fields (e.g. transgenic_line,
+        injection_structures) used by the filters and added to result
+        records.
+    structure_tree : StructureTree, optional
+        if given, injection structure filters also match descendants.
+    '''
+
+    DEFAULT_THRESHOLD = 0.1
+
+    def __init__(self, experiment_ids, centroids, projections, shape,
+                 resolution, metadata=None, structure_tree=None):
+        self.experiment_ids = np.array(experiment_ids, dtype=np.int64)
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+        self.projections = scipy.sparse.csc_matrix(projections)
+        self.shape = tuple(shape)
+        self.resolution = resolution
+        self.metadata = metadata or {}
+        self.structure_tree = structure_tree
+
+        self._has_centroid = np.flatnonzero(
+            np.isfinite(self.centroids).all(axis=1))
+        self._tree = cKDTree(self.centroids[self._has_centroid]) \
+            if len(self._has_centroid) else None
+
+    @classmethod
+    def build(cls, experiment_ids, read_injection, read_projection,
+              resolution, threshold=DEFAULT_THRESHOLD, metadata=None,
+              structure_tree=None, max_workers=4):
+        ''' Index some experiments, several at a time.
+
+        Parameters
+        ----------
+        experiment_ids : list of int
+        read_injection : callable
+            maps an experiment id to its (injection density, injection
+            fraction) volumes.
+        read_projection : callable
+            maps an experiment id to its projection density volume.
+        resolution : numeric
+            voxel size in microns.
+        threshold : float, optional
+            least projection density indexed.  Default 0.1, like the
+            spatial search service.
+        metadata, structure_tree :
+            as in the constructor.
+        max_workers : int, optional
+            experiments read and indexed concurrently.  Default 4.
+        '''
+        experiment_ids = list(experiment_ids)
+
+        def index(experiment_id):
+            density, fraction = read_injection(experiment_id)
+            centroid = injection_centroid(density, fraction, resolution)
+
+            projection = np.asarray(read_projection(experiment_id))
+            voxels = np.flatnonzero(projection >= threshold)
+            row = scipy.sparse.csr_matrix(
+                (projection.ravel()[voxels].astype(np.float32),
+                 voxels, [0, len(voxels)]),
+                shape=(1, projection.size))
+            return centroid, row, projection.shape
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(index, experiment_ids))
+
+        if results:
+            shape = results[0][2]
+            for eid, (_, _, other) in zip(experiment_ids, results):
+                if other != shape:
+                    raise ValueError("projection density of experiment %d "
+                                     "has shape %s, not %s" %
+                                     (eid, other, shape))
+            projections = scipy.sparse.vstack([row for _, row, _ in results])
+        else:
+            shape = (0, 0, 0)
+            projections = scipy.sparse.csr_matrix((0, 0), dtype=np.float32)
+
+        centroids = np.array([np.full(3, np.nan) if c is None else c
+                              for c, _, _ in results]).reshape(-1, 3)
+
+        _log.info("Indexed %d experiments", len(experiment_ids))
+        return cls(experiment_ids, centroids, projections, shape, resolution,
+                   metadata=metadata, structure_tree=structure_tree)
+
+    def save(self, path):
+        ''' Write the index (.npz).  Metadata is not saved.
+        '''
+        with open(path, 'wb') as f:
+            np.savez(f, experiment_ids=self.experiment_ids,
+                     centroids=self.centroids,
+                     data=self.projections.data,
+                     indices=self.projections.indices,
+                     indptr=self.projections.indptr,
+                     projections_shape=self.projections.shape,
+                     shape=self.shape, resolution=self.resolution)
+
+    @classmethod
+    def load(cls, path, metadata=None, structure_tree=None):
+        ''' Read an index written by save.
+        '''
+        with np.load(path) as data:
+            projections = scipy.sparse.csc_matrix(
+                (data['data'], data['indices'], data['indptr']),
+                shape=tuple(data['projections_shape']))
+            return cls(data['experiment_ids'], data['centroids'],
+                       projections, tuple(data['shape']),
+                       data['resolution'].item(), metadata=metadata,
+                       structure_tree=structure_tree)
+
+    def nearest_injections(self, seed_point, num_rows=2000,
+                           transgenic_lines=None, injection_structures=None):
+        ''' Experiments ranked by the distance of their injection centroid
+        to a point, like experiment_injection_coordinate_search.
+
+        Parameters
+        ----------
+        seed_point : list of float
+            coordinates in microns.
+        num_rows : int or 'all', optional
+            most experiments returned.  Default 2000.
+        transgenic_lines : list of str or int, optional
+            keep experiments of these lines.  0 selects experiments without
+            a transgenic line.
+        injection_structures : list of int, optional
+            keep experiments injected in these structures.
+
+        Returns
+        -------
+        list of dict
+            records with 'id', 'distance', 'injection-coordinates' and the
+            experiment's metadata, nearest first.
+        '''
+        if self._tree is None:
+            return []
+
+        keep = self._filter(transgenic_lines, injection_structures)
+        total = len(self._has_centroid)
+        wanted = total if num_rows == 'all' else min(num_rows, total)
+
+        # widen the query until enough experiments pass the filters
+        k = wanted
+        while True:
+            distances, positions = self._tree.query(seed_point, k=max(k, 1))
+            distances = np.atleast_1d(distances)
+            positions = np.atleast_1d(positions)
+            rows = self._has_centroid[positions[positions < total]]
+            distances = distances[positions < total]
+            passing = keep[rows]
+            if passing.sum() >= wanted or k >= total:
+                break
+            k = min(2 * k, total)
+
+        records = []
+        for row, distance in zip(rows[passing][:wanted],
+                                 distances[passing][:wanted]):
+            record = self._record(row)
+            record['distance'] = float(distance)
+            record['injection-coordinates'] = self.centroids[row].tolist()
+            records.append(record)
+
+        return records
+
+    def projecting_experiments(self, seed_point, transgenic_lines=None,
+                               injection_structures=None):
+        ''' Experiments whose projection density at a point is at least the
+        index's threshold, like experiment_spatial_search (without the
+        projection paths).
+
+        Parameters
+        ----------
+        seed_point : list of float
+            coordinates in microns.
+        transgenic_lines, injection_structures :
+            as in nearest_injections.
+
+        Returns
+        -------
+        list of dict
+            records with 'id', 'density' and the experiment's metadata,
+            densest first.
+        '''
+        voxel = np.round(np.asarray(seed_point, dtype=np.float64) /
+                         self.resolution).astype(np.int64)
+        if len(voxel) != len(self.shape) or (voxel < 0).any() or \
+                (voxel >= self.shape).any():
+            return []
+
+        column = np.ravel_multi_index(tuple(voxel), self.shape)
+        start, stop = self.projections.indptr[column:column + 2]
+        rows = self.projections.indices[start:stop]
+        densities = self.projections.data[start:stop]
+
+        keep = self._filter(transgenic_lines, injection_structures)[rows]
+        rows, densities = rows[keep], densities[keep]
+
+        records = []
+        for ii in np.argsort(-densities, kind='mergesort'):
+            record = self._record(rows[ii])
+            record['density'] = float(densities[ii])
+            records.append(record)
+
+        return records
+
+    def _filter(self, transgenic_lines, injection_structures):
+        ''' Which experiments pass the filters, by row.
+        '''
+        keep = np.ones(len(self.experiment_ids), dtype=bool)
+
+        if transgenic_lines is not None:
+            lines = set(transgenic_lines)
+            for row, eid in enumerate(self.experiment_ids.tolist()):
+                line = self.metadata.get(eid, {}).get('transgenic_line')
+                keep[row] = line in lines or (not line and 0 in lines)
+
+        if injection_structures is not None:
+            structures = set(injection_structures)
+            if self.structure_tree is not None:
+                for desc in self.structure_tree.descendant_ids(
+                        list(structures)):
+                    structures.update(desc)
+
+            for row, eid in enumerate(self.experiment_ids.tolist()):
+                injected = self.metadata.get(eid, {}).get(
+                    'injection_structures', [])
+                keep[row] &= bool(structures.intersection(injected))
+
+        return keep
+
+    def _record(self, row):
+        eid = int(self.experiment_ids[row])
+        record = dict((key.replace('_', '-'), value) for key, value
+                      in self.metadata.get(eid, {}).items() if key != 'id')
+        record['id'] = eid
+        return record
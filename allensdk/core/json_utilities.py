@@ -38,6 +38,7 @@ import simplejson as json
 import math
 import re
 import logging
+import time
 
 ju_logger = logging.getLogger(__name__)
 
@@ -51,6 +52,21 @@ except ImportError:
     import urlparse
 
 
+# functions called with (nbytes, parse_time) after a url is read; the api
+# package adds one to record transfer metrics
+_url_read_hooks = []
+
+
+def add_url_read_hook(hook):
+    if hook not in _url_read_hooks:
+        _url_read_hooks.append(hook)
+
+
+def _url_read(nbytes, parse_time):
+    for hook in _url_read_hooks:
+        hook(nbytes, parse_time)
+
+
 def read(file_name):
     """ Shortcut reading JSON from a file. """
     with open(file_name, 'rb') as f:
@@ -107,9 +123,13 @@ def read_url_get(url):
     the output will be of the corresponding type.
     '''
     response = urllib_request.urlopen(url)
-    json_string = response.read().decode('utf-8')
+    body = response.read()
 
-    return json.loads(json_string)
+    start = time.time()
+    data = json.loads(body.decode('utf-8'))
+    _url_read(len(body), time.time() - start)
+
+    return data
 
 
 def read_url_post(url):
@@ -151,7 +171,11 @@ def read_url_post(url):
     else:
         json_string = response.read()
 
-    return json.loads(json_string)
+    start = time.time()
+    data = json.loads(json_string)
+    _url_read(len(json_string), time.time() - start)
+
+    return data
 
 
 def json_handler(obj):
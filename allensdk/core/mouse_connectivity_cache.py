@@ -40,15 +40,25 @@ from allensdk.deprecated import deprecated
 
 from . import json_utilities
 from .reference_space_cache import ReferenceSpaceCache
+from .structure_unionize_store import StructureUnionizeStore
+from .volume_stack import VolumeStack
+from .structure_unionizer import StructureUnionizer
+from .correlation_search import CorrelationSearch
+from .experiment_index import ExperimentIndex
 
 import nrrd
 import os
+import hashlib
 import pandas as pd
 import numpy as np
+import scipy.sparse
 from allensdk.config.manifest import Manifest
+import allensdk.api.cache_manager as cache_manager
+from collections import OrderedDict
 import warnings
 import operator as op
 import functools
+import six
 from six.moves import reduce
 
 
@@ -93,6 +103,12 @@ class MouseConnectivityCache(ReferenceSpaceCache):
     manifest_file: string
         File name of the manifest to be read.  Default is "mouse_connectivity_manifest.json".
 
+    unionize_store: boolean
+        Keep the structure unionizes of downloaded experiments in one indexed table
+        (see get_unionize_store) instead of one csv file per experiment.  The table
+        may only be written by one process at a time, so leave this off for workers
+        sharing a manifest.  Default False.
+
     """
 
     PROJECTION_DENSITY_KEY = 'PROJECTION_DENSITY'
@@ -100,9 +116,13 @@ class MouseConnectivityCache(ReferenceSpaceCache):
     INJECTION_FRACTION_KEY = 'INJECTION_FRACTION'
     DATA_MASK_KEY = 'DATA_MASK'
     STRUCTURE_UNIONIZES_KEY = 'STRUCTURE_UNIONIZES'
+    STRUCTURE_UNIONIZE_STORE_KEY = 'STRUCTURE_UNIONIZE_STORE'
+    VOLUME_STACK_DIRECTORY = 'volume_stacks'
+    VOLUME_STACK_KINDS = ('projection_density', 'injection_density',
+                          'injection_fraction', 'data_mask')
     EXPERIMENTS_KEY = 'EXPERIMENTS'
 
-    MANIFEST_VERSION = 1.3
+    MANIFEST_VERSION = 1.4
 
     SUMMARY_STRUCTURE_SET_ID = 167587189
     DEFAULT_STRUCTURE_SET_IDS = tuple([SUMMARY_STRUCTURE_SET_ID])
@@ -123,7 +143,8 @@ class MouseConnectivityCache(ReferenceSpaceCache):
                  manifest_file=None,
                  ccf_version=None,
                  base_uri=None,
-                 version=None):
+                 version=None,
+                 unionize_store=False):
 
         if manifest_file is None:
             manifest_file = get_default_manifest_file('mouse_connectivity')
@@ -142,6 +163,7 @@ class MouseConnectivityCache(ReferenceSpaceCache):
             manifest=manifest_file, version=version)
 
         self.api = MouseConnectivityApi(base_uri=base_uri)
+        self.unionize_store = unionize_store
 
 
     def get_projection_density(self, experiment_id, file_name=None):
@@ -262,6 +284,253 @@ class MouseConnectivityCache(ReferenceSpaceCache):
 
         return nrrd.read(file_name)
 
+    def build_volume_stack(self, experiment_ids, kind='projection_density',
+                           file_name=None, compression=None, max_workers=4,
+                           overwrite=False):
+        """
+        Pack the volumes of many experiments into one on-disk
+        experiments x voxels array (see VolumeStack), downloading any
+        volumes that are not cached yet.  An interrupted build picks up
+        where it stopped.
+
+        Parameters
+        ----------
+
+        experiment_ids: list
+            List of experiment IDs, in the order of the stack's rows.
+
+        kind: string
+            One of 'projection_density', 'injection_density',
+            'injection_fraction' or 'data_mask'.  Default 'projection_density'.
+
+        file_name: string
+            File name of the stack.  If None, it is kept in a volume_stacks
+            directory next to the manifest, named by kind, resolution and
+            a digest of the experiment ids, so stacks of different
+            experiments do not replace each other.
+
+        compression: string
+            h5py compression filter ('gzip', 'lzf').  Uncompressed stacks are
+            memory mapped when read.  Default None.
+
+        max_workers: int
+            Number of volumes downloaded and read concurrently.  Default 4.
+
+        overwrite: boolean
+            Replace a stack of other experiments at file_name.  If False,
+            a ValueError is raised instead.  Default False.
+
+        Returns
+        -------
+        VolumeStack
+        """
+
+        if kind not in self.VOLUME_STACK_KINDS:
+            raise ValueError("unknown volume kind %s, expected one of %s" %
+                             (kind, ', '.join(self.VOLUME_STACK_KINDS)))
+
+        read = getattr(self, 'get_' + kind)
+
+        path = self.get_volume_stack_path(kind, file_name, experiment_ids)
+
+        return VolumeStack.build(path,
+                                 experiment_ids,
+                                 lambda eid: read(eid)[0],
+                                 compression=compression,
+                                 max_workers=max_workers,
+                                 attrs={'kind': kind,
+                                        'resolution': self.resolution},
+                                 overwrite=overwrite)
+
+    def get_volume_stack(self, kind='projection_density', file_name=None,
+                         experiment_ids=None):
+        """
+        Open a stack written by build_volume_stack.
+
+        Parameters
+        ----------
+
+        kind: string
+            Kind of volume stacked.  Default 'projection_density'.
+
+        file_name: string
+            File name of the stack.  If None, the default of
+            build_volume_stack is used, which needs experiment_ids.
+
+        experiment_ids: list
+            Experiments stacked, in the order they were passed to
+            build_volume_stack.
+
+        Returns
+        -------
+        VolumeStack
+        """
+
+        return VolumeStack(self.get_volume_stack_path(kind, file_name,
+                                                      experiment_ids))
+
+    def get_correlation_search(self, experiment_ids=None, structure_ids=None,
+                               hemisphere=None, file_name=None):
+        """
+        Build a local replacement for MouseConnectivityApi's
+        experiment_correlation_search.  Projection density volumes are
+        stacked (see build_volume_stack) and the voxels of the domain are
+        normalized once; searches then run in memory.
+
+        Parameters
+        ----------
+
+        experiment_ids: list
+            Experiments to search.  Default is all experiments.  A subset is
+            read from the stack of all experiments if that has been built;
+            otherwise it is stacked in a file of its own.
+
+        structure_ids: list
+            Domain of the correlations.  Default is the whole brain.
+
+        hemisphere: string
+            'left' or 'right' to restrict the domain to one hemisphere.
+            Default is both.
+
+        file_name: string
+            If given, the normalized vectors are saved to (or, if it
+            exists, read from) this .npz file.  Delete it after changing
+            the experiments or domain.
+
+        Returns
+        -------
+        CorrelationSearch
+            search(seed_ids) returns records like the service's, with 'id'
+            and 'r' and the experiment's metadata (dashed keys).
+        """
+
+        experiments = self.get_experiments()
+        all_ids = [e['id'] for e in experiments]
+        if experiment_ids is None:
+            experiment_ids = all_ids
+
+        metadata = dict((e['id'], self._correlation_metadata(e))
+                        for e in experiments)
+
+        if file_name is not None and os.path.exists(file_name):
+            return CorrelationSearch.load(file_name, metadata=metadata)
+
+        if structure_ids is None:
+            structure_ids = [997]
+        mask = self.get_reference_space().make_structure_mask(structure_ids)
+
+        midline = mask.shape[-1] // 2
+        if hemisphere == 'left':
+            mask[..., midline:] = 0
+        elif hemisphere == 'right':
+            mask[..., :midline] = 0
+        elif hemisphere is not None:
+            raise ValueError("hemisphere must be 'left', 'right' or None")
+
+        # a subset is read from the stack of every experiment, if there is
+        # one, rather than stacked again
+        full_path = self.get_volume_stack_path('projection_density',
+                                               experiment_ids=all_ids)
+        if set(experiment_ids) < set(all_ids) and os.path.exists(full_path):
+            stack = VolumeStack(full_path)
+        else:
+            stack = self.build_volume_stack(experiment_ids)
+
+        with stack:
+            search = CorrelationSearch.from_volume_stack(
+                stack, mask, experiment_ids, metadata=metadata)
+
+        if file_name is not None:
+            Manifest.safe_make_parent_dirs(file_name)
+            search.save(file_name)
+
+        return search
+
+    def get_experiment_index(self, experiment_ids=None,
+                             threshold=ExperimentIndex.DEFAULT_THRESHOLD,
+                             file_name=None, max_workers=4):
+        """
+        Build a local replacement for MouseConnectivityApi's
+        experiment_injection_coordinate_search (nearest_injections) and
+        experiment_spatial_search (projecting_experiments).  Injection
+        centroids and thresholded projection densities of every experiment
+        are computed once, downloading volumes as needed.
+
+        Parameters
+        ----------
+
+        experiment_ids: list
+            Experiments to index.  Default is all experiments.
+
+        threshold: float
+            Least projection density at which an experiment counts as
+            projecting to a voxel.  Default 0.1.
+
+        file_name: string
+            If given, the index is saved to (or, if it exists, read from)
+            this .npz file.  Delete it after changing the experiments or
+            threshold.
+
+        max_workers: int
+            Number of experiments read concurrently.  Default 4.
+
+        Returns
+        -------
+        ExperimentIndex
+        """
+
+        experiments = self.get_experiments()
+        if experiment_ids is None:
+            experiment_ids = [e['id'] for e in experiments]
+
+        metadata = dict((e['id'], e) for e in experiments)
+        structure_tree = self.get_structure_tree()
+
+        if file_name is not None and os.path.exists(file_name):
+            return ExperimentIndex.load(file_name, metadata=metadata,
+                                        structure_tree=structure_tree)
+
+        index = ExperimentIndex.build(
+            experiment_ids,
+            lambda eid: (self.get_injection_density(eid)[0],
+                         self.get_injection_fraction(eid)[0]),
+            lambda eid: self.get_projection_density(eid)[0],
+            self.resolution, threshold=threshold, metadata=metadata,
+            structure_tree=structure_tree, max_workers=max_workers)
+
+        if file_name is not None:
+            Manifest.safe_make_parent_dirs(file_name)
+            index.save(file_name)
+
+        return index
+
+    @staticmethod
+    def _correlation_metadata(experiment):
+        record = dict((key.replace('_', '-'), value)
+                      for key, value in experiment.items() if key != 'id')
+
+        if all(('injection_' + axis) in experiment for axis in 'xyz'):
+            record['injection-coordinates'] = [experiment['injection_' + axis]
+                                               for axis in 'xyz']
+
+        return record
+
+    def get_volume_stack_path(self, kind, file_name=None, experiment_ids=None):
+        if file_name is not None:
+            return file_name
+
+        if getattr(self, 'manifest_path', None) is None:
+            raise ValueError("a file_name is needed without a manifest")
+        if experiment_ids is None:
+            raise ValueError("experiment_ids are needed to name a volume stack")
+
+        digest = hashlib.sha1(np.asarray(experiment_ids, dtype='<i8').tobytes())
+
+        return os.path.join(os.path.dirname(os.path.abspath(self.manifest_path)),
+                            self.VOLUME_STACK_DIRECTORY,
+                            '%s_%s_%s.h5' % (kind, self.resolution,
+                                             digest.hexdigest()[:12]))
+
 
     def get_experiments(self, dataframe=False, file_name=None, cre=None, injection_structure_ids=None):
         """
@@ -411,6 +680,11 @@ class MouseConnectivityCache(ReferenceSpaceCache):
                                       include_descendants=include_descendants,
                                       hemisphere_ids=hemisphere_ids)
 
+        store = self.get_unionize_store()
+        if store is not None and not os.path.exists(file_name) and \
+                experiment_id in store.experiment_ids():
+            return filter_fn(store.query(experiment_ids=[experiment_id]))
+
         col_rn = lambda x: pd.DataFrame(x).rename(columns={
             'section_data_set_id': 'experiment_id'})
 
@@ -422,6 +696,66 @@ class MouseConnectivityCache(ReferenceSpaceCache):
                                                 writer=lambda p, x : pd.DataFrame(x).to_csv(p),
                                                 reader=lambda x: pd.read_csv(x, index_col=0, parse_dates=True))
 
+    def download_structure_unionizes(self, experiment_ids, max_workers=4):
+        """
+        Download and cache the structure unionizes of every experiment that is not 
+        cached yet.  Instead of one query per experiment, many experiments are fetched 
+        per query (see MouseConnectivityApi.get_structure_unionizes) and the results are 
+        split into the usual per-experiment files in one pass.
+
+        Parameters
+        ----------
+
+        experiment_ids: list
+            List of experiment IDs.  Corresponds to section_data_set_id in the API.
+
+        max_workers: int
+            Number of concurrent queries.  Default 4.
+
+        Returns
+        -------
+        list
+            IDs of the experiments that were downloaded.
+        """
+
+        store = self.get_unionize_store()
+        stored = store.experiment_ids() if store is not None else set()
+
+        missing = OrderedDict()
+        for eid in experiment_ids:
+            path = self.get_cache_path(None, self.STRUCTURE_UNIONIZES_KEY, eid)
+            if path is not None and not os.path.exists(path) and eid not in stored:
+                missing[eid] = path
+
+        # a single experiment is left to the lazy path
+        if len(missing) < 2:
+            return []
+
+        unionizes = pd.DataFrame(
+            self.api.get_structure_unionizes(list(missing), max_workers=max_workers))
+        unionizes = unionizes.rename(columns={'section_data_set_id': 'experiment_id'})
+
+        if store is not None:
+            store.append(unionizes, list(missing))
+            return list(missing)
+
+        groups = {}
+        if len(unionizes) > 0:
+            groups = dict(iter(unionizes.groupby('experiment_id', sort=False)))
+
+        for eid, path in missing.items():
+            Manifest.safe_make_parent_dirs(path)
+
+            # same format as get_experiment_structure_unionizes writes
+            group = groups.get(eid)
+            if group is None:
+                group = pd.DataFrame([])
+            group.reset_index(drop=True).to_csv(path)
+
+            cache_manager.record_create(path)
+
+        return list(missing)
+
     def rank_structures(self, experiment_ids, is_injection, structure_ids=None, hemisphere_ids=None,
                         rank_on='normalized_projection_volume', n=5, threshold=10**-2):
         '''Produces one or more (per experiment) ranked lists of brain structures, using a specified data field.
@@ -467,22 +801,19 @@ class MouseConnectivityCache(ReferenceSpaceCache):
                                                  is_injection=is_injection,
                                                  structure_ids=structure_ids,
                                                  hemisphere_ids=hemisphere_ids,
-                                                 include_descendants=False)
+                                                 include_descendants=False,
+                                                 columns=[rank_on])
         unionizes = unionizes[unionizes[rank_on] > threshold]
+        unionizes = unionizes[[c for c in unionizes.columns if filter_fields(c)]]
 
-        results = []
-        for eid in experiment_ids:
-
-            this_experiment_unionizes = unionizes[unionizes['experiment_id'] == eid]
-            this_experiment_unionizes = this_experiment_unionizes.sort_values(by=rank_on, ascending=False)
-            this_experiment_unionizes = this_experiment_unionizes.select(filter_fields, axis=1)
+        # the top n of every experiment at once
+        top = unionizes.sort_values(by=rank_on, ascending=False, kind='mergesort')
+        top = top.groupby('experiment_id', sort=False).head(n)
 
-            records = this_experiment_unionizes.to_dict('record')
-            if len(records) > n:
-                records = records[:n]
-            results.append(records)
+        by_experiment = {eid: group.to_dict('records')
+                         for eid, group in top.groupby('experiment_id', sort=False)}
 
-        return results
+        return [by_experiment.get(eid, []) for eid in experiment_ids]
 
     def filter_structure_unionizes(self, unionizes,
                                    is_injection=None,
@@ -519,13 +850,12 @@ class MouseConnectivityCache(ReferenceSpaceCache):
             structure_ids = MouseConnectivityCache.validate_structure_ids(structure_ids)
 
             if include_descendants:
-                structure_ids = reduce(op.add, self.get_structure_tree().descendant_ids(structure_ids))
+                keep = self.get_structure_tree().descends_from_any(
+                    unionizes['structure_id'].values, structure_ids)
             else:
-                structure_ids = set(structure_ids)
+                keep = unionizes['structure_id'].isin(set(structure_ids))
 
-
-            unionizes = unionizes[
-                unionizes['structure_id'].isin(structure_ids)]
+            unionizes = unionizes[keep]
 
         if hemisphere_ids is not None:
             unionizes = unionizes[
@@ -537,10 +867,17 @@ class MouseConnectivityCache(ReferenceSpaceCache):
                                 is_injection=None,
                                 structure_ids=None,
                                 include_descendants=False,
-                                hemisphere_ids=None):
+                                hemisphere_ids=None,
+                                max_workers=4,
+                                columns=None):
         """
         Get structure unionizes for a set of experiment IDs.  Filter the results by injection status,
-        structure, and hemisphere.
+        structure, and hemisphere.  Experiments that are not cached yet are downloaded 
+        together, in batched concurrent queries.
+
+        If this cache was made with unionize_store=True, the unionizes of all cached 
+        experiments are consolidated in one indexed table (see get_unionize_store), 
+        so only the requested rows and columns are read.
 
         Parameters
         ----------
@@ -563,22 +900,222 @@ class MouseConnectivityCache(ReferenceSpaceCache):
             Only return unionize records that disregard pixels outside of a hemisphere.
             or set of hemispheres. Left = 1, Right = 2, Both = 3.  If None, include all
             records [1, 2, 3].  Default None.
+
+        max_workers: int
+            Number of concurrent queries for experiments that are not cached.  Default 4.
+
+        columns: list
+            Only return these columns (and experiment_id, structure_id, hemisphere_id and 
+            is_injection).  If None, return all columns.  Default None.
+        """
+
+        self.download_structure_unionizes(experiment_ids, max_workers=max_workers)
+
+        store = self.get_unionize_store()
+
+        if store is None:
+            unionizes = [self.get_experiment_structure_unionizes(eid,
+                                                                 is_injection=is_injection,
+                                                                 structure_ids=structure_ids,
+                                                                 include_descendants=include_descendants,
+                                                                 hemisphere_ids=hemisphere_ids)
+                         for eid in experiment_ids]
+
+            unionizes = pd.concat(unionizes, ignore_index=True, sort=True)
+            if columns is not None:
+                keep = StructureUnionizeStore.INDEX_COLUMNS + list(columns)
+                unionizes = unionizes[[c for c in unionizes.columns if c in keep]]
+
+            return unionizes
+
+        # experiments cached as csv files before the store existed
+        stored = store.experiment_ids()
+        unstored = [eid for eid in pd.unique(list(experiment_ids)) if eid not in stored]
+        if unstored:
+            store.append(pd.concat([self.get_experiment_structure_unionizes(eid).assign(experiment_id=eid)
+                                    for eid in unstored],
+                                   ignore_index=True, sort=True),
+                         unstored)
+
+        if structure_ids is not None:
+            structure_ids = MouseConnectivityCache.validate_structure_ids(structure_ids)
+
+            if include_descendants:
+                structure_ids = reduce(op.add, self.get_structure_tree().descendant_ids(structure_ids))
+
+        unionizes = store.query(experiment_ids=experiment_ids,
+                                structure_ids=structure_ids,
+                                hemisphere_ids=hemisphere_ids,
+                                is_injection=is_injection,
+                                columns=columns)
+
+        # in the order of experiment_ids, like the per-experiment files
+        order = pd.Series(np.arange(len(experiment_ids)), index=list(experiment_ids))
+        order = order[~order.index.duplicated()]
+        unionizes = unionizes.iloc[np.argsort(order.loc[unionizes['experiment_id']].values,
+                                              kind='mergesort')]
+
+        return unionizes[sorted(unionizes.columns)].reset_index(drop=True)
+
+    def compute_structure_unionizes(self, experiment_ids, structure_ids=None,
+                                    structure_tree=None, hemisphere_ids=None,
+                                    is_injection=None, processes=None):
         """
+        Compute structure unionizes locally from the cached grid data volumes
+        and annotation, rather than querying them.  Unlike the queried
+        unionizes, these can cover any structures of any ontology over the
+        annotation.  Missing volumes are downloaded.
+
+        Parameters
+        ----------
+
+        experiment_ids: list
+            List of experiment IDs.
 
-        unionizes = [self.get_experiment_structure_unionizes(eid,
-                                                             is_injection=is_injection,
-                                                             structure_ids=structure_ids,
-                                                             include_descendants=include_descendants,
-                                                             hemisphere_ids=hemisphere_ids)
-                     for eid in experiment_ids]
+        structure_ids: list
+            Structures to summarize (with their descendants).  Default is
+            every structure of the structure tree.
+
+        structure_tree: StructureTree
+            Ontology of structure_ids.  Default is this cache's structure
+            tree.
+
+        hemisphere_ids: list
+            Only keep unionizes in these hemispheres.  1 is left, 2 is right,
+            3 is both.  Default keeps all.
 
-        return pd.concat(unionizes, ignore_index=True, sort=True)
+        is_injection: boolean
+            If given, only keep injection site (True) or non-injection site
+            (False) unionizes.
+
+        processes: int
+            Number of worker processes.  Default is the number of CPUs.
+
+        Returns
+        -------
+        DataFrame
+            One row per experiment, structure, hemisphere and is_injection,
+            with volume, projection_volume, projection_density and
+            normalized_projection_volume columns.
+        """
+
+        if structure_tree is None:
+            structure_tree = self.get_structure_tree()
+
+        unionizer = StructureUnionizer(structure_tree,
+                                       self.get_annotation_volume()[0],
+                                       self.resolution,
+                                       structure_ids=structure_ids)
+
+        paths = OrderedDict()
+        for eid in experiment_ids:
+            paths[eid] = self.download_volumes(eid)
+
+        unionizes = unionizer.unionize_files(paths, processes=processes)
+
+        if hemisphere_ids is not None:
+            unionizes = unionizes[unionizes['hemisphere_id'].isin(hemisphere_ids)]
+        if is_injection is not None:
+            unionizes = unionizes[unionizes['is_injection'] == is_injection]
+
+        return unionizes.reset_index(drop=True)
+
+    def download_volumes(self, experiment_id):
+        """
+        Download (if needed) the projection density, injection density,
+        injection fraction and data mask volumes of an experiment without
+        reading them.
+
+        Returns
+        -------
+        dict
+            Volume file paths, keyed by 'projection_density',
+            'injection_density', 'injection_fraction' and 'data_mask'.
+        """
+
+        keys = [('projection_density', self.PROJECTION_DENSITY_KEY),
+                ('injection_density', self.INJECTION_DENSITY_KEY),
+                ('injection_fraction', self.INJECTION_FRACTION_KEY),
+                ('data_mask', self.DATA_MASK_KEY)]
+
+        paths = {}
+        for kind, key in keys:
+            paths[kind] = self.get_cache_path(None, key, experiment_id,
+                                              self.resolution)
+            getattr(self.api, 'download_' + kind)(
+                paths[kind], experiment_id, self.resolution, strategy='lazy')
+
+        return paths
+
+    def get_unionize_store(self):
+        """
+        The consolidated structure unionize table.  Experiments downloaded in batches 
+        are added to it instead of being written to per-experiment csv files, and 
+        experiments already cached as csv files are added the first time they are 
+        queried.  Only one process at a time may write to it.
+
+        Returns
+        -------
+        StructureUnionizeStore or None
+            None unless this cache was made with unionize_store=True and caching is 
+            enabled.
+        """
+
+        if not self.unionize_store:
+            return None
+
+        path = self.get_cache_path(None, self.STRUCTURE_UNIONIZE_STORE_KEY)
+        if path is None:
+            return None
+
+        return StructureUnionizeStore(path)
 
     def get_projection_matrix(self, experiment_ids,
                               projection_structure_ids=None,
                               hemisphere_ids=None,
                               parameter='projection_volume',
-                              dataframe=False):
+                              dataframe=False,
+                              dtype=np.float64,
+                              sparse=False):
+        """
+        Tabulate one unionize value for each experiment, structure and hemisphere.
+
+        Parameters
+        ----------
+        experiment_ids: list
+            Rows of the matrix.
+
+        projection_structure_ids: list
+            Structures of the columns.  Defaults to the summary structures.
+
+        hemisphere_ids: list
+            Hemispheres of the columns (Left = 1, Right = 2, Both = 3).  Defaults to 
+            those for which there are unionizes.
+
+        parameter: string
+            The unionize value to tabulate (a list holding one name is also accepted).
+            Default 'projection_volume'.
+
+        dtype: numpy dtype
+            Type of the matrix, e.g. np.float32 to halve the memory of a large matrix.  
+            Default np.float64.
+
+        sparse: boolean
+            If True, return a scipy.sparse.csr_matrix in which entries without a 
+            unionize are absent (rather than NaN).  Default False.
+
+        Returns
+        -------
+        dict
+            'matrix': experiments x (hemisphere, structure) array, 'rows': experiment_ids, 
+            'columns': list of dicts with hemisphere_id, structure_id and label.
+        """
+
+        if not isinstance(parameter, six.string_types):
+            parameter = list(parameter)
+            if len(parameter) != 1:
+                raise ValueError("Only one unionize value can be tabulated (got %s)" % parameter)
+            parameter = parameter[0]
 
         if projection_structure_ids is None:
             projection_structure_ids = self.default_structure_ids
@@ -587,24 +1124,15 @@ class MouseConnectivityCache(ReferenceSpaceCache):
                                                  is_injection=False,
                                                  structure_ids=projection_structure_ids,
                                                  include_descendants=False,
-                                                 hemisphere_ids=hemisphere_ids)
+                                                 hemisphere_ids=hemisphere_ids,
+                                                 columns=[parameter])
 
-        hemisphere_ids = set(unionizes['hemisphere_id'].values.tolist())
+        hemisphere_ids = sorted(set(unionizes['hemisphere_id'].values.tolist()))
 
         nrows = len(experiment_ids)
         ncolumns = len(projection_structure_ids) * len(hemisphere_ids)
 
-        matrix = np.empty((nrows, ncolumns))
-        matrix[:] = np.NAN
-
-        row_lookup = {}
-        for idx, e in enumerate(experiment_ids):
-            row_lookup[e] = idx
-
-        column_lookup = {}
         columns = []
-
-        cidx = 0
         hlabel = {1: '-L', 2: '-R', 3: ''}
 
         acronym_map = self.get_structure_tree().value_map(lambda x: x['id'],
@@ -612,17 +1140,40 @@ class MouseConnectivityCache(ReferenceSpaceCache):
 
         for hid in hemisphere_ids:
             for sid in projection_structure_ids:
-                column_lookup[(hid, sid)] = cidx
                 label = acronym_map[sid] + hlabel[hid]
                 columns.append(
                     {'hemisphere_id': hid, 'structure_id': sid, 'label': label})
-                cidx += 1
 
-        for _, row in unionizes.iterrows():
-            ridx = row_lookup[row['experiment_id']]
-            k = (row['hemisphere_id'], row['structure_id'])
-            cidx = column_lookup[k]
-            matrix[ridx, cidx] = row[parameter]
+        # matrix coordinates of every unionize; a repeated experiment id 
+        # maps to its last row.
+        row_lookup = pd.Series(np.arange(nrows), index=list(experiment_ids))
+        row_lookup = row_lookup[~row_lookup.index.duplicated(keep='last')]
+        structure_lookup = pd.Series(np.arange(len(projection_structure_ids)),
+                                     index=list(projection_structure_ids))
+        structure_lookup = structure_lookup[~structure_lookup.index.duplicated(keep='last')]
+
+        ridx = row_lookup.reindex(unionizes['experiment_id'].values).values
+        sidx = structure_lookup.reindex(unionizes['structure_id'].values).values
+        hidx = np.searchsorted(hemisphere_ids, unionizes['hemisphere_id'].values)
+
+        values = np.asarray(unionizes[parameter].values)
+
+        found = ~(np.isnan(ridx) | np.isnan(sidx))
+        ridx = ridx[found].astype(int)
+        cidx = (hidx[found] * len(projection_structure_ids) + sidx[found]).astype(int)
+        values = values[found].astype(dtype)
+
+        # of repeated entries, the last is kept (csr_matrix would sum them)
+        _, last = np.unique((ridx * ncolumns + cidx)[::-1], return_index=True)
+        keep = len(ridx) - 1 - last
+        ridx, cidx, values = ridx[keep], cidx[keep], values[keep]
+
+        if sparse:
+            matrix = scipy.sparse.csr_matrix((values, (ridx, cidx)),
+                                             shape=(nrows, ncolumns), dtype=dtype)
+        else:
+            matrix = np.full((nrows, ncolumns), np.nan, dtype=dtype)
+            matrix[ridx, cidx] = values
 
         if dataframe:
             warnings.warn("dataframe argument is deprecated.")
@@ -661,6 +1212,11 @@ class MouseConnectivityCache(ReferenceSpaceCache):
                                   parent_key='BASEDIR',
                                   typename='file')
 
+        manifest_builder.add_path(self.STRUCTURE_UNIONIZE_STORE_KEY,
+                                  'structure_unionizes.h5',
+                                  parent_key='BASEDIR',
+                                  typename='file')
+
         manifest_builder.add_path(self.INJECTION_DENSITY_KEY,
                                   'experiment_%d/injection_density_%d.nrrd',
                                   parent_key='BASEDIR',
@@ -39,6 +39,8 @@ import operator as op
 import functools
 import os
 import csv
+import gzip
+from concurrent.futures import ThreadPoolExecutor
 
 from scipy.misc import imresize
 from scipy.ndimage.interpolation import zoom
@@ -47,10 +49,20 @@ import nrrd
 import pandas as pd
 
 from allensdk.core.structure_tree import StructureTree
+from allensdk.core.annotation_pyramid import mode_downsample
+from allensdk.core.slice_renderer import SliceRenderer
 
 
 class ReferenceSpace(object):
 
+    # numpy dtype kind and size -> nrrd type
+    NRRD_TYPES = {'i1': 'int8', 'u1': 'uint8', 'i2': 'int16', 'u2': 'uint16', 
+                  'i4': 'int32', 'u4': 'uint32', 'i8': 'int64', 'u8': 'uint64', 
+                  'f4': 'float', 'f8': 'double'}
+
+    # voxels of the annotation relabelled at a time
+    RELABEL_BLOCK_SIZE = 2 ** 24
+
     @property
     def direct_voxel_map(self):
         if not hasattr(self, '_direct_voxel_map'):
@@ -70,6 +82,33 @@ class ReferenceSpace(object):
     @total_voxel_map.setter
     def total_voxel_map(self, data):
         self._total_voxel_map = data
+
+    @property
+    def annotation(self):
+        return self._annotation
+
+    @annotation.setter
+    def annotation(self, data):
+        self._annotation = data
+        for name in ('_annotation_ids', '_annotation_labels'):
+            if hasattr(self, name):
+                delattr(self, name)
+
+    @property
+    def annotation_ids(self):
+        '''Sorted unique structure ids (including 0) of the annotation.
+        '''
+        if not hasattr(self, '_annotation_ids'):
+            self.relabel_annotation()
+        return self._annotation_ids
+
+    @property
+    def annotation_labels(self):
+        '''The annotation relabelled to positions in annotation_ids.
+        '''
+        if not hasattr(self, '_annotation_labels'):
+            self.relabel_annotation()
+        return self._annotation_labels
         
     def __init__(self, structure_tree, annotation, resolution):
         '''Handles brain structures in a 3d reference space
@@ -88,8 +127,82 @@ class ReferenceSpace(object):
         self.structure_tree = structure_tree
         self.resolution = resolution
         
-        self.annotation = np.ascontiguousarray(annotation)
+        # C or Fortran ordered volumes (e.g. memory maps of nrrd files) are
+        # used as they are
+        annotation = np.asarray(annotation)
+        if not (annotation.flags.c_contiguous or 
+                annotation.flags.f_contiguous):
+            annotation = np.ascontiguousarray(annotation)
+        self.annotation = annotation
+        
+    def relabel_annotation(self):
+        '''Relabels the annotation to consecutive integers (indices into 
+        annotation_ids), in the smallest unsigned integer type that fits. Done
+        once; structure masks are then lookup table gathers over the labels.
+        The annotation is read a block of planes at a time, so no 
+        annotation-sized temporaries are made.
+        
+        '''
+
+        blocks = list(self._annotation_blocks())
+
+        ids = np.array([], dtype=self.annotation.dtype)
+        for block in blocks:
+            ids = np.union1d(ids, np.unique(self.annotation[block]))
+
+        labels = np.empty(self.annotation.shape, 
+                          dtype=np.min_scalar_type(len(ids)))
+        for block in blocks:
+            labels[block] = np.searchsorted(ids, self.annotation[block])
+
+        self._annotation_ids = ids
+        self._annotation_labels = labels
+
+    def _annotation_blocks(self):
+        '''Slices of about RELABEL_BLOCK_SIZE voxels along the slowest varying 
+        axis of the annotation in memory: the first if it is C ordered, the 
+        last if it is Fortran ordered.
+        
+        '''
+
+        shape = self.annotation.shape
+        fortran = self.annotation.flags.f_contiguous and \
+            not self.annotation.flags.c_contiguous
+        axis = len(shape) - 1 if fortran else 0
+
+        plane = max(int(np.prod(shape)) // max(shape[axis], 1), 1)
+        step = max(self.RELABEL_BLOCK_SIZE // plane, 1)
+
+        for start in range(0, shape[axis], step):
+            block = [slice(None)] * len(shape)
+            block[axis] = slice(start, start + step)
+            yield tuple(block)
+
+    def structure_lookup_table(self, structure_ids, direct_only=False):
+        '''An indicator over annotation_ids for one or more structures
+        
+        Parameters
+        ----------
+        structure_ids : list of int
+            Indicate these structures' labels
+        direct_only : bool, optional
+            If True, only indicate labels directly assigned to these 
+            structures. Otherwise indicate labels of descendants too.
+            
+        Returns
+        -------
+        numpy ndarray :
+            uint8, aligned with annotation_ids. 1 for indicated labels.
         
+        '''
+
+        if not direct_only:
+            structure_ids = self.structure_tree.descendant_ids(structure_ids)
+            structure_ids = functools.reduce(op.add, structure_ids, [])
+
+        return np.isin(self.annotation_ids, 
+                       list(structure_ids)).astype(np.uint8)
+
     def direct_voxel_counts(self):
         '''Determines the number of voxels directly assigned to one or more 
         structures.
@@ -102,11 +215,9 @@ class ReferenceSpace(object):
         
         '''
 
-        uniques = np.unique(self.annotation, return_counts=True)
-        found = {k: v for k, v in zip(*uniques) if k != 0}
-
-        self._direct_voxel_map = {k: (found[k] if k in found else 0) for k 
-                                  in self.structure_tree.node_ids()}
+        counts = self.direct_voxel_count_array()
+        self._direct_voxel_map = dict(zip(self.structure_tree.node_ids(), 
+                                          counts.tolist()))
           
     def total_voxel_counts(self):
         '''Determines the number of voxels assigned to a structure or its 
@@ -120,12 +231,75 @@ class ReferenceSpace(object):
         
         ''' 
 
-        self._total_voxel_map = {}
-        for stid in self.structure_tree.node_ids():
+        counts = self.total_voxel_count_array()
+        self._total_voxel_map = dict(zip(self.structure_tree.node_ids(), 
+                                         counts.tolist()))
+
+    def direct_voxel_count_array(self):
+        '''Number of voxels directly assigned to each structure.
+        
+        Returns
+        -------
+        numpy ndarray :
+            Aligned with structure_tree.node_ids().
+        
+        '''
+
+        return self.structure_sums(direct_only=True)
+
+    def total_voxel_count_array(self):
+        '''Number of voxels assigned to each structure or its descendants.
+        
+        Returns
+        -------
+        numpy ndarray :
+            Aligned with structure_tree.node_ids().
+        
+        '''
+
+        return self.structure_sums()
 
-            desc_ids = self.structure_tree.descendant_ids([stid])[0]
-            self._total_voxel_map[stid] = sum([self.direct_voxel_map[dscid] 
-                                               for dscid in desc_ids])
+    def structure_sums(self, values=None, direct_only=False):
+        '''Sums a per-voxel quantity (such as projection energy) over each 
+        structure, with a single bincount over the relabelled annotation.
+        
+        Parameters
+        ----------
+        values : numpy ndarray, optional
+            Same shape as annotation. Defaults to counting voxels.
+        direct_only : bool, optional
+            If True, only sum voxels directly assigned to each structure. 
+            Otherwise include voxels assigned to descendants.
+            
+        Returns
+        -------
+        numpy ndarray :
+            Aligned with structure_tree.node_ids(). Integer counts if values 
+            is None, floats otherwise.
+        
+        '''
+
+        labels = self.annotation_labels.ravel()
+        if values is None:
+            label_sums = np.bincount(labels, minlength=len(self.annotation_ids))
+        else:
+            values = np.asarray(values)
+            if values.shape != self.annotation.shape:
+                raise ValueError('values shape {0} does not match annotation '
+                                 'shape {1}'.format(values.shape, 
+                                                    self.annotation.shape))
+            label_sums = np.bincount(labels, weights=values.ravel(), 
+                                     minlength=len(self.annotation_ids))
+
+        node_ids = np.array(self.structure_tree.node_ids())
+        positions = np.searchsorted(self.annotation_ids, node_ids)
+        positions = np.minimum(positions, len(self.annotation_ids) - 1)
+        found = self.annotation_ids[positions] == node_ids
+
+        sums = np.where(found, label_sums[positions], 0)
+        if direct_only:
+            return sums
+        return self.structure_tree.sum_over_descendants(sums)
     
     def remove_unassigned(self, update_self=True):
         '''Obtains a structure tree consisting only of structures that have 
@@ -169,24 +343,11 @@ class ReferenceSpace(object):
         
         '''
     
-        if direct_only:
-            mask = np.zeros(self.annotation.shape, dtype=np.uint8, order='C')
-            for stid in structure_ids:
-                
-                if self.direct_voxel_map[stid] == 0:
-                    continue
-                    
-                mask[self.annotation == stid] = True
-                
-            return mask
-            
-        else:
-            structure_ids = self.structure_tree.descendant_ids(structure_ids)
-            structure_ids = set(functools.reduce(op.add, structure_ids))
-            return self.make_structure_mask(structure_ids, direct_only=True)
+        lut = self.structure_lookup_table(structure_ids, direct_only)
+        return lut[self.annotation_labels]
                         
     def many_structure_masks(self, structure_ids, output_cb=None, 
-                             direct_only=False):
+                             direct_only=False, max_workers=None):
         '''Build one or more structure masks and do something with them
         
         Parameters
@@ -200,6 +361,9 @@ class ReferenceSpace(object):
         direct_only : bool, optional
             If True, only include voxels directly assigned to a structure in 
             the mask. Otherwise include voxels assigned to descendants.
+        max_workers : int, optional
+            If given, call output_cb on this many structures at a time, in 
+            threads. Results are still yielded in order.
             
         Yields
         -------
@@ -217,10 +381,22 @@ class ReferenceSpace(object):
         
         if output_cb is None:
             output_cb = ReferenceSpace.return_mask_cb
-                                              
-        for stid in structure_ids:
-            yield output_cb(stid, functools.partial(self.make_structure_mask, 
-                                                    [stid], direct_only))
+
+        def call(stid):
+            return output_cb(stid, functools.partial(self.make_structure_mask, 
+                                                     [stid], direct_only))
+
+        if max_workers is None:
+            for stid in structure_ids:
+                yield call(stid)
+            return
+
+        # relabel once, before the threads need it
+        self.annotation_labels
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(call, structure_ids):
+                yield result
 
 
     def check_coverage(self, structure_ids, domain_mask):
@@ -272,7 +448,7 @@ class ReferenceSpace(object):
                 self.check_coverage(structure_ids, domain_mask)]
         
         
-    def downsample(self, target_resolution):
+    def downsample(self, target_resolution, interpolator='nearest'):
         '''Obtain a smaller reference space by downsampling
         
         Parameters
@@ -280,8 +456,10 @@ class ReferenceSpace(object):
         target_resolution : tuple of numeric
             Resolution in microns of the output space.
         interpolator : string
-            Method used to interpolate the volume. Currently only 'nearest' 
-            is supported
+            Method used to interpolate the volume. 'nearest' (default) 
+            samples the nearest voxel. 'mode' takes the most common label 
+            of the voxels covered by each output voxel, so that small 
+            structures are not dropped.
             
         Returns
         -------
@@ -291,10 +469,19 @@ class ReferenceSpace(object):
         
         '''
         
-        factors = [ float(ii / jj) for ii, jj in zip(self.resolution, 
-                                                     target_resolution)]
+        if interpolator == 'mode':
+            factors = [float(jj / ii) for ii, jj in zip(self.resolution, 
+                                                        target_resolution)]
+            target = mode_downsample(self.annotation, [factors])[0]
+
+        elif interpolator == 'nearest':
+            factors = [ float(ii / jj) for ii, jj in zip(self.resolution, 
+                                                         target_resolution)]
                                                      
-        target = zoom(self.annotation, factors, order=0)
+            target = zoom(self.annotation, factors, order=0)
+
+        else:
+            raise ValueError('unknown interpolator: {0}'.format(interpolator))
         
         return ReferenceSpace(self.structure_tree, target, target_resolution)
         
@@ -330,13 +517,38 @@ class ReferenceSpace(object):
             cmap[0] = [0, 0, 0]
         
         position = int(np.around(position / self.resolution[axis]))
-        image = np.squeeze(self.annotation.take([position], axis=axis))
+        plane = np.squeeze(self.annotation.take([position], axis=axis))
+
+        # colors of just the structures in this plane
+        ids, labels = np.unique(plane, return_inverse=True)
+        lut = np.array([cmap[stid] for stid in ids.tolist()], 
+                       dtype=np.uint8).reshape(-1, 3)
+
+        return lut[labels.reshape(plane.shape)]
+
+    def slice_renderer(self, cmap=None, cache_size=64):
+        '''Obtain a renderer of many slices, with a cache of recent slices 
+        (see SliceRenderer)
+        
+        Parameters
+        ----------
+        cmap : dict, optional
+            Keys are structure ids, values are rgb triplets. Defaults to 
+            structure rgb_triplets.
+        cache_size : int, optional
+            Number of rendered slices kept.
             
-        return np.reshape([cmap[point] for point in image.flat], 
-                      list(image.shape) + [3]).astype(np.uint8)
+        Returns
+        -------
+        SliceRenderer
+        
+        '''
+
+        return SliceRenderer(self, cmap=cmap, cache_size=cache_size)
             
             
-    def export_itksnap_labels(self, id_type=np.uint16, label_description_kwargs=None):
+    def export_itksnap_labels(self, id_type=np.uint16, label_description_kwargs=None, 
+                              block_planes=16):
         '''Produces itksnap labels, remapping large ids if needed.
 
         Parameters
@@ -345,6 +557,8 @@ class ReferenceSpace(object):
             Used to determine the type of the output annotation and whether ids need to be remapped to smaller values.
         label_description_kwargs : dict, optional
             Keyword arguments passed to StructureTree.export_label_description
+        block_planes : int, optional
+            Number of planes (along the last axis) remapped at a time.
 
         Returns
         -------
@@ -355,46 +569,131 @@ class ReferenceSpace(object):
 
         '''
 
-        if label_description_kwargs is None:
-            label_description_kwargs = {}
-
-        label_description = self.structure_tree.export_label_description(**label_description_kwargs)
-
-        if np.any(label_description['IDX'].values > np.iinfo(id_type).max):
-            label_description = label_description.sort_values(by='LABEL')
-            label_description = label_description.reset_index(drop=True)
-            new_annotation = np.zeros(self.annotation.shape, dtype=id_type)
-            id_map = {}
+        label_description, keys, values = self._itksnap_label_map(
+            id_type, label_description_kwargs)
 
-            for ii, idx in enumerate(label_description['IDX'].values):
-                id_map[idx] = ii + 1
-                new_annotation[self.annotation == idx] = ii + 1
+        if keys is None:
+            return self.annotation, label_description
 
-            label_description['IDX'] = label_description.apply(lambda row: id_map[row['IDX']], axis=1)
-            return new_annotation, label_description
+        new_annotation = np.zeros(self.annotation.shape, dtype=id_type)
+        for start, stop, block in self._itksnap_blocks(keys, values, 
+                                                       block_planes):
+            new_annotation[..., start:stop] = block
 
-        return self.annotation, label_description
+        return new_annotation, label_description
 
     
-    def write_itksnap_labels(self, annotation_path, label_path, **kwargs):
+    def write_itksnap_labels(self, annotation_path, label_path, block_planes=16, 
+                             **kwargs):
         '''Generate a label file (nrrd) and a label_description file (csv) for use with ITKSnap
 
+        The label volume is remapped and written (gzip encoded) a block of 
+        planes at a time, so that no whole-volume copy of the annotation is 
+        made. This works on memory mapped annotations; those of 
+        ReferenceSpaceCache are Fortran ordered, like nrrd files, so each 
+        block is contiguous on disk and the file is read once.
+
         Parameters
         ----------
         annotation_path : str
             write generated label file here
         label_path : str
             write generated label_description file here
+        block_planes : int, optional
+            Number of planes (along the last axis) remapped and written at a 
+            time.
         **kwargs : 
-            will be passed to self.export_itksnap_labels
+            id_type and label_description_kwargs, as for 
+            self.export_itksnap_labels
 
         '''
 
-        annotation, labels = self.export_itksnap_labels(**kwargs)
-        nrrd.write(annotation_path, annotation, header={'spacings': self.resolution})
+        id_type = kwargs.get('id_type', np.uint16)
+        labels, keys, values = self._itksnap_label_map(
+            id_type, kwargs.get('label_description_kwargs'))
+
+        if keys is None:
+            dtype = np.dtype(self.annotation.dtype)
+        else:
+            dtype = np.dtype(id_type)
+        dtype = dtype.newbyteorder('<')
+
+        header = ['NRRD0004',
+                  '# Complete NRRD file format specification at:',
+                  '# http://teem.sourceforge.net/nrrd/format.html',
+                  'type: {0}'.format(self.NRRD_TYPES[dtype.kind + str(dtype.itemsize)]),
+                  'dimension: {0}'.format(self.annotation.ndim),
+                  'sizes: {0}'.format(' '.join(map(str, self.annotation.shape))),
+                  'endian: little',
+                  'encoding: gzip',
+                  'spacings: {0}'.format(' '.join('{0:g}'.format(float(r)) 
+                                                  for r in self.resolution)),
+                  '', '']
+
+        with open(annotation_path, 'wb') as annotation_file:
+            annotation_file.write('\n'.join(header).encode('ascii'))
+
+            # nrrd data are in F order, so consecutive blocks along the last 
+            # (slowest) axis can be appended to one gzip stream
+            with gzip.GzipFile(fileobj=annotation_file, mode='wb') as data:
+                for _, _, block in self._itksnap_blocks(keys, values, 
+                                                        block_planes):
+                    data.write(block.astype(dtype, copy=False).tobytes('F'))
+
         labels.to_csv(label_path, sep=' ', index=False, header=False, quoting=csv.QUOTE_NONNUMERIC)
 
 
+    def _itksnap_label_map(self, id_type, label_description_kwargs=None):
+        '''Build the label description and, if any id is too large for 
+        id_type, a lookup from structure ids (sorted keys) to consecutive 
+        labels (values), ordered by label name.
+        '''
+
+        if label_description_kwargs is None:
+            label_description_kwargs = {}
+
+        label_description = self.structure_tree.export_label_description(**label_description_kwargs)
+
+        if not np.any(label_description['IDX'].values > np.iinfo(id_type).max):
+            return label_description, None, None
+
+        label_description = label_description.sort_values(by='LABEL')
+        label_description = label_description.reset_index(drop=True)
+
+        ids = label_description['IDX'].values
+        labels = np.arange(1, len(ids) + 1)
+
+        order = np.argsort(ids, kind='mergesort')
+        keys = ids[order]
+        values = labels[order].astype(id_type)
+
+        label_description['IDX'] = labels
+        return label_description, keys, values
+
+
+    def _itksnap_blocks(self, keys, values, block_planes):
+        '''Yield (start, stop, block) for blocks of planes along the last 
+        axis of the annotation, remapped through keys -> values (ids not 
+        among the keys become 0) unless keys is None.
+        '''
+
+        n_planes = self.annotation.shape[-1]
+
+        for start in range(0, n_planes, block_planes):
+            stop = min(start + block_planes, n_planes)
+            block = np.asarray(self.annotation[..., start:stop])
+
+            if keys is not None:
+                positions = np.searchsorted(keys, block)
+                positions[positions == len(keys)] = 0
+
+                remapped = values[positions]
+                remapped[keys[positions] != block] = 0
+                block = remapped
+
+            yield start, stop, block
+
+
     @staticmethod
     def return_mask_cb(structure_id, fn):
         '''A basic callback for many_structure_masks
@@ -33,8 +33,21 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import os
+import logging
+import functools
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import nrrd
+
 from allensdk.config.manifest_builder import ManifestBuilder
 from allensdk.api.cache import Cache
+import allensdk.api.bulk_download as bulk_download
+import allensdk.api.cache_manager as cache_manager
+from allensdk.api.revalidation import remove_validators
+from allensdk.config.manifest import Manifest
 from allensdk.api.queries.reference_space_api import ReferenceSpaceApi
 from allensdk.api.queries.ontologies_api import OntologiesApi
 from allensdk.deprecated import deprecated
@@ -42,6 +55,54 @@ from allensdk.deprecated import deprecated
 from .ontology import Ontology
 from .structure_tree import StructureTree
 from .reference_space import ReferenceSpace
+from .annotation_pyramid import AnnotationPyramid
+
+
+_log = logging.getLogger('allensdk.core.reference_space_cache')
+
+
+def _replace(source, destination):
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    else:
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def _partial_path(path):
+    ''' A new empty file next to path, to be written and then moved to path.
+    Its name is unique, so concurrent writers of path do not share it.
+    '''
+    directory, name = os.path.split(path)
+    root, extension = os.path.splitext(name)
+
+    handle, partial_path = tempfile.mkstemp(prefix=root + '.',
+                                            suffix='.partial' + extension,
+                                            dir=directory or os.curdir)
+    os.close(handle)
+
+    return partial_path
+
+
+def _write_atomically(path, write):
+    ''' Call write with a temporary path next to path, then move the result 
+    into place, so an interrupted write never leaves a partial file at path.
+    '''
+    Manifest.safe_make_parent_dirs(path)
+
+    partial_path = _partial_path(path)
+    try:
+        write(partial_path)
+        _replace(partial_path, path)
+    except:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    finally:
+        remove_validators(partial_path)
+
+    cache_manager.record_create(path)
 
 
 class ReferenceSpaceCache(Cache):
@@ -56,6 +117,11 @@ class ReferenceSpaceCache(Cache):
 
     MANIFEST_VERSION = 1.2
 
+    # raw copies of volumes, in the nrrd files' (Fortran) order, next to them
+    MEMORY_MAP_SUFFIX = '.npy'
+
+    PYRAMID_RESOLUTIONS = (25, 50, 100)
+
     def __init__(self, 
                  resolution, 
                  reference_space_key,
@@ -75,7 +141,7 @@ class ReferenceSpaceCache(Cache):
         self.api = ReferenceSpaceApi(base_uri=kwargs['base_uri'])
 
         
-    def get_annotation_volume(self, file_name=None):
+    def get_annotation_volume(self, file_name=None, mmap=False):
         """
         Read the annotation volume.  Download it first if it doesn't exist.
 
@@ -87,21 +153,31 @@ class ReferenceSpaceCache(Cache):
             it will be read from this file.  If file_name is None, the
             file_name will be pulled out of the manifest.  Default is None.
 
+        mmap: boolean
+            If True, return a read-only memory map of a raw copy of the
+            volume, written next to the nrrd file on first use.  Processes
+            mapping the same file share its pages.  Default False.
+
         """
 
         file_name = self.get_cache_path(
             file_name, self.ANNOTATION_KEY, self.reference_space_key, self.resolution)
 
-        annotation, info = self.api.download_annotation_volume(
+        download = lambda: self.api.download_annotation_volume(
             self.reference_space_key,
             self.resolution,
             file_name, 
             strategy='lazy')
 
+        if mmap:
+            return self.memory_mapped_volume(file_name, download)
+
+        annotation, info = download()
+
         return annotation, info
 
 
-    def get_template_volume(self, file_name=None):
+    def get_template_volume(self, file_name=None, mmap=False):
         """
         Read the template volume.  Download it first if it doesn't exist.
 
@@ -113,18 +189,120 @@ class ReferenceSpaceCache(Cache):
             it will be read from this file.  If file_name is None, the
             file_name will be pulled out of the manifest.  Default is None.
 
+        mmap: boolean
+            If True, return a read-only memory map (see 
+            get_annotation_volume).  Default False.
+
         """
 
         file_name = self.get_cache_path(
             file_name, self.TEMPLATE_KEY, self.resolution)
 
-        template, info = self.api.download_template_volume(self.resolution, 
-                                                           file_name, 
-                                                           strategy='lazy')
+        download = lambda: self.api.download_template_volume(self.resolution, 
+                                                             file_name, 
+                                                             strategy='lazy')
+
+        if mmap:
+            return self.memory_mapped_volume(file_name, download)
+
+        template, info = download()
 
         return template, info
 
 
+    def memory_mapped_volume(self, file_name, download):
+        """
+        Memory map a raw copy of a nrrd volume.  The copy is written once,
+        after download, and again if the nrrd file is replaced.  It keeps
+        the nrrd file's (Fortran) order, so that planes along the last axis
+        are contiguous on disk.
+
+        Parameters
+        ----------
+
+        file_name: string
+            The nrrd file.
+
+        download: function
+            Called without arguments to download (if needed) and read the
+            nrrd file.  Returns (volume, header).
+
+        Returns
+        -------
+        numpy.memmap
+            Read-only volume.
+        dict
+            nrrd header.
+        """
+
+        raw_path = os.path.splitext(file_name)[0] + self.MEMORY_MAP_SUFFIX
+
+        if not os.path.exists(file_name) or not os.path.exists(raw_path) or \
+                os.path.getmtime(raw_path) < os.path.getmtime(file_name):
+            volume, header = download()
+
+            partial_path = _partial_path(raw_path)
+            try:
+                with open(partial_path, 'wb') as f:
+                    np.save(f, np.asfortranarray(volume))
+                _replace(partial_path, raw_path)
+            except:
+                os.remove(partial_path)
+                raise
+
+            _log.info("Wrote raw volume %s", raw_path)
+        else:
+            with open(file_name, 'rb') as f:
+                header = nrrd.read_header(f)
+
+        return np.load(raw_path, mmap_mode='r'), header
+
+
+    def get_annotation_pyramid(self, resolutions=None, annotation_file_name=None):
+        """
+        Coarser copies of the annotation volume, downsampled by majority
+        vote.  Missing levels are built in one block-wise pass over the
+        (memory mapped) annotation and kept next to it; levels are opened
+        as memory maps when first asked for.
+
+        Parameters
+        ----------
+
+        resolutions: list of int
+            Coarser resolutions (microns) to make sure exist.  Default 25, 50
+            and 100, less any finer than this cache's resolution.
+
+        annotation_file_name: string
+            File name of the annotation volume.  Default is None.
+
+        Returns
+        -------
+        AnnotationPyramid
+            get_level(resolution) returns a level; coarsest(resolution)
+            picks the coarsest level at least as fine as a resolution.
+        """
+
+        if resolutions is None:
+            resolutions = [r for r in self.PYRAMID_RESOLUTIONS 
+                           if r > self.resolution]
+
+        annotation_file_name = self.get_cache_path(
+            annotation_file_name, self.ANNOTATION_KEY, 
+            self.reference_space_key, self.resolution)
+
+        pyramid = AnnotationPyramid(
+            os.path.join(os.path.dirname(annotation_file_name), 
+                         'annotation_pyramid_%d' % self.resolution))
+
+        if any(not os.path.exists(pyramid.path(r)) for r in resolutions 
+               if r != self.resolution):
+            annotation, _ = self.get_annotation_volume(annotation_file_name, 
+                                                       mmap=True)
+            pyramid.build(annotation, self.resolution, resolutions)
+
+        return pyramid
+
+
     def get_structure_tree(self, file_name=None, structure_graph_id=1):
         """
         Read the list of adult mouse structures and return an StructureTree 
@@ -153,7 +331,7 @@ class ReferenceSpaceCache(Cache):
 
 
     def get_reference_space(self, structure_file_name=None, 
-                            annotation_file_name=None):
+                            annotation_file_name=None, mmap=False):
         """
         Build a ReferenceSpace from this cache's annotation volume and 
         structure tree. The ReferenceSpace does operations that relate brain 
@@ -171,11 +349,18 @@ class ReferenceSpaceCache(Cache):
             File name to store the annotation volume.  If it already exists,
             it will be read from this file.  If file_name is None, the
             file_name will be pulled out of the manifest.  Default is None.
+
+        mmap: boolean
+            If True, the ReferenceSpace's annotation is a read-only memory 
+            map (see get_annotation_volume).  Default False.
         
         """
         
+        annotation, _ = self.get_annotation_volume(annotation_file_name, 
+                                                   mmap=mmap)
+
         return ReferenceSpace(self.get_structure_tree(structure_file_name), 
-                              self.get_annotation_volume(annotation_file_name)[0], 
+                              annotation, 
                               [self.resolution] * 3)
 
     def get_structure_mask(self, structure_id, file_name=None, annotation_file_name=None):
@@ -257,10 +442,159 @@ class ReferenceSpaceCache(Cache):
 
         return self.api.download_structure_mesh(structure_id, 
                                                 self.reference_space_key,
-                                                file_name, 
+                                                file_name,
                                                 strategy='lazy')
 
 
+    def build_structure_masks(self, structure_ids, download=False,
+                              max_workers=4, max_per_host=None,
+                              progress=None, annotation_file_name=None):
+        """
+        Make sure structure masks exist in the manifest location for many
+        structures, building (or downloading) the missing ones concurrently.
+        Masks are written as gzip-compressed nrrd files under a temporary
+        name and moved into place when complete, so an interrupted build can
+        be run again and picks up where it stopped.  A file at the manifest
+        location is the record of a completed mask; no separate record is
+        kept, beyond the entry made in any registered cache index (see
+        allensdk.api.cache_manager).
+
+        Parameters
+        ----------
+
+        structure_ids: list of int
+            Structures whose masks are wanted.
+
+        download: boolean
+            If True, download masks from the Allen Institute.  Otherwise build
+            them from the (memory mapped) annotation volume, which is
+            relabelled once and shared by all workers.  Default False.
+
+        max_workers: int
+            Number of masks built or downloaded at once.  Default 4.
+
+        max_per_host: int
+            Maximum concurrent downloads from the api server.  Default is
+            max_workers.
+
+        progress: function
+            Called with an allensdk.api.bulk_download.DownloadProgress after
+            each mask finishes.
+
+        annotation_file_name: string
+            File name of the annotation volume.  Default is None.
+
+        Returns
+        -------
+        OrderedDict
+            structure id -> {'mask': status}, where status is 'cached' if the
+            mask was already in the manifest location, 'downloaded' (built) or
+            'failed'.
+        """
+
+        structure_ids = ReferenceSpaceCache.validate_structure_ids(
+            list(structure_ids))
+
+        paths = OrderedDict(
+            (sid, self.get_cache_path(None, self.STRUCTURE_MASK_KEY,
+                                      self.reference_space_key,
+                                      self.resolution, sid))
+            for sid in structure_ids)
+
+        missing = [sid for sid, path in paths.items()
+                   if not os.path.exists(path)]
+
+        if download:
+            def write(sid, partial_path):
+                self.api.download_structure_mask(sid,
+                                                 self.reference_space_key,
+                                                 self.resolution,
+                                                 partial_path,
+                                                 strategy='pass_through',
+                                                 reader=None)
+        else:
+            space = None
+            if missing:
+                space = self.get_reference_space(
+                    annotation_file_name=annotation_file_name, mmap=True)
+                # relabel once, up front, rather than in every worker
+                space.annotation_labels
+
+            def write(sid, partial_path):
+                nrrd.write(partial_path, space.make_structure_mask([sid]),
+                           header={'spacings': space.resolution,
+                                   'encoding': 'gzip'})
+
+        tasks = [bulk_download.DownloadTask(
+                    sid, 'mask', path,
+                    functools.partial(_write_atomically, path,
+                                      functools.partial(write, sid)),
+                    self.api.api_url)
+                 for sid, path in paths.items()]
+
+        return bulk_download.download_all(tasks,
+                                          max_workers=max_workers,
+                                          max_per_host=max_per_host,
+                                          progress=progress)
+
+
+    def build_structure_meshes(self, structure_ids, max_workers=4,
+                               max_per_host=None, progress=None):
+        """
+        Download the meshes of many structures concurrently.  Like
+        build_structure_masks, each file is moved into place only once
+        complete, so interrupted downloads are resumed.
+
+        Parameters
+        ----------
+
+        structure_ids: list of int
+            Structures whose meshes are wanted.
+
+        max_workers: int
+            Number of concurrent downloads.  Default 4.
+
+        max_per_host: int
+            Maximum concurrent downloads from the api server.  Default is
+            max_workers.
+
+        progress: function
+            Called with an allensdk.api.bulk_download.DownloadProgress after
+            each mesh finishes.
+
+        Returns
+        -------
+        OrderedDict
+            structure id -> {'mesh': status}, where status is 'cached',
+            'downloaded' or 'failed'.
+        """
+
+        structure_ids = ReferenceSpaceCache.validate_structure_ids(
+            list(structure_ids))
+
+        def write(sid, partial_path):
+            self.api.download_structure_mesh(sid,
+                                             self.reference_space_key,
+                                             partial_path,
+                                             strategy='pass_through',
+                                             reader=None)
+
+        tasks = []
+        for sid in structure_ids:
+            path = self.get_cache_path(None, self.STRUCTURE_MESH_KEY,
+                                       self.reference_space_key, sid)
+            tasks.append(bulk_download.DownloadTask(
+                sid, 'mesh', path,
+                functools.partial(_write_atomically, path,
+                                  functools.partial(write, sid)),
+                self.api.api_url))
+
+        return bulk_download.download_all(tasks,
+                                          max_workers=max_workers,
+                                          max_per_host=max_per_host,
+                                          progress=progress)
+
+
     def add_manifest_paths(self, manifest_builder):
         """
         Construct a manifest for this Cache class and save it in a file.
@@ -38,6 +38,8 @@ import operator as op
 from collections import defaultdict
 from six import iteritems
 
+import numpy as np
+
 from allensdk.deprecated import deprecated
 
 
@@ -84,6 +86,9 @@ class SimpleTree( object ):
         self.node_id_cb = node_id_cb
         self.parent_id_cb = parent_id_cb
 
+        # lookup tables by node property, built on first use
+        self._value_maps = {}
+
 
     def filter_nodes(self, criterion):
         '''Obtain a list of nodes filtered by some criterion
@@ -156,17 +161,24 @@ class SimpleTree( object ):
         list : 
             outputs, 1 for each input value.
 
+        Notes
+        -----
+        Lookups by a named property are built once and reused, so changes to 
+        that property of existing nodes are not seen.
+
         '''
 
         if to_fn is None:
             to_fn = lambda x: x
 
         if not callable( key ):
-            from_fn = lambda x: x[key]
-        else:
-            from_fn = key
+            if key not in self._value_maps:
+                self._value_maps[key] = self.value_map( lambda x: x[key], 
+                                                        lambda x: x )
+            node_map = self._value_maps[key]
+            return [ to_fn(node_map[vv]) for vv in values ]
 
-        value_map = self.value_map( from_fn, to_fn )
+        value_map = self.value_map( key, to_fn )
         return [ value_map[vv] for vv in values ]
 
 
@@ -282,19 +294,168 @@ class SimpleTree( object ):
         
         '''
     
-        out = []
-        for ii, nid in enumerate(node_ids):
+        order, enter, leave = self._euler_tour()
+        return [ order[enter[nid]:leave[nid]] for nid in node_ids ]
+
+
+    def _euler_tour(self):
+        '''Numbers nodes in depth-first (pre-)order, once. Each node's 
+        descendants (itself included) are then the contiguous run 
+        order[enter[id]:leave[id]], and a is an ancestor of b if and only if 
+        enter[a] <= enter[b] < leave[a].
+        '''
+
+        if not hasattr(self, '_tour'):
+            roots = [nid for nid, pid in iteritems(self._parent_ids) 
+                     if pid is None or pid not in self._nodes]
+
+            order = []
+            enter = {}
+            leave = {}
+            stack = [(nid, False) for nid in reversed(roots)]
+            while stack:
+                nid, leaving = stack.pop()
+                if leaving:
+                    leave[nid] = len(order)
+                    continue
+                enter[nid] = len(order)
+                order.append(nid)
+                stack.append((nid, True))
+                stack.extend((cid, False) 
+                             for cid in reversed(self._child_ids[nid]))
+
+            self._tour = (order, enter, leave)
+
+        return self._tour
+
+
+    def _tour_intervals(self, node_ids):
+        '''Arrays of enter and leave numbers of some nodes. Unknown nodes 
+        get the empty interval [-1, -1).
+        '''
+
+        _, enter, leave = self._euler_tour()
+        node_ids = list(node_ids)
+        return (np.array([enter.get(nid, -1) for nid in node_ids], dtype=int), 
+                np.array([leave.get(nid, -1) for nid in node_ids], dtype=int))
+
+
+    def is_descendant(self, node_ids, ancestor_ids):
+        '''Test pairs of nodes for descent
+        
+        Parameters
+        ----------
+        node_ids : list of hashable
+            Putative descendants.
+        ancestor_ids : list of hashable
+            Putative ancestors, paired with node_ids.
             
-            current = [nid]
-            children = self.child_ids([nid])[0]
+        Returns
+        -------
+        numpy ndarray of bool : 
+            True where the node descends from (or is) its paired ancestor.
+        
+        '''
+
+        node_enter, _ = self._tour_intervals(node_ids)
+        enter, leave = self._tour_intervals(ancestor_ids)
+
+        return (node_enter >= 0) & (enter <= node_enter) & (node_enter < leave)
+
+
+    def descends_from_any(self, node_ids, ancestor_ids):
+        '''Test many nodes for descent from any of a set of nodes
+        
+        Parameters
+        ----------
+        node_ids : list of hashable
+            Nodes to test. Unknown nodes descend from nothing.
+        ancestor_ids : list of hashable
+            Putative ancestors.
             
-            if children:
-                current.extend(functools.reduce(op.add, map(list, 
-                               self.descendant_ids(children))))
-                               
-            out.append(current)
+        Returns
+        -------
+        numpy ndarray of bool : 
+            True for each node that descends from (or is) one of 
+            ancestor_ids.
+        
+        '''
+
+        node_enter, _ = self._tour_intervals(node_ids)
+        enter, leave = self._tour_intervals(ancestor_ids)
+        known = enter >= 0
+        enter, leave = enter[known], leave[known]
+
+        if len(enter) == 0:
+            return np.zeros(len(node_enter), dtype=bool)
+
+        # nested intervals are covered by their outermost one
+        order = np.argsort(enter, kind='mergesort')
+        enter, leave = enter[order], np.maximum.accumulate(leave[order])
+        outermost = np.r_[True, enter[1:] >= leave[:-1]]
+        enter, leave = enter[outermost], leave[np.r_[outermost[1:], True]]
+
+        interval = np.searchsorted(enter, node_enter, side='right') - 1
+        return (node_enter >= 0) & (interval >= 0) & \
+            (node_enter < leave[np.maximum(interval, 0)])
+
+
+    def post_order_ids(self):
+        '''Obtain the ids of all nodes, each after all of its descendants
+        
+        Returns
+        -------
+        list of hashable : 
+            Every node id, children before parents.
+        
+        '''
+
+        roots = [nid for nid, pid in iteritems(self._parent_ids) 
+                 if pid is None or pid not in self._nodes]
+
+        out = []
+        stack = [(nid, False) for nid in roots]
+        while stack:
+            nid, visited = stack.pop()
+            if visited:
+                out.append(nid)
+                continue
+            stack.append((nid, True))
+            stack.extend((cid, False) for cid in self._child_ids[nid])
+
         return out
 
+
+    def sum_over_descendants(self, values):
+        '''Total some per-node values over each node's descendants, in one 
+        pass from the leaves up.
+        
+        Parameters
+        ----------
+        values : array-like
+            Aligned (along the first axis) with node_ids(). 
+            
+        Returns
+        -------
+        numpy ndarray : 
+            Aligned with node_ids(). Each element is the sum of the values 
+            of a node and all of its descendants.
+        
+        '''
+
+        totals = np.array(values, copy=True)
+        if len(totals) != len(self._nodes):
+            raise ValueError('got {0} values for {1} nodes'.format(
+                len(totals), len(self._nodes)))
+
+        position = {nid: ii for ii, nid in enumerate(self.node_ids())}
+        for nid in self.post_order_ids():
+            pid = self._parent_ids[nid]
+            if pid in position:
+                totals[position[pid]] += totals[position[nid]]
+
+        return totals
+
     
     @deprecated("Use SimpleTree.nodes instead")
     def node(self, node_ids=None):
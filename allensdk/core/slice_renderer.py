@@ -0,0 +1,233 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Colored slices of an annotation, rendered many at a time.
+'''
+from __future__ import division
+import os
+import logging
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+_log = logging.getLogger('allensdk.core.slice_renderer')
+
+
+class SliceRenderer(object):
+    ''' Renders slices of a ReferenceSpace's annotation as RGB images.
+
+    Structure colors are looked up once, into a table sorted by structure
+    id, so a slice is a search and a gather over its own voxels; neither the
+    annotation nor its relabelling is read in whole.  Recently rendered
+    slices are kept in a least recently used cache.
+
+    Parameters
+    ----------
+    reference_space : ReferenceSpace
+    cmap : dict, optional
+        Keys are structure ids, values are rgb triplets.  Defaults to
+        structure rgb_triplets, with black background.  Ids without a color
+        are drawn black.
+    cache_size : int, optional
+        number of slices kept.  Default 64.
+    '''
+
+    def __init__(self, reference_space, cmap=None, cache_size=64):
+        self.reference_space = reference_space
+        self.cache_size = cache_size
+
+        if cmap is None:
+            cmap = reference_space.structure_tree.get_colormap()
+            cmap[0] = [0, 0, 0]
+
+        self.ids = np.array(sorted(cmap), dtype=np.int64)
+        # the last color is for ids without one
+        self.colors = np.zeros((len(self.ids) + 1, 3), dtype=np.uint8)
+        for ii, stid in enumerate(self.ids.tolist()):
+            self.colors[ii] = cmap[stid]
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index(self, axis, position):
+        ''' The plane of a position (in microns) along an axis.
+        '''
+        index = int(np.around(position / self.reference_space.resolution[axis]))
+        if not 0 <= index < self.reference_space.annotation.shape[axis]:
+            raise IndexError("position %s is outside the annotation along "
+                             "axis %d" % (position, axis))
+        return index
+
+    def render_plane(self, axis, index, step=1):
+        ''' The image of one plane.
+
+        Parameters
+        ----------
+        axis : int
+            0 is coronal, 1 is horizontal, and 2 is sagittal.
+        index : int
+            plane number along axis.
+        step : int, optional
+            take every step-th pixel of the plane.  Default 1.
+
+        Returns
+        -------
+        numpy ndarray
+            read-only AxBx3 uint8 image, shared with the cache.
+        '''
+        key = (axis, index, step)
+        with self._lock:
+            if key in self._cache:
+                self._cache[key] = image = self._cache.pop(key)
+                return image
+
+        plane = [slice(None, None, step)] * 3
+        plane[axis] = index
+        plane = np.asarray(self.reference_space.annotation[tuple(plane)])
+
+        positions = np.searchsorted(self.ids, plane)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == plane[found]
+        positions[~found] = len(self.ids)
+
+        image = self.colors[positions]
+        image.flags.writeable = False
+
+        with self._lock:
+            self._cache[key] = image
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return image
+
+    def render(self, axis, position):
+        ''' The image of the plane at a position, as
+        ReferenceSpace.get_slice_image.
+
+        Parameters
+        ----------
+        axis : int
+            0 is coronal, 1 is horizontal, and 2 is sagittal.
+        position : numeric
+            in microns along axis.
+        '''
+        return self.render_plane(axis, self.index(axis, position))
+
+    def render_many(self, axis, positions=None):
+        ''' Images of several planes.
+
+        Parameters
+        ----------
+        axis : int
+        positions : list of numeric, optional
+            in microns.  Defaults to every plane.
+
+        Yields
+        ------
+        (int, numpy ndarray)
+            plane number and image.
+        '''
+        for index in self._indices(axis, positions):
+            yield index, self.render_plane(axis, index)
+
+    def write_tiles(self, directory, axis, positions=None, tile_size=256,
+                    levels=None, max_workers=4, extension='png'):
+        ''' Write planes as tiled image pyramids, in
+        <directory>/<axis>_<plane>/<level>/<row>_<column>.<extension>.
+        Level 0 is full resolution; each following level halves it.
+
+        Parameters
+        ----------
+        directory : string
+        axis : int
+        positions : list of numeric, optional
+            in microns.  Defaults to every plane.
+        tile_size : int, optional
+            tile edge in pixels.  Default 256.
+        levels : int, optional
+            number of levels.  Defaults to as many as it takes to fit a
+            plane in one tile.
+        max_workers : int, optional
+            planes rendered and written concurrently.  Default 4.
+        extension : string, optional
+            image format, by file extension.  Default 'png'.
+
+        Returns
+        -------
+        list of string
+            the directory of each plane.
+        '''
+        import skimage.io
+
+        shape = [n for ii, n in enumerate(self.reference_space.annotation.shape)
+                 if ii != axis]
+        if levels is None:
+            levels = 1 + max(0, int(np.ceil(np.log2(max(shape) / tile_size))))
+
+        def write(index):
+            plane_dir = os.path.join(directory, '%d_%d' % (axis, index))
+            for level in range(levels):
+                image = self.render_plane(axis, index, step=2 ** level)
+                level_dir = os.path.join(plane_dir, str(level))
+                if not os.path.isdir(level_dir):
+                    os.makedirs(level_dir)
+
+                for row in range(0, image.shape[0], tile_size):
+                    for col in range(0, image.shape[1], tile_size):
+                        path = os.path.join(level_dir, '%d_%d.%s' % (
+                            row // tile_size, col // tile_size, extension))
+                        with warnings.catch_warnings():
+                            # low contrast (e.g. background) tiles
+                            warnings.simplefilter('ignore')
+                            skimage.io.imsave(
+                                path, image[row:row + tile_size,
+                                            col:col + tile_size])
+            return plane_dir
+
+        indices = list(self._indices(axis, positions))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            written = list(executor.map(write, indices))
+
+        _log.info("Wrote %d tiled planes to %s", len(written), directory)
+        return written
+
+    def _indices(self, axis, positions):
+        if positions is None:
+            return range(self.reference_space.annotation.shape[axis])
+        return [self.index(axis, position) for position in positions]
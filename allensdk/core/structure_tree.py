@@ -236,7 +236,7 @@ class StructureTree( SimpleTree ):
         
         '''
     
-        return parent_id in self.ancestor_ids([child_id])[0]
+        return bool(self.is_descendant([child_id], [parent_id])[0])
     
     
     def get_structure_sets(self):
@@ -271,10 +271,16 @@ class StructureTree( SimpleTree ):
         
         '''
     
-        ancestor_ids = functools.reduce(op.add, 
-                              map(lambda x: x[1:], 
-                                  self.ancestor_ids(structure_ids)))
-        return (set(ancestor_ids) & set(structure_ids))
+        structure_ids = list(set(structure_ids))
+        enter, leave = self._tour_intervals(structure_ids)
+
+        # in tour order, a structure contains another of the set if and only 
+        # if it contains the next one
+        order = np.argsort(enter, kind='mergesort')
+        enter, leave = enter[order], leave[order]
+        contains_next = (enter[:-1] >= 0) & (enter[1:] < leave[:-1])
+
+        return set(np.array(structure_ids)[order[:-1][contains_next]].tolist())
         
 
     def export_label_description(self, alphas=None, exclude_label_vis=None, exclude_mesh_vis=None, label_key='acronym'):
@@ -0,0 +1,313 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' A single on-disk table of the structure unionizes of many experiments.
+'''
+import os
+import logging
+import threading
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+_log = logging.getLogger('allensdk.core.structure_unionize_store')
+
+
+class StructureUnionizeStore(object):
+    ''' Structure unionize records of many experiments in one HDF5 table,
+    indexed on experiment_id, structure_id, hemisphere_id and is_injection.
+    Experiments are appended as they are downloaded, and queries read only
+    the rows and columns they ask for.
+
+    The store is safe to use from several threads of one process, but not
+    from several processes at once: give concurrent processes their own
+    store, or only read from a shared one.
+
+    Parameters
+    ----------
+    path : string
+        the HDF5 file.  Created on first append.
+    '''
+
+    INDEX_COLUMNS = ['experiment_id', 'structure_id', 'hemisphere_id',
+                     'is_injection']
+    UNIONIZES_KEY = 'unionizes'
+    EXPERIMENTS_KEY = 'experiments'
+
+    # longest list of values pytables will evaluate in a where clause
+    MAX_SELECTORS = 31
+
+    # characters reserved for each value of a text column
+    MIN_TEXT_SIZE = 64
+
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+        key = os.path.abspath(path)
+        with StructureUnionizeStore._locks_lock:
+            self._lock = StructureUnionizeStore._locks.setdefault(
+                key, threading.RLock())
+
+    def _open(self, mode):
+        return pd.HDFStore(self.path, mode=mode, complevel=5, complib='blosc')
+
+    def experiment_ids(self):
+        ''' The experiments in the store (including those with no unionizes).
+
+        Returns
+        -------
+        set of int
+        '''
+        with self._lock:
+            if not os.path.exists(self.path):
+                return set()
+
+            with self._open('r') as store:
+                if self.EXPERIMENTS_KEY not in store:
+                    return set()
+                return set(store.select(self.EXPERIMENTS_KEY)[
+                    'experiment_id'].tolist())
+
+    def append(self, unionizes, experiment_ids):
+        ''' Add the unionizes of some experiments.
+
+        Parameters
+        ----------
+        unionizes : DataFrame
+            records of the experiments.  If it has no experiment_id column,
+            it must be the records of a single experiment.
+        experiment_ids : list of int
+            the experiments these are the complete records of.  Experiments
+            already in the store are skipped.
+        '''
+        experiment_ids = list(experiment_ids)
+        unionizes = pd.DataFrame(unionizes)
+
+        if 'section_data_set_id' in unionizes.columns and \
+                'experiment_id' not in unionizes.columns:
+            unionizes = unionizes.rename(
+                columns={'section_data_set_id': 'experiment_id'})
+
+        if 'experiment_id' not in unionizes.columns:
+            if len(unionizes) == 0:
+                unionizes = pd.DataFrame(columns=['experiment_id'])
+            elif len(experiment_ids) != 1:
+                raise ValueError("unionizes of several experiments need an "
+                                 "experiment_id column")
+            unionizes = unionizes.assign(experiment_id=experiment_ids[0])
+
+        with self._lock:
+            new_ids = [eid for eid in experiment_ids
+                       if eid not in self.experiment_ids()]
+            if not new_ids:
+                return
+
+            unionizes = unionizes[unionizes['experiment_id'].isin(new_ids)]
+
+            with warnings.catch_warnings():
+                # pytables performance warnings about index-less appends
+                warnings.simplefilter('ignore')
+
+                with self._open('a') as store:
+                    if len(unionizes) > 0:
+                        self._append_rows(store, unionizes)
+
+                    store.append(self.EXPERIMENTS_KEY,
+                                 pd.DataFrame({'experiment_id':
+                                               np.array(new_ids, dtype=np.int64)}),
+                                 format='table', index=False)
+
+                    if self.UNIONIZES_KEY in store:
+                        store.create_table_index(self.UNIONIZES_KEY,
+                                                 columns=self.INDEX_COLUMNS,
+                                                 optlevel=6, kind='medium')
+
+            _log.info("Added unionizes of %d experiments to %s",
+                      len(new_ids), self.path)
+
+    def _append_rows(self, store, unionizes):
+        ''' Append rows to the table.  If they don't fit its columns (new
+        columns, missing values in an integer column, longer text) the
+        table is written again with columns that hold both.
+        '''
+        if self.UNIONIZES_KEY not in store:
+            self._write_table(store, unionizes)
+            return
+
+        stored = store.select(self.UNIONIZES_KEY, start=0, stop=0)
+        offset = store.get_storer(self.UNIONIZES_KEY).nrows
+        rows = self._normalize(unionizes)
+
+        if set(rows.columns) == set(stored.columns):
+            rows = rows[stored.columns]
+
+            if (rows.dtypes == stored.dtypes).all():
+                rows.index = np.arange(offset, offset + len(rows))
+                try:
+                    store.append(self.UNIONIZES_KEY, rows, format='table',
+                                 index=False)
+                    return
+                except ValueError as e:
+                    # e.g. text longer than the column; nothing was written
+                    _log.info("Rewriting %s: %s", self.path, e)
+
+        combined = pd.concat([store.select(self.UNIONIZES_KEY), unionizes],
+                             ignore_index=True, sort=False)
+        store.remove(self.UNIONIZES_KEY)
+        self._write_table(store, combined)
+
+    def _write_table(self, store, unionizes):
+        rows = self._normalize(unionizes)
+        rows.index = np.arange(len(rows))
+
+        min_itemsize = dict((c, max(self.MIN_TEXT_SIZE,
+                                    int(rows[c].str.len().max())))
+                            for c in rows.columns if rows[c].dtype == object)
+
+        store.append(self.UNIONIZES_KEY, rows, format='table',
+                     data_columns=self.INDEX_COLUMNS,
+                     min_itemsize=min_itemsize or None,
+                     index=False)
+
+    def _normalize(self, unionizes):
+        ''' Column types for the table.  The index columns must have values:
+        is_injection is stored as bool and the others as int64.  Other
+        boolean and integer columns keep their type unless values are
+        missing, in which case they are stored as float64 (missing as NaN),
+        like other numbers.  Anything else is stored as text, with missing
+        values as empty strings.
+        '''
+        unionizes = unionizes.copy()
+
+        for column in unionizes.columns:
+            values = unionizes[column]
+
+            if column in self.INDEX_COLUMNS:
+                if values.isnull().any():
+                    raise ValueError("unionizes are missing %s values" %
+                                     column)
+                dtype = bool if column == 'is_injection' else np.int64
+                unionizes[column] = values.astype(dtype)
+            elif values.dtype == bool:
+                continue
+            elif np.issubdtype(values.dtype, np.integer):
+                unionizes[column] = values.astype(np.int64)
+            elif np.issubdtype(values.dtype, np.number):
+                unionizes[column] = values.astype(np.float64)
+            else:
+                unionizes[column] = values.where(values.notnull(), '').astype(str)
+
+        return unionizes
+
+    def query(self,
+              experiment_ids=None,
+              structure_ids=None,
+              hemisphere_ids=None,
+              is_injection=None,
+              columns=None):
+        ''' Read unionizes.  Each argument left as None does not filter.
+
+        Parameters
+        ----------
+        experiment_ids : list of int, optional
+        structure_ids : list of int, optional
+        hemisphere_ids : list of int, optional
+        is_injection : bool, optional
+        columns : list of string, optional
+            read only these columns (the index columns are always read).
+
+        Returns
+        -------
+        DataFrame
+            rows in the order they were appended
+        '''
+        with self._lock:
+            if not os.path.exists(self.path):
+                return pd.DataFrame(columns=self.INDEX_COLUMNS)
+
+            with self._open('r') as store:
+                if self.UNIONIZES_KEY not in store:
+                    return pd.DataFrame(columns=self.INDEX_COLUMNS)
+
+                if columns is not None:
+                    columns = list(pd.unique(self.INDEX_COLUMNS + list(columns)))
+
+                terms = []
+                if is_injection is not None:
+                    terms.append('is_injection == %s' % bool(is_injection))
+
+                selectors = [('experiment_id', experiment_ids),
+                             ('structure_id', structure_ids),
+                             ('hemisphere_id', hemisphere_ids)]
+                selectors = [(field, [int(v) for v in values])
+                             for field, values in selectors
+                             if values is not None]
+
+                # the shortest list can be evaluated by pytables, in chunks
+                # if need be; the others are applied after reading.
+                chunked = None
+                if selectors:
+                    chunked = min(selectors, key=lambda s: len(s[1]))
+
+                if chunked is not None and \
+                        len(chunked[1]) <= 8 * self.MAX_SELECTORS:
+                    field, values = chunked
+                    parts = []
+                    for start in range(0, max(len(values), 1),
+                                       self.MAX_SELECTORS):
+                        chunk = values[start:start + self.MAX_SELECTORS]
+                        parts.append(store.select(
+                            self.UNIONIZES_KEY,
+                            where=terms + ['%s == %r' % (field, chunk)],
+                            columns=columns))
+                    data = pd.concat(parts) if parts else None
+                else:
+                    data = store.select(self.UNIONIZES_KEY,
+                                        where=terms if terms else None,
+                                        columns=columns)
+
+        if data is None or len(data) == 0:
+            return pd.DataFrame(columns=data.columns if data is not None
+                                else self.INDEX_COLUMNS)
+
+        for field, values in selectors:
+            data = data[data[field].isin(values)]
+
+        return data.sort_index().reset_index(drop=True)
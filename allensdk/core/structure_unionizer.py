@@ -0,0 +1,279 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Structure unionizes computed locally from grid data volumes.
+'''
+from __future__ import division
+import logging
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import nrrd
+
+from .reference_space import ReferenceSpace
+
+
+_log = logging.getLogger('allensdk.core.structure_unionizer')
+
+
+class StructureUnionizer(object):
+    ''' Summarizes an experiment's grid data volumes per structure and
+    hemisphere, like the structure unionizes served by the API.
+
+    The annotation is relabelled once (see
+    ReferenceSpace.relabel_annotation), to consecutive (direct structure,
+    hemisphere) labels.  Each experiment then takes one weighted bincount
+    per summed quantity over those labels, and the per-label sums are
+    rolled up to the requested structures (and their descendants) with a
+    sparse product.  The structure tree may be any ontology over the
+    annotation's structure ids.
+
+    Parameters
+    ----------
+    structure_tree : StructureTree
+        structures to summarize.
+    annotation : numpy ndarray or ReferenceSpace
+        3d volume of structure ids, of the shape of the experiment volumes.
+        The last axis runs from left to right.  The labels of a
+        ReferenceSpace are reused.
+    resolution : numeric or length-3 tuple of numeric
+        voxel size in microns.
+    structure_ids : list of int, optional
+        structures to summarize.  Defaults to every structure of the tree.
+    '''
+
+    LEFT, RIGHT, BOTH = 1, 2, 3
+
+    # columns of the unionizes of no experiments
+    COLUMNS = ['experiment_id', 'structure_id', 'hemisphere_id',
+               'is_injection', 'volume', 'projection_volume',
+               'projection_density', 'normalized_projection_volume']
+
+    def __init__(self, structure_tree, annotation, resolution,
+                 structure_ids=None):
+        if not isinstance(annotation, ReferenceSpace):
+            annotation = ReferenceSpace(structure_tree, annotation, resolution)
+        if structure_ids is None:
+            structure_ids = structure_tree.node_ids()
+
+        self.shape = annotation.annotation.shape
+        self.structure_ids = np.array(structure_ids, dtype=np.int64)
+        self.voxel_volume = np.prod(np.broadcast_to(
+            np.asarray(resolution, dtype=np.float64), (3,))) / 1e9
+
+        direct_ids = annotation.annotation_ids
+        self.n_labels = 2 * len(direct_ids)
+
+        labels = annotation.annotation_labels.astype(
+            np.min_scalar_type(self.n_labels))
+        labels *= 2
+        labels[..., self.shape[-1] // 2:] += 1
+        self.labels = labels.ravel()
+
+        descendants = structure_tree.descendant_ids(list(structure_ids))
+        position = dict((sid, ii) for ii, sid in enumerate(direct_ids.tolist()))
+        rows, cols = [], []
+        for row, desc in enumerate(descendants):
+            for sid in desc:
+                if sid in position:
+                    rows.append(row)
+                    cols.append(position[sid])
+
+        # structures x direct structures
+        self.membership = scipy.sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)),
+            shape=(len(self.structure_ids), len(direct_ids)))
+
+    def _sum(self, weights):
+        ''' Per structure sums of some voxel weights, as a
+        structures x (left, right) array.
+        '''
+        sums = np.bincount(self.labels, weights=weights.ravel(),
+                           minlength=self.n_labels).reshape(-1, 2)
+        return self.membership.dot(sums)
+
+    def unionize(self, projection_density, injection_density,
+                 injection_fraction, data_mask, projection_energy=None,
+                 experiment_id=None):
+        ''' Summarize the volumes of one experiment.
+
+        Voxels count toward the injection site by their injection fraction
+        and toward the rest of the brain by the remainder.  Voxels are
+        weighted by the data mask.
+
+        Parameters
+        ----------
+        projection_density, injection_density, injection_fraction,
+        data_mask : numpy ndarray
+            the experiment's grid data volumes.
+        projection_energy : numpy ndarray, optional
+            if given, a mean projection_energy column is added.
+        experiment_id : int, optional
+            fills the experiment_id column.
+
+        Returns
+        -------
+        DataFrame
+            one row per structure, hemisphere and is_injection that has
+            valid voxels, with columns volume, projection_volume,
+            projection_density, normalized_projection_volume and (optionally)
+            projection_energy.  Volumes are in cubic millimeters.
+        '''
+        for volume in (projection_density, injection_density,
+                       injection_fraction, data_mask):
+            if volume.shape != self.shape:
+                raise ValueError("volume shape %s does not match "
+                                 "annotation shape %s" %
+                                 (volume.shape, self.shape))
+
+        data_mask = np.asarray(data_mask, dtype=np.float64)
+        injection_fraction = np.clip(injection_fraction, 0, 1)
+
+        pixels = data_mask * injection_fraction
+        projection = data_mask * injection_density
+        sums = {True: (self._sum(pixels), self._sum(projection))}
+
+        pixels = data_mask - pixels
+        projection = data_mask * np.clip(projection_density - injection_density,
+                                         0, None)
+        sums[False] = (self._sum(pixels), self._sum(projection))
+
+        energies = {}
+        if projection_energy is not None:
+            for is_injection in sums:
+                weights = data_mask * (injection_fraction if is_injection
+                                       else 1 - injection_fraction)
+                energies[is_injection] = self._sum(weights * projection_energy)
+
+        # normalized by the projection volume of the whole injection site
+        injection_volume = np.float64(
+            np.sum(data_mask * injection_density)) * self.voxel_volume
+
+        frames = []
+        for is_injection, (pixels, projection) in sums.items():
+            for hemisphere_id in (self.LEFT, self.RIGHT, self.BOTH):
+                if hemisphere_id == self.BOTH:
+                    hem_pixels = pixels.sum(axis=1)
+                    hem_projection = projection.sum(axis=1)
+                else:
+                    hem_pixels = pixels[:, hemisphere_id - 1]
+                    hem_projection = projection[:, hemisphere_id - 1]
+
+                frame = pd.DataFrame({
+                    'structure_id': self.structure_ids,
+                    'hemisphere_id': hemisphere_id,
+                    'is_injection': is_injection,
+                    'volume': hem_pixels * self.voxel_volume,
+                    'projection_volume': hem_projection * self.voxel_volume})
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    frame['projection_density'] = hem_projection / hem_pixels
+                    frame['normalized_projection_volume'] = \
+                        frame['projection_volume'] / injection_volume
+
+                    if is_injection in energies:
+                        energy = energies[is_injection]
+                        energy = energy.sum(axis=1) \
+                            if hemisphere_id == self.BOTH \
+                            else energy[:, hemisphere_id - 1]
+                        frame['projection_energy'] = energy / hem_pixels
+
+                frames.append(frame[hem_pixels > 0])
+
+        unionizes = pd.concat(frames, ignore_index=True)
+        if experiment_id is not None:
+            unionizes.insert(0, 'experiment_id', experiment_id)
+
+        return unionizes
+
+    def unionize_files(self, paths, processes=None):
+        ''' Summarize the volumes of many experiments, spread across a
+        process pool.
+
+        Parameters
+        ----------
+        paths : dict
+            maps experiment ids to dicts of nrrd file paths, keyed by the
+            volume arguments of unionize (projection_density,
+            injection_density, injection_fraction, data_mask and optionally
+            projection_energy).
+        processes : int, optional
+            size of the pool.  Defaults to the number of CPUs.  With 1,
+            experiments are summarized in this process.
+
+        Returns
+        -------
+        DataFrame
+            the unionizes of all experiments, in the order of paths.  Empty,
+            with the columns of unionize, if there are no experiments.
+        '''
+        tasks = list(paths.items())
+        if not tasks:
+            return pd.DataFrame(columns=self.COLUMNS)
+
+        if processes == 1 or len(tasks) == 1:
+            _init_worker(self)
+            try:
+                frames = [_unionize_files(task) for task in tasks]
+            finally:
+                _init_worker(None)
+        else:
+            pool = mp.Pool(processes, initializer=_init_worker,
+                           initargs=(self,))
+            try:
+                frames = pool.map(_unionize_files, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        _log.info("Unionized %d experiments", len(tasks))
+        return pd.concat(frames, ignore_index=True)
+
+
+# the unionizer of a pool worker, passed once when the worker starts
+_worker_unionizer = None
+
+
+def _init_worker(unionizer):
+    global _worker_unionizer
+    _worker_unionizer = unionizer
+
+
+def _unionize_files(task):
+    experiment_id, paths = task
+    volumes = dict((key, nrrd.read(path)[0]) for key, path in paths.items())
+    return _worker_unionizer.unionize(experiment_id=experiment_id, **volumes)
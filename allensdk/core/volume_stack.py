@@ -0,0 +1,398 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+''' Many experiments' volumes packed into one on-disk array.
+'''
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+import numpy as np
+import h5py
+
+
+_log = logging.getLogger('allensdk.core.volume_stack')
+
+
+class VolumeStack(object):
+    ''' Volumes of several experiments at one resolution, stored as a single
+    experiments x voxels float32 array in an HDF5 file.  Each row is one
+    flattened volume.
+
+    Uncompressed stacks are contiguous on disk and are read through a numpy
+    memory map, so that reading a few voxels of every experiment touches only
+    the pages holding those voxels.  Compressed stacks are chunked along both
+    axes and are read one chunk column at a time.
+
+    Parameters
+    ----------
+    path : string
+        an HDF5 file written by VolumeStack.build
+    '''
+
+    DATA_KEY = 'data'
+    EXPERIMENT_IDS_KEY = 'experiment_ids'
+    COMPLETE_KEY = 'complete'
+
+    DTYPE = np.float32
+
+    # default chunk shape of compressed stacks
+    CHUNK_ROWS = 4
+    CHUNK_VOXELS = 2 ** 16
+
+    def __init__(self, path):
+        self.path = path
+        self._file = h5py.File(path, 'r')
+
+        self.experiment_ids = self._file[self.EXPERIMENT_IDS_KEY][:]
+        self.shape = tuple(self._file.attrs['shape'])
+        self.attrs = dict(self._file.attrs)
+
+        self._rows = dict((eid, row) for row, eid
+                          in enumerate(self.experiment_ids.tolist()))
+
+        complete = self._file[self.COMPLETE_KEY][:]
+        if not complete.all():
+            raise ValueError("%s is missing %d experiments; rebuild it"
+                             % (path, np.count_nonzero(~complete)))
+
+        self._data = self._file[self.DATA_KEY]
+        self._memmap = None
+
+        offset = self._data.id.get_offset()
+        if self._data.chunks is None and offset is not None:
+            self._memmap = np.memmap(path, dtype=self._data.dtype, mode='r',
+                                     offset=offset, shape=self._data.shape)
+
+    @property
+    def n_voxels(self):
+        return int(np.prod(self.shape))
+
+    def close(self):
+        self._memmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.experiment_ids)
+
+    def row(self, experiment_id):
+        ''' Position of an experiment in the stack.
+        '''
+        try:
+            return self._rows[experiment_id]
+        except KeyError:
+            raise KeyError("experiment %s is not in %s"
+                           % (experiment_id, self.path))
+
+    def get_experiment(self, experiment_id):
+        ''' The volume of one experiment.
+
+        Parameters
+        ----------
+        experiment_id : int
+
+        Returns
+        -------
+        numpy ndarray
+            float32 volume.  A read-only view of the file if the stack is
+            uncompressed.
+        '''
+        row = self.row(experiment_id)
+
+        if self._memmap is not None:
+            return self._memmap[row].reshape(self.shape)
+        return self._data[row].reshape(self.shape)
+
+    def get_voxels(self, voxels, experiment_ids=None):
+        ''' Some voxels of every (or some) experiments.
+
+        Parameters
+        ----------
+        voxels : array-like
+            flat (C order) voxel indices, or a tuple of per-axis index arrays
+            as returned by numpy.nonzero.
+        experiment_ids : list of int, optional
+            defaults to all experiments, in stack order.
+
+        Returns
+        -------
+        numpy ndarray
+            experiments x voxels float32 array.
+        '''
+        if isinstance(voxels, tuple):
+            voxels = np.ravel_multi_index(voxels, self.shape)
+        voxels = np.asarray(voxels, dtype=np.int64).ravel()
+
+        if experiment_ids is None:
+            rows = slice(None)
+        else:
+            rows = np.array([self.row(eid) for eid in experiment_ids],
+                            dtype=np.int64)
+
+        if self._memmap is not None:
+            if isinstance(rows, slice):
+                return np.asarray(self._memmap[:, voxels])
+            return np.asarray(self._memmap[rows[:, np.newaxis], voxels])
+
+        return self._read_chunked(rows, voxels)
+
+    def get_masked(self, mask, experiment_ids=None):
+        ''' The voxels inside a mask (e.g. a structure mask) of every (or
+        some) experiments.
+
+        Parameters
+        ----------
+        mask : numpy ndarray
+            volume of the stack's shape.  Nonzero voxels are read.
+        experiment_ids : list of int, optional
+            defaults to all experiments, in stack order.
+
+        Returns
+        -------
+        numpy ndarray
+            experiments x masked voxels float32 array, with voxels in C order
+            of the mask.
+        '''
+        mask = np.asarray(mask)
+        if mask.shape != self.shape:
+            raise ValueError("mask shape %s does not match volume shape %s"
+                             % (mask.shape, self.shape))
+
+        return self.get_voxels(np.flatnonzero(mask), experiment_ids)
+
+    def _read_chunked(self, rows, voxels):
+        ''' Reads a block of chunk columns at a time, so each compressed
+        chunk holding requested voxels is decompressed once.
+        '''
+        n_rows = len(self) if isinstance(rows, slice) else len(rows)
+        out = np.empty((n_rows, len(voxels)), dtype=self._data.dtype)
+        if len(voxels) == 0 or n_rows == 0:
+            return out
+
+        width = self._data.chunks[1]
+        order = np.argsort(voxels, kind='mergesort')
+        blocks = voxels[order] // width
+        starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+
+        for start, end in zip(starts, ends):
+            lo = int(blocks[start]) * width
+            hi = min(lo + width, self.n_voxels)
+            block = self._data[:, lo:hi]
+            if not isinstance(rows, slice):
+                block = block[rows]
+            cols = order[start:end]
+            out[:, cols] = block[:, voxels[cols] - lo]
+
+        return out
+
+    @classmethod
+    def build(cls, path, experiment_ids, read_volume, compression=None,
+              chunks=None, max_workers=4, attrs=None, overwrite=False):
+        ''' Write the volumes of some experiments into a stack.  Building is
+        resumable: if the file already holds a partial stack of the same
+        experiments, only the missing experiments are read.
+
+        Parameters
+        ----------
+        path : string
+            HDF5 file to write.
+        experiment_ids : list of int
+            order of the experiments in the stack.
+        read_volume : callable
+            maps an experiment id to its volume.  Called from several
+            threads.
+        compression : string, optional
+            h5py compression filter, e.g. 'gzip' or 'lzf'.  Compressed stacks
+            can not be memory mapped.  Default None.
+        chunks : tuple of int, optional
+            (experiments, voxels) chunk shape of compressed stacks.  Each
+            band of chunk rows is held in memory while being written.
+        max_workers : int
+            number of volumes read concurrently.  Default 4.
+        attrs : dict, optional
+            stored with the stack (e.g. resolution).
+        overwrite : bool
+            replace a stack of other experiments (or compression) at path,
+            rather than raising a ValueError.  Default False.
+
+        Returns
+        -------
+        VolumeStack
+        '''
+        experiment_ids = np.array(experiment_ids, dtype=np.int64)
+        if len(experiment_ids) == 0:
+            raise ValueError("no experiments to stack")
+        if len(np.unique(experiment_ids)) != len(experiment_ids):
+            raise ValueError("experiment ids are not unique")
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        complete = cls._resumable(path, experiment_ids, compression,
+                                  overwrite)
+        todo = [row for row in range(len(experiment_ids))
+                if complete is None or not complete[row]]
+
+        if not todo:
+            return cls(path)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque((row, executor.submit(read_volume,
+                                                  int(experiment_ids[row])))
+                            for row in todo[:max_workers])
+            queued = len(pending)
+
+            with h5py.File(path, 'a') as f:
+                band = None
+                band_rows = []
+                while pending:
+                    row, future = pending.popleft()
+                    volume = np.asarray(future.result(), dtype=cls.DTYPE)
+
+                    if queued < len(todo):
+                        next_row = todo[queued]
+                        pending.append((next_row, executor.submit(
+                            read_volume, int(experiment_ids[next_row]))))
+                        queued += 1
+
+                    if cls.DATA_KEY not in f:
+                        cls._create(f, experiment_ids, volume.shape,
+                                    compression, chunks, attrs)
+                    elif tuple(f.attrs['shape']) != volume.shape:
+                        raise ValueError(
+                            "volume of experiment %d has shape %s, not %s" %
+                            (experiment_ids[row], volume.shape,
+                             tuple(f.attrs['shape'])))
+
+                    data = f[cls.DATA_KEY]
+                    if data.chunks is None:
+                        data[row] = volume.ravel()
+                        f[cls.COMPLETE_KEY][row] = True
+                        f.flush()
+                        continue
+
+                    # write whole bands of chunk rows at once, so no chunk
+                    # is compressed more than once
+                    band_height = data.chunks[0]
+                    if band is not None and row // band_height != band:
+                        cls._write_band(f, band, band_rows, band_height)
+                        band_rows = []
+                    band = row // band_height
+                    band_rows.append((row, volume.ravel()))
+
+                if band_rows:
+                    cls._write_band(f, band, band_rows,
+                                    f[cls.DATA_KEY].chunks[0])
+
+        _log.info("Stacked %d volumes in %s", len(todo), path)
+        return cls(path)
+
+    @classmethod
+    def _resumable(cls, path, experiment_ids, compression, overwrite):
+        ''' The completed rows of an existing stack of the same experiments,
+        or None after removing a stack that can not be resumed.  Files that
+        are not readable stacks (e.g. cut short while being created) are
+        always replaced; other stacks only if overwrite is set.
+        '''
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with h5py.File(path, 'r') as f:
+                if cls.DATA_KEY in f:
+                    if np.array_equal(f[cls.EXPERIMENT_IDS_KEY][:],
+                                      experiment_ids) and \
+                            f[cls.DATA_KEY].compression == compression:
+                        return f[cls.COMPLETE_KEY][:]
+                    if not overwrite:
+                        raise ValueError(
+                            "%s holds a stack of other experiments or "
+                            "compression; pass overwrite=True to replace it"
+                            % path)
+        except (IOError, OSError, KeyError):
+            pass
+
+        _log.info("Replacing volume stack %s", path)
+        os.remove(path)
+        return None
+
+    @classmethod
+    def _create(cls, f, experiment_ids, shape, compression, chunks, attrs):
+        n_voxels = int(np.prod(shape))
+        n_rows = len(experiment_ids)
+
+        if compression is None:
+            chunks = None
+        elif chunks is None:
+            chunks = (min(n_rows, cls.CHUNK_ROWS),
+                      min(n_voxels, cls.CHUNK_VOXELS))
+
+        f.create_dataset(cls.DATA_KEY, shape=(n_rows, n_voxels),
+                         dtype=cls.DTYPE, chunks=chunks,
+                         compression=compression)
+        f.create_dataset(cls.EXPERIMENT_IDS_KEY, data=experiment_ids)
+        f.create_dataset(cls.COMPLETE_KEY, shape=(n_rows,), dtype=bool)
+
+        for key, value in (attrs or {}).items():
+            f.attrs[key] = value
+        f.attrs['shape'] = np.array(shape, dtype=np.int64)
+
+    @classmethod
+    def _write_band(cls, f, band, band_rows, band_height):
+        data = f[cls.DATA_KEY]
+        lo = band * band_height
+        hi = min(lo + band_height, data.shape[0])
+
+        rows = [row for row, _ in band_rows]
+        if rows == list(range(lo, hi)):
+            data[lo:hi] = np.stack([volume for _, volume in band_rows])
+        else:
+            # resuming a partly written band
+            for row, volume in band_rows:
+                data[row] = volume
+
+        complete = f[cls.COMPLETE_KEY]
+        for row in rows:
+            complete[row] = True
+        f.flush()
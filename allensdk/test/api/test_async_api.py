@@ -0,0 +1,111 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import threading
+import time
+
+import pytest
+from mock import patch
+
+asyncio = pytest.importorskip('asyncio')
+
+from allensdk.api.async_api import (AsyncApi, AsyncRmaApi,
+                                    AsyncMouseConnectivityApi)
+
+
+_msg = {'success': True, 'id': 0, 'start_row': 0, 'num_rows': 1,
+        'total_rows': 1, 'msg': [{'id': 1}]}
+
+
+def run(make_awaitable):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(make_awaitable())
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@patch('allensdk.core.json_utilities.read_url_get', return_value=_msg)
+def test_model_query_gather(read_url_get):
+    with AsyncRmaApi(max_concurrency=4) as api:
+        results = run(lambda: asyncio.gather(*[
+            api.model_query('Structure', criteria='[id$eq%d]' % i)
+            for i in range(10)]))
+
+    assert results == [_msg['msg']] * 10
+    assert read_url_get.call_count == 10
+    urls = [c[0][0] for c in read_url_get.call_args_list]
+    assert all(any('id$eq%d%%5D' % i in url for url in urls)
+               for i in range(10))
+
+
+@patch('allensdk.core.json_utilities.read_url_get', return_value=_msg)
+def test_service_method(read_url_get):
+    with AsyncMouseConnectivityApi() as api:
+        assert run(lambda: api.get_experiment_detail(5)) == _msg['msg']
+
+    assert 'id$eq5' in read_url_get.call_args[0][0]
+
+
+def test_bounded_concurrency():
+    lock = threading.Lock()
+    state = {'active': 0, 'peak': 0}
+
+    def work(i):
+        with lock:
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+        time.sleep(0.02)
+        with lock:
+            state['active'] -= 1
+        return i
+
+    with AsyncApi(max_concurrency=3) as api:
+        results = run(lambda: asyncio.gather(*[api.submit(work, i)
+                                               for i in range(12)]))
+
+    assert results == list(range(12))
+    assert state['peak'] == 3
+
+
+def test_errors_propagate():
+    def fail():
+        raise ValueError('nope')
+
+    with AsyncApi() as api:
+        with pytest.raises(ValueError):
+            run(lambda: api.submit(fail))
@@ -0,0 +1,93 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import threading
+import time
+
+import pytest
+
+import allensdk.api.bulk_download as bulk_download
+from allensdk.api.bulk_download import DownloadTask, HostLimiter
+
+
+def test_download_all_dedupes_paths(tmpdir_factory):
+    tmpdir = tmpdir_factory.mktemp('bulk')
+    calls = []
+
+    def writer(path):
+        def write():
+            calls.append(path)
+            with open(path, 'w') as f:
+                f.write('abc')
+        return write
+
+    shared = str(tmpdir.join('shared.txt'))
+    tasks = [DownloadTask(1, 'a', shared, writer(shared), 'http://example.org'),
+             DownloadTask(2, 'a', shared, writer(shared), 'http://example.org')]
+
+    statuses = bulk_download.download_all(tasks)
+
+    assert calls == [shared]
+    assert statuses == {1: {'a': 'downloaded'}, 2: {'a': 'downloaded'}}
+
+    statuses = bulk_download.download_all(tasks)
+    assert statuses == {1: {'a': 'cached'}, 2: {'a': 'cached'}}
+
+
+def test_host_limiter():
+    limiter = HostLimiter(max_per_host=2)
+    lock = threading.Lock()
+    active = [0]
+    peak = [0]
+
+    def work():
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+
+    threads = [threading.Thread(target=limiter.run,
+                                args=('http://api.brain-map.org/x', work))
+               for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert peak[0] <= 2
+    assert limiter.semaphore('http://api.brain-map.org/y') is \
+        limiter.semaphore('http://api.brain-map.org/z')
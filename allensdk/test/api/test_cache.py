@@ -189,6 +189,99 @@ def test_memoize():
             fb.f(0), time.time() - t0
 
 
+def test_memoize_per_instance():
+    import gc
+
+    class FooBar(object):
+        calls = 0
+
+        @memoize
+        def f(self, x):
+            FooBar.calls += 1
+            return x
+
+    fb = FooBar()
+    other = FooBar()
+
+    for ii in range(3):
+        assert fb.f(1) == 1
+        assert other.f(1) == 1
+
+    info = FooBar.f.cache_info()
+    assert FooBar.calls == 2
+    assert info.hits == 4
+    assert info.misses == 2
+    assert info.currsize == 2
+
+    del fb
+    gc.collect()
+
+    assert FooBar.f.cache_info().currsize == 1
+
+
+def test_memoize_bounds():
+    @memoize(max_entries=2)
+    def f(x):
+        return x
+
+    for ii in range(4):
+        f(ii)
+
+    info = f.cache_info()
+    assert info.currsize == 2
+    assert info.evictions == 2
+
+    @memoize(max_entries=None, max_bytes=1000)
+    def g(n):
+        return np.zeros(n)
+
+    g(50)
+    g(50)
+    g(100)
+    g(1000)
+
+    info = g.cache_info()
+    assert info.hits == 1
+    assert info.currsize == 1
+    assert info.nbytes == 800
+
+    g.cache_clear()
+    assert g.cache_info() == (0, 0, 0, None, 0, 1000, 0)
+
+
+def test_memoize_functions_key_by_value():
+
+    class Key(object):
+        def __init__(self, value):
+            self.value = value
+
+        def __eq__(self, other):
+            return self.value == other.value
+
+        def __hash__(self):
+            return hash(self.value)
+
+    @memoize
+    def f(key):
+        return key.value
+
+    assert f(Key(1)) == 1
+    assert f(Key(1)) == 1
+
+    info = f.cache_info()
+    assert info.hits == 1
+    assert info.misses == 1
+
+
+def test_memoize_unhashable():
+    @memoize
+    def f(x):
+        return len(x)
+
+    assert f([1, 2]) == 2
+    assert f.cache_info().currsize == 0
+
+
 def test_get_default_manifest_file():
     assert get_default_manifest_file('brain_observatory') == 'brain_observatory/manifest.json'
     assert get_default_manifest_file('cell_types') == 'cell_types/manifest.json'
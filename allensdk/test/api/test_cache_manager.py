@@ -0,0 +1,165 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+import time
+
+import pytest
+
+import allensdk.api.cache_manager as cache_manager
+from allensdk.api.cache import Cache, cacheable
+from allensdk.api.cache_manager import CacheIndex, parse_size
+
+
+class DummyCache(Cache):
+    MANIFEST_VERSION = None
+
+
+def write_file(path, nbytes):
+    with open(path, 'wb') as f:
+        f.write(b'x' * nbytes)
+
+
+@pytest.fixture
+def cache_dir(tmpdir_factory):
+    return str(tmpdir_factory.mktemp('cache_manager'))
+
+
+def test_parse_size():
+    assert parse_size('10') == 10
+    assert parse_size('2K') == 2048
+    assert parse_size('1.5GB') == int(1.5 * 2**30)
+
+    with pytest.raises(ValueError):
+        parse_size('lots')
+
+
+def test_prune_lru(cache_dir):
+    index = CacheIndex(cache_dir)
+
+    paths = [os.path.join(cache_dir, '%d.dat' % i) for i in range(4)]
+    for path in paths:
+        write_file(path, 100)
+        index.record_access(path)
+        time.sleep(0.01)
+
+    index.pin(paths[0])
+    index.record_access(paths[1])
+
+    removed = index.prune(quota=250)
+
+    assert removed == [paths[2], paths[3]]
+    assert os.path.exists(paths[0])
+    assert os.path.exists(paths[1])
+    assert index.usage()['total_bytes'] == 200
+
+
+def test_validators_evicted_with_file(cache_dir):
+    index = CacheIndex(cache_dir)
+
+    path = os.path.join(cache_dir, 'data.dat')
+    write_file(path, 100)
+    write_file(path + '.validators.json', 10)
+
+    index.scan()
+    assert index.usage()['file_count'] == 1
+
+    assert index.prune(quota=50) == [path]
+    assert not os.path.exists(path + '.validators.json')
+
+
+def test_prune_lfu(cache_dir):
+    index = CacheIndex(cache_dir, policy='lfu')
+
+    paths = [os.path.join(cache_dir, '%d.dat' % i) for i in range(3)]
+    for count, path in zip([3, 1, 2], paths):
+        write_file(path, 100)
+        for _ in range(count):
+            index.record_access(path)
+
+    assert index.prune(quota=200, dry_run=True) == [paths[1]]
+    assert os.path.exists(paths[1])
+
+
+def test_lease_blocks_eviction(cache_dir):
+    index = CacheIndex(cache_dir, quota=0)
+
+    path = os.path.join(cache_dir, 'leased.dat')
+    write_file(path, 100)
+    index.scan()
+
+    with index.lease(path):
+        assert index.prune() == []
+
+    assert index.prune() == [path]
+
+
+def test_cacher_enforces_quota(cache_dir):
+    manifest_file = os.path.join(cache_dir, 'manifest.json')
+    cache = DummyCache(manifest=manifest_file)
+    cache.set_cache_quota(250)
+
+    @cacheable()
+    def make_file(n, file_name):
+        write_file(file_name, n)
+
+    try:
+        for i in range(3):
+            path = os.path.join(cache_dir, 'files', '%d.dat' % i)
+            make_file(100, path, path=path, strategy='lazy')
+            time.sleep(0.01)
+
+        assert not os.path.exists(os.path.join(cache_dir, 'files', '0.dat'))
+        assert os.path.exists(os.path.join(cache_dir, 'files', '2.dat'))
+        assert os.path.exists(manifest_file)
+        assert cache.cache_usage()['quota'] == 250
+
+        # a second cache on the same directory picks the quota up
+        assert DummyCache(manifest=manifest_file).cache_index.quota == 250
+    finally:
+        cache_manager.unregister(cache.cache_index)
+
+
+def test_main(cache_dir, capsys):
+    manifest_file = os.path.join(cache_dir, 'manifest.json')
+    write_file(manifest_file, 10)
+    write_file(os.path.join(cache_dir, 'a.dat'), 100)
+
+    assert cache_manager.main(['usage', manifest_file]) == 0
+    assert '110B in 2 files' in capsys.readouterr()[0]
+
+    assert cache_manager.main(['prune', manifest_file, '--quota', '50']) == 0
+    assert not os.path.exists(os.path.join(cache_dir, 'a.dat'))
+    assert os.path.exists(manifest_file)
@@ -34,7 +34,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 import pytest
-from mock import MagicMock
+import os
+from mock import MagicMock, patch
 import numpy as np
 from allensdk.api.queries.image_download_api import ImageDownloadApi
 
@@ -609,3 +610,105 @@ def test_section_image_query(image_api):
 
     image_api.section_image_query(70813257)
     image_api.json_msg_query.assert_called_once_with(exp)
+
+
+def fake_image(width, height):
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[:, :, 0] = (np.arange(height) // 10 * 10 % 250)[:, None]
+    image[:, :, 1] = (np.arange(width) // 10 * 10 % 250)[None, :]
+    return image
+
+
+def serve_tiles(image, failures=0):
+    from PIL import Image
+    from six.moves.urllib.parse import urlparse, parse_qs
+
+    calls = []
+
+    def retrieve(url, file_path):
+        calls.append(url)
+        if len(calls) <= failures:
+            raise IOError('connection reset')
+
+        query = dict((k, int(v[0])) for k, v in
+                     parse_qs(urlparse(url).query).items()
+                     if k != 'downsample_dimensions')
+        tile = image[query['top']:query['top'] + query['height'],
+                     query['left']:query['left'] + query['width']]
+        Image.fromarray(tile).save(file_path, format='JPEG', quality=100)
+
+    return retrieve, calls
+
+
+def test_download_image_tiled(image_api, tmpdir_factory):
+    image = fake_image(50, 35)
+    image_api.retrieve_file_over_http.side_effect, calls = \
+        serve_tiles(image, failures=1)
+
+    path = str(tmpdir_factory.mktemp('tiled').join('1.npy'))
+
+    with patch('time.sleep'):
+        image_api.download_image_tiled(1, path, width=50, height=35,
+                                       top=0, left=0, tile_size=16,
+                                       max_workers=3)
+
+    stitched = np.load(path, mmap_mode='r')
+    assert stitched.shape == (35, 50, 3)
+    assert np.abs(stitched.astype(int) - image).max() <= 8
+    # 4 x 3 tiles plus one retry
+    assert len(calls) == 13
+    assert not os.path.exists(path + '.tiles')
+
+
+def test_download_image_tiled_removes_tile_dir(image_api, tmpdir_factory):
+    image = fake_image(32, 32)
+    retrieve, calls = serve_tiles(image)
+
+    def retrieve_with_validators(url, file_path):
+        retrieve(url, file_path)
+        with open(file_path + '.validators.json', 'w') as f:
+            f.write('{}')
+
+    image_api.retrieve_file_over_http.side_effect = retrieve_with_validators
+
+    path = str(tmpdir_factory.mktemp('tiled').join('1.npy'))
+    image_api.download_image_tiled(1, path, width=32, height=32, top=0,
+                                   left=0, tile_size=16)
+
+    assert len(calls) == 4
+    assert not os.path.exists(path + '.tiles')
+
+
+def test_download_image_tiled_resume(image_api, tmpdir_factory):
+    image = fake_image(32, 32)
+    image_api.retrieve_file_over_http.side_effect, calls = \
+        serve_tiles(image)
+
+    path = str(tmpdir_factory.mktemp('tiled').join('1.npy'))
+    tile_dir = path + '.tiles'
+    os.makedirs(tile_dir)
+    calls_before = serve_tiles(image)[0]
+    calls_before('http://x/1?top=0&left=0&width=16&height=16',
+                 os.path.join(tile_dir, '0_0.jpg'))
+
+    image_api.download_image_tiled(1, path, width=32, height=32, top=0,
+                                   left=0, tile_size=16, keep_tiles=True)
+
+    assert len(calls) == 3
+    assert sorted(os.listdir(tile_dir)) == \
+        ['0_0.jpg', '0_16.jpg', '16_0.jpg', '16_16.jpg']
+
+
+def test_download_section_images_tiled(image_api, tmpdir_factory):
+    image_api.section_image_query = MagicMock(return_value=[
+        {'id': 5, 'x': 0, 'y': 0, 'width': 64, 'height': 32}])
+    image_api.download_image_tiled = MagicMock()
+
+    directory = str(tmpdir_factory.mktemp('section_images'))
+    paths = image_api.download_section_images_tiled(10, directory,
+                                                    downsample=1)
+
+    assert paths == {5: os.path.join(directory, '5.npy')}
+    image_api.download_image_tiled.assert_called_once_with(
+        5, paths[5], width=32, height=16, top=0, left=0, downsample=1,
+        output='memmap')
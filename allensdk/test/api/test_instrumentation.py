@@ -0,0 +1,149 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import json
+
+import pytest
+
+import allensdk.api.instrumentation as instrumentation
+from allensdk.api.cache import cacheable
+from allensdk.api.queries.rma_api import RmaApi
+from allensdk.api.replay_server import ReplayServer, ResponseArchive
+
+
+_msg = {'success': True, 'id': 0, 'start_row': 0, 'num_rows': 1,
+        'total_rows': 1, 'msg': [{'id': 997}]}
+
+
+@pytest.fixture
+def server(tmpdir_factory):
+    archive_dir = str(tmpdir_factory.mktemp('instrumentation_archive'))
+    with ReplayServer(archive_dir) as replay:
+        replay.archive.put(ResponseArchive.key('GET', '/data/123/file.txt'),
+                           200, {'Content-Type': 'text/plain'}, b'x' * 100)
+        yield replay
+
+
+class DummyApi(RmaApi):
+    @cacheable(reader=lambda p: json.load(open(p)),
+               writer=lambda p, d: json.dump(d, open(p, 'w')))
+    def get_structure(self):
+        return self.model_query('Structure', criteria='[id$eq997]')
+
+
+def test_endpoint():
+    assert instrumentation.endpoint('http://a.org/x/12/y/345?q=1') == \
+        'a.org/x/{id}/y/{id}'
+    assert instrumentation.cache_endpoint('/tmp/experiment_12/data.nwb') == \
+        'data.nwb'
+
+
+def test_collect(server, tmpdir_factory):
+    key = ResponseArchive.key('GET', RmaApi().build_query_url(
+        RmaApi().model_stage('Structure', criteria='[id$eq997]')))
+    server.archive.put(key, 200, {'Content-Type': 'application/json'},
+                       json.dumps(_msg).encode('utf-8'))
+
+    api = DummyApi(server.url)
+    path = str(tmpdir_factory.mktemp('instrumentation').join('structure.json'))
+    file_path = path + '.txt'
+
+    with instrumentation.collect() as report:
+        api.get_structure(path=path)
+        api.get_structure(path=path)
+        api.retrieve_file_over_http(server.url + '/data/123/file.txt',
+                                    file_path)
+
+    kinds = [(e.kind, e.method, e.outcome) for e in report.events]
+    assert kinds == [
+        ('request', 'DummyApi.get_structure', 'ok'),
+        ('cache', 'DummyApi.get_structure', 'miss'),
+        ('cache', 'DummyApi.get_structure', 'hit'),
+        ('download', 'stream_file_over_http', 'ok')]
+
+    request = report.events[0]
+    assert request.nbytes == len(json.dumps(_msg))
+    assert 0 < request.parse_time <= request.elapsed
+
+    totals = report.totals()
+    assert totals['cache']['hits'] == 1
+    assert totals['cache']['misses'] == 1
+    assert totals['download']['nbytes'] == 100
+
+    summary = report.summary()
+    assert ('download', 'stream_file_over_http',
+            server.url.split('//')[1] + '/data/{id}/file.txt') in summary.index
+    assert 'DummyApi.get_structure' in str(report)
+
+
+def test_hooks_and_errors():
+    events = []
+    registry = instrumentation.MetricsRegistry()
+    registry.add_hook(events.append)
+    registry.add_hook(lambda e: 1 / 0)
+
+    event = instrumentation.Event('request', 'm', 'e', 'error', 1.0, 0, 0.0,
+                                  0, 0.0)
+    registry.emit(event)
+    registry.emit(event._replace(outcome='ok', elapsed=3.0))
+
+    assert len(events) == 2
+    row = registry.summary().loc[('request', 'm', 'e')]
+    assert row['count'] == 2
+    assert row['errors'] == 1
+    assert row['max_elapsed'] == 3.0
+    assert row['mean_elapsed'] == 2.0
+
+
+def test_error_outcome():
+    with instrumentation.collect() as report:
+        with pytest.raises(ValueError):
+            with instrumentation.measure('request', 'fn', url='http://a/b'):
+                raise ValueError()
+
+    assert report.events[0].outcome == 'error'
+
+
+def test_retries():
+    with instrumentation.collect() as report:
+        instrumentation.note_retry()
+        instrumentation.note_retry()
+        with instrumentation.measure('download', 'fn', url='http://a/b'):
+            pass
+        with instrumentation.measure('download', 'fn', url='http://a/b'):
+            pass
+
+    assert [e.retries for e in report.events] == [2, 0]
+    assert report.totals()['download']['retries'] == 2
@@ -459,3 +459,39 @@ def test_calculate_injection_centroid(connectivity):
         density, fraction, resolution=25)
     
     assert np.array_equal(centroid, [37.5, 37.5])
+
+
+def test_get_structure_unionizes_chunked(connectivity):
+    with patch.object(MCA, "json_msg_query",
+                      side_effect=lambda url: [{'url': url}]) as mock_query:
+        records = connectivity.get_structure_unionizes(
+            experiment_ids=list(range(10)), chunk_size=4, max_workers=2)
+
+    assert mock_query.call_count == 3
+    assert [r['url'].split('$in')[1].split(']')[0] for r in records] == \
+        ['0,1,2,3', '4,5,6,7', '8,9']
+
+
+def test_get_structure_unionizes_paged(connectivity):
+    pages = [[{'id': 1}, {'id': 2}], [{'id': 3}, {'id': 4}], [{'id': 5}]]
+    connectivity.UNIONIZE_PAGE_SIZE = 2
+
+    with patch.object(MCA, "json_msg_query",
+                      side_effect=pages) as mock_query:
+        records = connectivity.get_structure_unionizes(experiment_ids=[1, 2])
+
+    assert [r['id'] for r in records] == [1, 2, 3, 4, 5]
+    assert mock_query.call_count == 3
+
+    url = mock_query.call_args_list[1][0][0]
+    assert "[order$eqid]" in url
+    assert "[num_rows$eq2][start_row$eq2]" in url
+
+
+def test_in_clause_chunks():
+    from allensdk.api.queries.rma_api import in_clause_chunks
+
+    assert in_clause_chunks([1, 2, 3], max_count=2) == [[1, 2], [3]]
+    assert in_clause_chunks([100, 200, 300], max_length=8) == \
+        [[100, 200], [300]]
+    assert in_clause_chunks([]) == []
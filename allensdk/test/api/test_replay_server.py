@@ -0,0 +1,104 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import json
+import time
+
+import pytest
+import requests
+
+from allensdk.api.queries.rma_api import RmaApi
+from allensdk.api.replay_server import (ReplayServer, ResponseArchive,
+                                        normalize_url)
+
+
+_msg = {'success': True, 'id': 0, 'start_row': 0, 'num_rows': 1,
+        'total_rows': 1, 'msg': [{'id': 997, 'acronym': 'root'}]}
+
+
+@pytest.fixture
+def upstream_archive(tmpdir_factory):
+    archive = ResponseArchive(str(tmpdir_factory.mktemp('upstream')))
+    url = RmaApi().build_query_url(
+        RmaApi().model_stage('Structure', criteria='[id$eq997]'))
+    archive.put(ResponseArchive.key('GET', url), 200,
+                {'Content-Type': 'application/json', 'ETag': '"abc"'},
+                json.dumps(_msg).encode('utf-8'))
+    return archive
+
+
+def test_normalize_url():
+    assert normalize_url('http://a.org/x%5By%5D?b=2&a=1') == '/x[y]?a=1&b=2'
+    assert normalize_url('http://b.org/x[y]?a=1&b=2') == '/x[y]?a=1&b=2'
+
+
+def test_record_and_replay(tmpdir_factory, upstream_archive):
+    archive_dir = str(tmpdir_factory.mktemp('recorded'))
+
+    with ReplayServer(upstream_archive.directory) as upstream:
+        with ReplayServer(archive_dir, mode='record',
+                          upstream=upstream.url) as recorder:
+            rma = RmaApi(recorder.url)
+            assert rma.model_query('Structure', criteria='[id$eq997]') == \
+                _msg['msg']
+
+    assert len(ResponseArchive(archive_dir)) == 1
+
+    with ReplayServer(archive_dir, latency=0.05) as replay:
+        rma = RmaApi(replay.url)
+
+        start = time.time()
+        assert rma.model_query('Structure', criteria='[id$eq997]') == \
+            _msg['msg']
+        assert time.time() - start >= 0.05
+
+        response = requests.get(replay.url + '/api/v2/data/query.json?q=x')
+        assert response.status_code == 404
+
+
+def test_conditional_and_bandwidth(upstream_archive):
+    key = list(upstream_archive.index.keys())[0]
+    path = key.split(' ')[1]
+
+    with ReplayServer(upstream_archive.directory, bandwidth=1000) as replay:
+        start = time.time()
+        response = requests.get(replay.url + path)
+        assert response.json() == _msg
+        assert time.time() - start >= 0.05
+
+        response = requests.get(replay.url + path,
+                                headers={'If-None-Match': '"abc"'})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == '"abc"'
@@ -0,0 +1,126 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import threading
+import time
+
+import pytest
+from mock import patch
+
+from allensdk.api.queries.rma_api import RmaApi
+from allensdk.api.response_cache import ResponseCache, response_key
+
+
+_msg = {'success': True, 'msg': [{'id': 1}]}
+
+
+@pytest.fixture
+def response_cache():
+    cache = RmaApi.enable_response_cache(ttl=60)
+    yield cache
+    RmaApi.disable_response_cache()
+
+
+def test_response_key():
+    assert response_key('http://API.org/a%5B1%5D?q=x&b=2') == \
+        response_key('http://api.org/a[1]?b=2&q=x')
+    assert response_key('http://a.org/x') != response_key('http://b.org/x')
+
+
+@patch("allensdk.core.json_utilities.read_url_get",
+       side_effect=lambda url: {'success': True, 'msg': [{'id': 1}]})
+def test_rma_response_cache(read_url_get, response_cache):
+    for _ in range(3):
+        data = RmaApi().model_query('Structure', criteria='[id$eq1]')
+        assert data == [{'id': 1}]
+        data[0]['id'] = 2
+
+    assert read_url_get.call_count == 1
+    assert response_cache.info()['hits'] == 2
+
+
+@patch("allensdk.core.json_utilities.read_url_get",
+       return_value={'success': False, 'msg': 'bad query'})
+def test_rma_response_cache_skips_errors(read_url_get, response_cache):
+    for _ in range(2):
+        RmaApi().model_query('Structure', criteria='[id$eq1]')
+
+    assert read_url_get.call_count == 2
+
+
+def test_ttl():
+    cache = ResponseCache(ttl=0.05)
+    cache.put('http://a.org/x', {'a': 1})
+
+    assert cache.get('http://a.org/x') == {'a': 1}
+    time.sleep(0.1)
+    assert cache.get('http://a.org/x') is None
+
+
+def test_sqlite_store(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('responses').join('responses.sqlite'))
+
+    ResponseCache(path=path).put('http://a.org/x', [1, 2])
+
+    assert ResponseCache(path=path).get('http://a.org/x') == [1, 2]
+
+
+def test_coalescing():
+    cache = ResponseCache()
+    calls = []
+    started = threading.Event()
+
+    def slow():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return {'a': 1}
+
+    results = []
+
+    def fetch():
+        results.append(cache.fetch('http://a.org/x', slow))
+
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    for t in threads[1:]:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [{'a': 1}] * 4
+    assert cache.info()['coalesced'] == 3
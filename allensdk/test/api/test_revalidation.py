@@ -0,0 +1,136 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+
+import pytest
+
+import allensdk.api.revalidation as revalidation
+from allensdk.api.api import Api
+from allensdk.api.cache import Cache
+from allensdk.api.replay_server import ReplayServer, ResponseArchive
+
+
+class DummyCache(Cache):
+    MANIFEST_VERSION = None
+
+
+def serve(archive, path, body, etag):
+    archive.put(ResponseArchive.key('GET', path), 200,
+                {'Content-Type': 'text/plain', 'ETag': etag}, body)
+
+
+@pytest.fixture
+def server(tmpdir_factory):
+    archive_dir = str(tmpdir_factory.mktemp('revalidation_archive'))
+    with ReplayServer(archive_dir) as replay:
+        serve(replay.archive, '/data/file.txt', b'one', '"v1"')
+        yield replay
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_revalidate_strategy(server, tmpdir_factory):
+    url = server.url + '/data/file.txt'
+    path = str(tmpdir_factory.mktemp('revalidate').join('file.txt'))
+
+    def download():
+        Cache.cacher(Api().retrieve_file_over_http, url, path,
+                     path=path, strategy='revalidate')
+
+    download()
+    assert read(path) == b'one'
+    assert revalidation.read_validators(path) == \
+        {'url': url, 'etag': '"v1"', 'last_modified': None}
+
+    # a 304 leaves the local copy alone
+    with open(path, 'wb') as f:
+        f.write(b'local')
+    download()
+    assert read(path) == b'local'
+
+    serve(server.archive, '/data/file.txt', b'two', '"v2"')
+    download()
+    assert read(path) == b'two'
+    assert revalidation.read_validators(path)['etag'] == '"v2"'
+
+
+def test_lazy_download_stores_no_validators(server, tmpdir_factory):
+    url = server.url + '/data/file.txt'
+    path = str(tmpdir_factory.mktemp('lazy').join('file.txt'))
+
+    Cache.cacher(Api().retrieve_file_over_http, url, path,
+                 path=path, strategy='lazy')
+
+    assert read(path) == b'one'
+    assert not os.path.exists(revalidation.validators_path(path))
+
+
+def test_cache_revalidate(server, tmpdir_factory):
+    cache_dir = str(tmpdir_factory.mktemp('revalidate_manifest'))
+    cache = DummyCache(manifest=os.path.join(cache_dir, 'manifest.json'))
+
+    paths = {}
+    for name in ['a', 'b', 'gone']:
+        serve(server.archive, '/data/%s.txt' % name, b'old', '"1"')
+        paths[name] = os.path.join(cache_dir, '%s.txt' % name)
+        Cache.cacher(Api().retrieve_file_over_http,
+                     server.url + '/data/%s.txt' % name, paths[name],
+                     path=paths[name], strategy='revalidate')
+
+    serve(server.archive, '/data/b.txt', b'new', '"2"')
+    server.archive.index.pop(ResponseArchive.key('GET', '/data/gone.txt'))
+
+    statuses = cache.revalidate(max_workers=2)
+
+    assert statuses == {paths['a']: revalidation.UNCHANGED,
+                        paths['b']: revalidation.UPDATED,
+                        paths['gone']: revalidation.FAILED}
+    assert read(paths['b']) == b'new'
+    assert read(paths['gone']) == b'old'
+    assert not os.path.exists(paths['gone'] + '.partial')
+
+
+def test_find_validated_files_removes_orphans(tmpdir_factory):
+    cache_dir = str(tmpdir_factory.mktemp('orphans'))
+    path = os.path.join(cache_dir, 'file.txt')
+    revalidation.write_validators(path, 'http://example.com/file.txt',
+                                  {'ETag': '"1"'})
+
+    assert revalidation.find_validated_files(cache_dir) == []
+    assert not os.path.exists(revalidation.validators_path(path))
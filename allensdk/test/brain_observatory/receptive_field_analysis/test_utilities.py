@@ -0,0 +1,75 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import gc
+import weakref
+
+import mock
+import numpy as np
+import pandas as pd
+
+from allensdk.brain_observatory.receptive_field_analysis import utilities
+
+
+class DataSet(object):
+
+    def get_stimulus_table(self, stimulus):
+        return pd.DataFrame({'frame': [1, 0, 1]})
+
+    def get_stimulus_template(self, stimulus):
+        template = np.zeros((2, 4, 5), dtype=np.uint8)
+        template[0, 1, 2] = 255
+        return template
+
+
+def test_get_A_blur_releases_data_set():
+
+    data = DataSet()
+    data_ref = weakref.ref(data)
+
+    # the blur itself is beside the point
+    with mock.patch.object(utilities, 'convolve', side_effect=lambda x: x):
+        A = utilities.get_A_blur(data, 'locally_sparse_noise')
+        again = utilities.get_A_blur(data, 'locally_sparse_noise')
+
+    assert A.shape == (40, 3)
+    assert again is A
+
+    del data
+    gc.collect()
+
+    assert data_ref() is None
+    assert utilities.get_A_blur.cache_info().currsize == 0
+    assert utilities.get_A.cache_info().currsize == 0
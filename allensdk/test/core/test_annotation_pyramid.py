@@ -0,0 +1,138 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+
+import mock
+import numpy as np
+import pytest
+from scipy.ndimage import zoom
+
+from allensdk.core.annotation_pyramid import (mode_downsample, level_shape,
+                                              AnnotationPyramid)
+
+
+def brute_force(volume, factor):
+    shape = level_shape(volume.shape, [factor] * 3)
+    out = np.zeros(shape, dtype=volume.dtype)
+    index = [np.minimum(np.floor(np.arange(n) / factor).astype(int), t - 1)
+             for n, t in zip(volume.shape, shape)]
+    for coarse in np.ndindex(*shape):
+        labels = volume[np.ix_(*[np.flatnonzero(ii == c)
+                                 for ii, c in zip(index, coarse)])]
+        ids, counts = np.unique(labels, return_counts=True)
+        out[coarse] = ids[np.argmax(counts)]
+    return out
+
+
+@pytest.fixture
+def volume():
+    return np.random.RandomState(4).choice(
+        [0, 5, 7, 1000000], size=(23, 10, 9),
+        p=[0.4, 0.3, 0.2, 0.1]).astype(np.uint32)
+
+
+@pytest.mark.parametrize('block_planes', [1, 3, 16, 100])
+def test_mode_downsample(volume, block_planes):
+    factors = [2, 2.5, 4]
+    obtained = mode_downsample(volume, factors, block_planes=block_planes)
+
+    for factor, level in zip(factors, obtained):
+        assert level.dtype == volume.dtype
+        assert np.array_equal(level, brute_force(volume, factor))
+
+
+def test_mode_downsample_fortran(volume):
+    obtained = mode_downsample(np.asfortranarray(volume), [2, 4],
+                               block_planes=2)
+
+    for factor, level in zip([2, 4], obtained):
+        assert np.array_equal(level, brute_force(volume, factor))
+
+
+def test_small_structure_survives():
+    volume = np.zeros((8, 8, 8), dtype=np.uint16)
+    volume[4:6, 4:6, 4:6] = 9
+
+    assert not (zoom(volume, 0.25, order=0) == 9).any()
+    assert (mode_downsample(volume, [4])[0] == 0).all()
+    assert (mode_downsample(volume, [2])[0] == 9).sum() == 1
+
+
+def test_pyramid(tmpdir_factory, volume):
+    directory = str(tmpdir_factory.mktemp('pyramid').join('levels'))
+    pyramid = AnnotationPyramid(directory)
+    assert pyramid.resolutions() == []
+
+    pyramid.build(volume, 10, [20, 40], block_planes=4)
+    assert pyramid.resolutions() == [20, 40]
+    assert not [n for n in os.listdir(directory) if n.endswith('.partial')]
+
+    level = pyramid.get_level(40)
+    assert isinstance(level, np.memmap)
+    assert np.array_equal(level, brute_force(volume, 4))
+
+    assert pyramid.coarsest(30) == 20
+    assert pyramid.coarsest(100) == 40
+    assert pyramid.coarsest(5) is None
+
+    with pytest.raises(KeyError):
+        pyramid.get_level(50)
+
+    # levels of a fortran ordered annotation keep its order
+    fortran = AnnotationPyramid(directory, prefix='fortran')
+    fortran.build(np.asfortranarray(volume), 10, [20], block_planes=4)
+    level = fortran.get_level(20)
+    assert level.flags.f_contiguous
+    assert np.array_equal(level, pyramid.get_level(20))
+    with pytest.raises(ValueError):
+        pyramid.build(volume, 10, [5])
+
+
+def test_pyramid_build_failure(tmpdir_factory, volume):
+    directory = str(tmpdir_factory.mktemp('pyramid'))
+    pyramid = AnnotationPyramid(directory)
+
+    # concurrent builds write to files of their own
+    assert pyramid._partial_path(20) != pyramid._partial_path(20)
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+
+    # an interrupted build leaves no partial levels behind
+    with mock.patch('allensdk.core.annotation_pyramid.mode_downsample',
+                    side_effect=IOError('disk full')):
+        with pytest.raises(IOError):
+            pyramid.build(volume, 10, [20, 40])
+    assert os.listdir(directory) == []
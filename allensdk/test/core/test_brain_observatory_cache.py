@@ -39,6 +39,7 @@ import numpy as np
 from mock import patch, mock_open, MagicMock
 from allensdk.core.brain_observatory_cache import BrainObservatoryCache
 from allensdk.api.queries.brain_observatory_api import BrainObservatoryApi
+from allensdk.config.manifest import Manifest
 import json
 import allensdk.brain_observatory.stimulus_info as si
 from allensdk.test_utilities.regression_fixture import get_list_of_path_dict
@@ -340,3 +341,40 @@ def test_brain_observatory_cache_get_events_data(brain_observatory_cache, events
     events = brain_observatory_cache.get_ophys_experiment_events(eid)
     true_events = np.load(data_file, allow_pickle=False)["ev"]
     assert(np.all(events == true_events))
+
+
+def test_prefetch(tmpdir_factory):
+    manifest_file = str(tmpdir_factory.mktemp("boc").join("manifest.json"))
+    boc = BrainObservatoryCache(manifest_file=manifest_file)
+
+    def save(experiment_id, file_name, strategy=None):
+        if experiment_id == 3:
+            raise IOError("no such file")
+        Manifest.safe_make_parent_dirs(file_name)
+        with open(file_name, 'w') as f:
+            f.write('x' * experiment_id)
+
+    existing = boc.get_cache_path(None, boc.EVENTS_DATA_KEY, 1)
+    os.makedirs(os.path.dirname(existing))
+    open(existing, 'w').close()
+
+    reports = []
+    with patch.object(boc.api, "save_ophys_experiment_data", side_effect=save) as data, \
+            patch.object(boc.api, "save_ophys_experiment_event_data", side_effect=save) as events:
+        statuses = boc.prefetch([1, 2, 1, 3],
+                                kinds=['data', 'events'],
+                                max_workers=2,
+                                progress=reports.append)
+
+    assert list(statuses.keys()) == [1, 2, 3]
+    assert statuses[1] == {'data': 'downloaded', 'events': 'cached'}
+    assert statuses[2] == {'data': 'downloaded', 'events': 'downloaded'}
+    assert statuses[3] == {'data': 'failed', 'events': 'failed'}
+    assert data.call_count == 3
+    assert events.call_count == 2
+    assert len(reports) == 5
+    assert reports[-1].bytes == 5
+    assert reports[-1].failed == 2
+
+    with pytest.raises(ValueError):
+        boc.prefetch([1], kinds=['nwb'])
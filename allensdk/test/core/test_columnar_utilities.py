@@ -0,0 +1,122 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import pytest
+import pandas as pd
+import allensdk.core.columnar_utilities as columnar
+import allensdk.core.json_utilities as ju
+from allensdk.api.cache import Cache
+
+try:
+    import pyarrow
+    extensions = ['.h5', '.parquet', '.feather']
+except ImportError:
+    extensions = ['.h5']
+
+
+@pytest.fixture
+def records():
+    return [{'cell_specimen_id': i,
+             'osi_dg': None if i % 3 == 0 else i * 0.5,
+             'failed_experiment_container': None if i == 2 else i % 2 == 0,
+             'area': None if i == 1 else 'VISp',
+             'p_dg': None if i == 4 else i,
+             'tags': [1, 2] if i == 0 else None}
+            for i in range(10)]
+
+
+@pytest.mark.parametrize('extension', extensions)
+def test_round_trip(tmpdir_factory, records, extension):
+    path = str(tmpdir_factory.mktemp('columnar').join('data' + extension))
+
+    columnar.write(path, records)
+
+    assert columnar.read_records(path) == records
+
+
+@pytest.mark.parametrize('extension', extensions)
+def test_read_filters(tmpdir_factory, records, extension):
+    path = str(tmpdir_factory.mktemp('columnar').join('data' + extension))
+    columnar.write(path, records)
+
+    filters = [{'field': 'osi_dg', 'op': 'between', 'value': [1, 3]},
+               {'field': 'area', 'op': '=', 'value': 'VISp'},
+               {'field': 'cell_specimen_id', 'op': 'in', 'value': [2, 5, 8]}]
+
+    data = columnar.read(path, filters=filters, drop_columns=['tags', 'area'])
+
+    assert list(data['cell_specimen_id']) == [2, 5]
+    assert list(data.columns) == ['cell_specimen_id', 'osi_dg',
+                                  'failed_experiment_container', 'p_dg']
+
+
+def test_read_columns(tmpdir_factory, records):
+    path = str(tmpdir_factory.mktemp('columnar').join('data.h5'))
+    columnar.write(path, records)
+
+    data = columnar.read(path,
+                         columns=['cell_specimen_id'],
+                         filters=[{'field': 'failed_experiment_container',
+                                   'op': 'is',
+                                   'value': True}])
+
+    assert list(data.columns) == ['cell_specimen_id']
+    assert list(data['cell_specimen_id']) == [0, 4, 6, 8]
+
+
+def test_filter_mask():
+    df = pd.DataFrame({'a': [1, 2, 3, None]})
+
+    mask = columnar.filter_mask(df, [{'field': 'a', 'op': '>=', 'value': 2}])
+
+    assert list(mask) == [False, True, True, False]
+
+    with pytest.raises(ValueError):
+        columnar.filter_mask(df, [{'field': 'a', 'op': '~', 'value': 2}])
+
+
+def test_migrate_to_columnar(tmpdir_factory, records):
+    tmpdir = tmpdir_factory.mktemp('columnar')
+    json_path = str(tmpdir.join('cell_specimens.json'))
+    path = columnar.columnar_path(json_path)
+    ju.write(json_path, records)
+
+    assert Cache.migrate_to_columnar(json_path, path)
+    assert not Cache.migrate_to_columnar(json_path, path)
+
+    data = Cache.cache_columnar_json(drop_columns=['tags'])['reader'](path)
+
+    assert len(data) == len(records)
+    assert 'tags' not in data[0]
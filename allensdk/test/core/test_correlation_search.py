@@ -0,0 +1,125 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+import pytest
+
+from allensdk.core.correlation_search import CorrelationSearch
+from allensdk.core.volume_stack import VolumeStack
+
+
+@pytest.fixture
+def vectors():
+    return np.random.RandomState(3).rand(10, 50)
+
+
+@pytest.fixture
+def search(vectors):
+    CorrelationSearch.BLOCK_SIZE, block_size = 3, CorrelationSearch.BLOCK_SIZE
+    yield CorrelationSearch(vectors.copy(), range(100, 110),
+                            metadata={101: {'structure-abbrev': 'VISp'}})
+    CorrelationSearch.BLOCK_SIZE = block_size
+
+
+def test_correlations(search, vectors):
+    expected = np.corrcoef(vectors)
+
+    obtained = search.correlations(range(100, 110))
+    assert obtained.dtype == np.float32
+    assert np.allclose(obtained, expected, atol=1e-5)
+
+    obtained = search.correlations([104], experiment_ids=[109, 100])
+    assert np.allclose(obtained, expected[[4]][:, [9, 0]], atol=1e-5)
+
+    with pytest.raises(KeyError):
+        search.correlations([7])
+
+
+def test_search(search, vectors):
+    expected = np.corrcoef(vectors)[1]
+    expected_order = np.argsort(-expected, kind='mergesort') + 100
+
+    obtained = search.search(101)
+    assert [record['id'] for record in obtained] == list(expected_order)
+    assert obtained[0] == {'id': 101, 'r': pytest.approx(1.0),
+                           'structure-abbrev': 'VISp'}
+
+    page = search.search(101, num_rows=3, start_row=2)
+    assert [record['id'] for record in page] == list(expected_order[2:5])
+    assert search.search(101, start_row=20) == []
+
+
+def test_search_many(search):
+    obtained = search.search([100, 105, 109, 101], num_rows=4)
+
+    assert set(obtained) == {100, 101, 105, 109}
+    for seed, records in obtained.items():
+        assert len(records) == 4
+        single = search.search(seed, num_rows=4)
+        assert [r['id'] for r in records] == [r['id'] for r in single]
+        assert np.allclose([r['r'] for r in records],
+                           [r['r'] for r in single], atol=1e-6)
+
+
+def test_constant_vector():
+    vectors = np.ones((2, 5), dtype=np.float32)
+    vectors[1] = np.arange(5)
+    search = CorrelationSearch(vectors, [1, 2])
+    assert np.allclose(search.correlations([1, 2]), [[0, 0], [0, 1]])
+
+
+def test_save_load(tmpdir_factory, search):
+    path = str(tmpdir_factory.mktemp('correlation').join('search.npz'))
+    search.save(path)
+
+    loaded = CorrelationSearch.load(path)
+    assert np.array_equal(loaded.vectors, search.vectors)
+    assert [r['id'] for r in loaded.search(103)] == \
+        [r['id'] for r in search.search(103)]
+
+
+def test_from_volume_stack(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('correlation').join('stack.h5'))
+    rng = np.random.RandomState(5)
+    volumes = dict((eid, rng.rand(4, 3, 2)) for eid in (1, 2, 3))
+    mask = np.zeros((4, 3, 2))
+    mask[1:3] = 1
+
+    with VolumeStack.build(path, [1, 2, 3], volumes.get) as stack:
+        search = CorrelationSearch.from_volume_stack(stack, mask, [3, 1])
+
+    expected = np.corrcoef(volumes[3][mask > 0], volumes[1][mask > 0])[0, 1]
+    assert [r['id'] for r in search.search(3)] == [3, 1]
+    assert search.search(3)[1]['r'] == pytest.approx(expected, abs=1e-5)
@@ -0,0 +1,146 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+import pytest
+
+from allensdk.api.queries.mouse_connectivity_api import MouseConnectivityApi
+from allensdk.core.experiment_index import ExperimentIndex, injection_centroid
+from allensdk.core.structure_tree import StructureTree
+
+
+SHAPE = (6, 5, 4)
+
+
+@pytest.fixture
+def volumes():
+    rng = np.random.RandomState(1)
+    volumes = {}
+    for eid in range(1, 7):
+        density = np.zeros(SHAPE)
+        fraction = np.zeros(SHAPE)
+        x = eid - 1
+        density[x, 1:3, 1:3] = rng.rand(2, 2)
+        fraction[x, 1:3, 1:3] = 1
+        projection = rng.rand(*SHAPE) * 0.2
+        volumes[eid] = (density, fraction, projection)
+    # no injection site
+    volumes[7] = (np.zeros(SHAPE), np.zeros(SHAPE), np.zeros(SHAPE))
+    return volumes
+
+
+@pytest.fixture
+def index(volumes):
+    metadata = {1: {'transgenic_line': 'Cux2', 'injection_structures': [2]},
+                2: {'transgenic_line': None, 'injection_structures': [3]},
+                3: {'transgenic_line': 'Cux2', 'injection_structures': [1]},
+                4: {'transgenic_line': 'Rbp4', 'injection_structures': [2]}}
+    tree = StructureTree([{'id': 1, 'structure_id_path': [1]},
+                          {'id': 2, 'structure_id_path': [1, 2]},
+                          {'id': 3, 'structure_id_path': [1, 3]}])
+
+    return ExperimentIndex.build(sorted(volumes),
+                                 lambda eid: volumes[eid][:2],
+                                 lambda eid: volumes[eid][2],
+                                 resolution=25, metadata=metadata,
+                                 structure_tree=tree, max_workers=2)
+
+
+def test_injection_centroid(volumes):
+    api = MouseConnectivityApi()
+    for density, fraction, _ in volumes.values():
+        expected = api.calculate_injection_centroid(density, fraction, 25)
+        obtained = injection_centroid(density, fraction, 25)
+        if expected is None:
+            assert obtained is None
+        else:
+            assert np.allclose(obtained, expected)
+
+
+def test_nearest_injections(index):
+    obtained = index.nearest_injections([2 * 25, 37, 37])
+
+    assert [r['id'] for r in obtained][:1] == [3]
+    assert set(r['id'] for r in obtained) == set(range(1, 7))
+    assert np.all(np.diff([r['distance'] for r in obtained]) >= 0)
+    assert obtained[0]['transgenic-line'] == 'Cux2'
+    assert len(obtained[0]['injection-coordinates']) == 3
+
+    assert len(index.nearest_injections([0, 0, 0], num_rows=2)) == 2
+
+    obtained = index.nearest_injections([5 * 25, 37, 37],
+                                        transgenic_lines=['Cux2'])
+    assert [r['id'] for r in obtained] == [3, 1]
+
+    obtained = index.nearest_injections([0, 0, 0], transgenic_lines=[0])
+    assert [r['id'] for r in obtained] == [2, 5, 6]
+
+    # 2 and 3 descend from 1
+    obtained = index.nearest_injections([0, 0, 0],
+                                        injection_structures=[1],
+                                        num_rows=3)
+    assert [r['id'] for r in obtained] == [1, 2, 3]
+
+
+def test_projecting_experiments(index, volumes):
+    voxel = (3, 2, 1)
+    obtained = index.projecting_experiments(np.array(voxel) * 25.0)
+
+    expected = sorted((eid for eid in volumes
+                       if volumes[eid][2][voxel] >= 0.1),
+                      key=lambda eid: -volumes[eid][2][voxel])
+    assert [r['id'] for r in obtained] == expected
+    for record in obtained:
+        assert record['density'] == \
+            pytest.approx(volumes[record['id']][2][voxel])
+
+    assert index.projecting_experiments([-100, 0, 0]) == []
+
+    obtained = index.projecting_experiments(np.array(voxel) * 25.0,
+                                            transgenic_lines=['Rbp4'])
+    assert [r['id'] for r in obtained] == [eid for eid in expected
+                                           if eid == 4]
+
+
+def test_save_load(tmpdir_factory, index):
+    path = str(tmpdir_factory.mktemp('index').join('index.npz'))
+    index.save(path)
+
+    loaded = ExperimentIndex.load(path, metadata=index.metadata)
+    assert loaded.shape == SHAPE
+    assert loaded.nearest_injections([50, 50, 50]) == \
+        index.nearest_injections([50, 50, 50])
+    assert loaded.projecting_experiments([25, 25, 25]) == \
+        index.projecting_experiments([25, 25, 25])
@@ -44,6 +44,8 @@ import pandas as pd
 
 from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
 from allensdk.core.structure_tree import StructureTree
+from allensdk.core.reference_space import ReferenceSpace
+from allensdk.config.manifest import Manifest
 
 
 @pytest.fixture
@@ -377,15 +379,53 @@ def test_filter_structure_unionizes(mcc, unionizes):
 
     assert obtained.loc[0, 'volume'] == 0.016032
 
+def test_filter_structure_unionizes_descendants(mcc):
+
+    tree = StructureTree([{'id': 1, 'structure_id_path': [1]},
+                          {'id': 2, 'structure_id_path': [1, 2]},
+                          {'id': 3, 'structure_id_path': [1, 2, 3]},
+                          {'id': 4, 'structure_id_path': [1, 4]}])
+    unionizes = pd.DataFrame({'structure_id': [1, 2, 3, 4, 5, 3]})
+
+    with mock.patch.object(mcc, 'get_structure_tree', return_value=tree):
+        obtained = mcc.filter_structure_unionizes(unionizes, structure_ids=[2],
+                                                  include_descendants=True)
+
+    assert list(obtained['structure_id']) == [2, 3, 3]
+
+
 def test_get_structure_unionizes(mcc, unionizes):
 
     with mock.patch.object(mcc, "get_experiment_structure_unionizes",
-                           new=lambda *a, **k: pd.DataFrame(unionizes)):
+                           new=lambda *a, **k: pd.DataFrame(unionizes)), \
+            mock.patch.object(mcc, "download_structure_unionizes"):
         obtained = mcc.get_structure_unionizes([1, 2, 3])
 
     assert obtained.shape[0] == 6
 
 
+def test_download_structure_unionizes(mcc, unionizes):
+
+    other = dict(unionizes[0], section_data_set_id=2, id=5)
+    records = unionizes + [other]
+
+    with mock.patch.object(mcc.api, "model_query",
+                           return_value=records) as mock_query:
+        obtained = mcc.get_structure_unionizes([166218353, 2, 3])
+
+    # one query for all three experiments
+    assert mock_query.call_count == 1
+    assert obtained.shape[0] == 3
+    assert sorted(obtained['experiment_id'].unique()) == [2, 166218353]
+
+    with mock.patch.object(mcc.api, "model_query") as mock_query:
+        cached = mcc.get_experiment_structure_unionizes(166218353)
+        assert len(mcc.get_experiment_structure_unionizes(3)) == 0
+
+    mock_query.assert_not_called()
+    assert cached.loc[0, 'projection_intensity'] == 263.231
+
+
 def test_get_projection_matrix(mcc):
     # yup
 
@@ -471,3 +511,301 @@ def test_validate_structure_ids(inp, fails):
     else:
         out = MouseConnectivityCache.validate_structure_ids(inp)
         assert( out == [ int(i) for i in inp ] )
+
+
+def test_unionize_store_is_opt_in(mcc, unionizes):
+
+    assert mcc.get_unionize_store() is None
+
+    other = dict(unionizes[0], section_data_set_id=2, id=5)
+    with mock.patch.object(mcc.api, "model_query",
+                           return_value=unionizes + [other]):
+        mcc.get_structure_unionizes([166218353, 2])
+
+    for eid in [166218353, 2]:
+        assert os.path.exists(mcc.get_cache_path(
+            None, mcc.STRUCTURE_UNIONIZES_KEY, eid))
+    assert not os.path.exists(os.path.join(
+        os.path.dirname(mcc.manifest_path), 'structure_unionizes.h5'))
+
+
+def test_download_structure_unionizes_to_store(mcc, unionizes):
+
+    mcc.unionize_store = True
+    other = dict(unionizes[0], section_data_set_id=2, id=5)
+
+    with mock.patch.object(mcc.api, "model_query",
+                           return_value=unionizes + [other]) as mock_query:
+        obtained = mcc.get_structure_unionizes([166218353, 2])
+        again = mcc.get_experiment_structure_unionizes(2)
+
+    assert mock_query.call_count == 1
+    assert obtained.shape[0] == 3
+    assert again['id'].tolist() == [5]
+    assert mcc.get_unionize_store().path == mcc.get_cache_path(
+        None, mcc.STRUCTURE_UNIONIZE_STORE_KEY)
+
+    # stored once, not also as csv files
+    assert not os.path.exists(mcc.get_cache_path(
+        None, mcc.STRUCTURE_UNIONIZES_KEY, 2))
+
+
+def test_get_structure_unionizes_from_store(mcc, unionizes):
+
+    mcc.unionize_store = True
+    eid = 166218353
+
+    with mock.patch.object(mcc.api, "model_query",
+                           new=lambda *args, **kwargs: unionizes):
+        mcc.get_experiment_structure_unionizes(eid)
+
+    # the csv cached above is moved into the store on first use
+    first = mcc.get_structure_unionizes([eid], hemisphere_ids=[2])
+    assert mcc.get_unionize_store().experiment_ids() == {eid}
+
+    with mock.patch.object(mcc, "get_experiment_structure_unionizes") as csv:
+        obtained = mcc.get_structure_unionizes([eid], hemisphere_ids=[2],
+                                               columns=['projection_volume'])
+
+    csv.assert_not_called()
+    assert len(first) == len(obtained) == 1
+    assert obtained['structure_id'].tolist() == [60]
+    assert obtained['projection_volume'].tolist() == [0.00148144]
+    assert 'sum_pixels' in first.columns
+    assert 'sum_pixels' not in obtained.columns
+
+
+def test_get_projection_matrix_sparse(mcc):
+
+    unionizes = pd.DataFrame({'experiment_id': [3, 1, 1, 3, 9],
+                              'structure_id': [2, 2, 5, 5, 2],
+                              'hemisphere_id': [1, 2, 2, 1, 1],
+                              'projection_volume': [1.0, 2.0, 3.0, 4.0, 5.0]})
+
+    class FakeTree(object):
+        def value_map(*a, **k):
+            return {2: 'two', 5: 'five'}
+
+    with mock.patch.object(mcc, "get_structure_unionizes",
+                           new=lambda *a, **k: unionizes), \
+            mock.patch.object(mcc, "get_structure_tree",
+                              new=lambda *a, **k: FakeTree()):
+        dense = mcc.get_projection_matrix([1, 3], [2, 5],
+                                          dtype=np.float32)
+        sparse = mcc.get_projection_matrix([1, 3], [2, 5], sparse=True)
+
+    expected = np.array([[np.nan, np.nan, 2.0, 3.0],
+                         [1.0, 4.0, np.nan, np.nan]])
+
+    assert dense['matrix'].dtype == np.float32
+    assert np.allclose(dense['matrix'], expected, equal_nan=True)
+    assert [c['label'] for c in dense['columns']] == \
+        ['two-L', 'five-L', 'two-R', 'five-R']
+    assert sparse['matrix'].nnz == 4
+    assert np.allclose(sparse['matrix'].toarray(), np.nan_to_num(expected))
+
+
+def test_get_projection_matrix_repeated_unionizes(mcc):
+
+    unionizes = pd.DataFrame({'experiment_id': [1, 1],
+                              'structure_id': [2, 2],
+                              'hemisphere_id': [1, 1],
+                              'projection_volume': [2.0, 7.0]})
+
+    class FakeTree(object):
+        def value_map(*a, **k):
+            return {2: 'two'}
+
+    with mock.patch.object(mcc, "get_structure_unionizes",
+                           new=lambda *a, **k: unionizes), \
+            mock.patch.object(mcc, "get_structure_tree",
+                              new=lambda *a, **k: FakeTree()):
+        dense = mcc.get_projection_matrix([1], [2])
+        sparse = mcc.get_projection_matrix([1], [2], sparse=True)
+
+        with pytest.raises(ValueError):
+            mcc.get_projection_matrix([1], [2], parameter=['projection_volume',
+                                                           'sum_pixels'])
+
+    assert dense['matrix'][0, 0] == 7.0
+    assert sparse['matrix'].toarray()[0, 0] == 7.0
+
+
+def test_rank_structures_many_experiments(mcc):
+
+    unionizes = pd.DataFrame({'experiment_id': [1, 1, 1, 2, 2, 3],
+                              'structure_id': [10, 11, 12, 10, 11, 10],
+                              'hemisphere_id': [1, 1, 2, 1, 2, 1],
+                              'is_injection': [True] * 6,
+                              'normalized_projection_volume':
+                                  [0.2, 0.5, 0.3, 0.001, 0.9, 0.0]})
+
+    with mock.patch.object(mcc, "get_structure_unionizes",
+                           new=lambda *a, **k: unionizes):
+        obtained = mcc.rank_structures([2, 1, 3, 4], True, [10, 11, 12],
+                                       n=2)
+
+    assert [[r['structure_id'] for r in exp] for exp in obtained] == \
+        [[11], [11, 12], [], []]
+    assert sorted(obtained[1][0].keys()) == \
+        ['experiment_id', 'hemisphere_id', 'normalized_projection_volume',
+         'structure_id']
+
+
+def test_build_volume_stack(mcc):
+
+    shape = (3, 4, 5)
+    volumes = {eid: np.random.rand(*shape) for eid in [11, 12, 13]}
+
+    with mock.patch.object(mcc, 'get_injection_density',
+                           side_effect=lambda eid: (volumes[eid], {})):
+        stack = mcc.build_volume_stack([13, 11, 12], kind='injection_density')
+
+    with stack:
+        assert stack.attrs['kind'] == 'injection_density'
+        assert np.allclose(stack.get_experiment(11), volumes[11])
+
+    assert os.path.exists(mcc.get_volume_stack_path('injection_density',
+                                                    experiment_ids=[13, 11, 12]))
+    with mcc.get_volume_stack('injection_density',
+                              experiment_ids=[13, 11, 12]) as stack:
+        assert list(stack.experiment_ids) == [13, 11, 12]
+
+    # a stack of other experiments goes to its own file
+    with mock.patch.object(mcc, 'get_injection_density',
+                           side_effect=lambda eid: (volumes[eid], {})):
+        mcc.build_volume_stack([12], kind='injection_density').close()
+    with mcc.get_volume_stack('injection_density',
+                              experiment_ids=[13, 11, 12]) as stack:
+        assert len(stack) == 3
+
+    with pytest.raises(ValueError):
+        mcc.build_volume_stack([11], kind='template')
+
+
+def test_compute_structure_unionizes(mcc):
+
+    tree = StructureTree([{'id': 1, 'structure_id_path': [1]},
+                          {'id': 2, 'structure_id_path': [1, 2]}])
+    annotation = np.zeros((4, 4, 4), dtype=np.uint32)
+    annotation[1:3, 1:3, :] = 2
+
+    volumes = {'projection_density': np.full(annotation.shape, 0.5),
+               'injection_density': np.zeros(annotation.shape),
+               'injection_fraction': np.zeros(annotation.shape),
+               'data_mask': np.ones(annotation.shape)}
+
+    def download(kind):
+        def write(path, eid, resolution, **kwargs):
+            Manifest.safe_make_parent_dirs(path)
+            nrrd.write(path, volumes[kind])
+        return write
+
+    patches = [mock.patch.object(mcc.api, 'download_' + kind,
+                                 side_effect=download(kind))
+               for kind in volumes]
+    for patch in patches:
+        patch.start()
+    try:
+        with mock.patch.object(mcc, 'get_annotation_volume',
+                               return_value=(annotation, {})):
+            obtained = mcc.compute_structure_unionizes(
+                [5, 6], structure_tree=tree, hemisphere_ids=[3],
+                is_injection=False, processes=1)
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    assert len(obtained) == 4
+    assert list(obtained['experiment_id']) == [5, 5, 6, 6]
+    assert np.allclose(obtained['projection_density'], 0.5)
+    row = obtained[(obtained['experiment_id'] == 6) &
+                   (obtained['structure_id'] == 2)].iloc[0]
+    assert np.isclose(row['volume'], 16 * (25 / 1000.0) ** 3)
+
+    with mock.patch.object(mcc, 'get_annotation_volume',
+                           return_value=(annotation, {})):
+        obtained = mcc.compute_structure_unionizes(
+            [], structure_tree=tree, hemisphere_ids=[3], is_injection=False)
+
+    assert len(obtained) == 0
+    assert 'projection_density' in obtained.columns
+
+
+def test_get_correlation_search(mcc):
+
+    tree = StructureTree([{'id': 997, 'structure_id_path': [997]}])
+    annotation = np.zeros((3, 4, 4), dtype=np.uint32)
+    annotation[1:, 1:, :] = 997
+    rsp = ReferenceSpace(tree, annotation, [25] * 3)
+
+    rng = np.random.RandomState(11)
+    volumes = dict((eid, rng.rand(3, 4, 4)) for eid in (1, 2, 3))
+    experiments = [{'id': eid, 'structure_abbrev': 'VISp', 'injection_x': 1,
+                    'injection_y': 2, 'injection_z': 3} for eid in volumes]
+    path = os.path.join(os.path.dirname(mcc.manifest_path), 'search.npz')
+
+    with mock.patch.object(mcc, 'get_experiments', return_value=experiments), \
+            mock.patch.object(mcc, 'get_reference_space', return_value=rsp), \
+            mock.patch.object(mcc, 'get_projection_density',
+                              side_effect=lambda eid: (volumes[eid], {})):
+        search = mcc.get_correlation_search(hemisphere='right',
+                                            file_name=path)
+        loaded = mcc.get_correlation_search(file_name=path)
+
+    mask = annotation > 0
+    mask[..., :2] = False
+    expected = np.corrcoef(volumes[2][mask], volumes[3][mask])[0, 1]
+
+    records = search.search(2)
+    assert records[0]['id'] == 2
+    assert records[0]['structure-abbrev'] == 'VISp'
+    assert records[0]['injection-coordinates'] == [1, 2, 3]
+    assert dict((r['id'], r['r']) for r in records)[3] == \
+        pytest.approx(expected, abs=1e-5)
+    assert [r['id'] for r in loaded.search(2)] == [r['id'] for r in records]
+
+    # a subset is read from the stack of all experiments, which is kept
+    full_path = mcc.get_volume_stack_path('projection_density',
+                                          experiment_ids=[1, 2, 3])
+    with mock.patch.object(mcc, 'get_experiments', return_value=experiments), \
+            mock.patch.object(mcc, 'get_reference_space', return_value=rsp), \
+            mock.patch.object(mcc, 'build_volume_stack') as build:
+        subset = mcc.get_correlation_search(experiment_ids=[3, 2],
+                                            hemisphere='right')
+
+    assert not build.called
+    assert os.path.exists(full_path)
+    assert dict((r['id'], r['r']) for r in subset.search(2))[3] == \
+        pytest.approx(expected, abs=1e-5)
+
+
+def test_get_experiment_index(mcc):
+
+    shape = (4, 4, 4)
+    density = np.zeros(shape)
+    density[1, 2, 3] = 1
+    projection = np.zeros(shape)
+    projection[0, 0, 0] = 0.5
+
+    experiments = [{'id': 8, 'transgenic_line': 'Cux2',
+                    'injection_structures': [1]}]
+    tree = StructureTree([{'id': 1, 'structure_id_path': [1]}])
+    path = os.path.join(os.path.dirname(mcc.manifest_path), 'index.npz')
+
+    with mock.patch.object(mcc, 'get_experiments', return_value=experiments), \
+            mock.patch.object(mcc, 'get_structure_tree', return_value=tree), \
+            mock.patch.object(mcc, 'get_injection_density',
+                              return_value=(density, {})), \
+            mock.patch.object(mcc, 'get_injection_fraction',
+                              return_value=(density, {})), \
+            mock.patch.object(mcc, 'get_projection_density',
+                              return_value=(projection, {})):
+        index = mcc.get_experiment_index(file_name=path)
+        loaded = mcc.get_experiment_index(file_name=path)
+
+    for idx in (index, loaded):
+        records = idx.nearest_injections([0, 0, 0], injection_structures=[1])
+        assert records[0]['id'] == 8
+        assert records[0]['injection-coordinates'] == [25, 50, 75]
+        assert [r['id'] for r in idx.projecting_experiments([0, 0, 0])] == [8]
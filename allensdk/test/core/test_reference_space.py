@@ -100,6 +100,30 @@ def test_total_voxel_counts(rsp):
     assert( obt[6] == 4 )   
     
     
+def test_voxel_count_arrays(rsp):
+
+    node_ids = rsp.structure_tree.node_ids()
+    direct = rsp.direct_voxel_count_array()
+    total = rsp.total_voxel_count_array()
+
+    for ii, stid in enumerate(node_ids):
+        desc = rsp.structure_tree.descendant_ids([stid])[0]
+        assert( direct[ii] == np.count_nonzero(rsp.annotation == stid) )
+        assert( total[ii] == np.count_nonzero(np.isin(rsp.annotation, desc)) )
+
+
+def test_structure_sums(rsp):
+
+    values = np.random.RandomState(2).rand(*rsp.annotation.shape)
+    obt = dict(zip(rsp.structure_tree.node_ids(), rsp.structure_sums(values)))
+
+    assert( np.isclose(obt[2], values[rsp.make_structure_mask([2]) > 0].sum()) )
+    assert( obt[7] == 0 )
+
+    with pytest.raises(ValueError):
+        rsp.structure_sums(np.zeros((2, 2, 2)))
+
+
 def test_remove_unassigned(rsp):
 
     rsp.remove_unassigned()
@@ -144,6 +168,59 @@ def test_many_structure_masks_default_cb(rsp):
         assert( np.allclose(item, [1, 2]) )
     
     
+def test_many_structure_masks_threaded(rsp):
+
+    obtained = list(rsp.many_structure_masks([2, 3, 1, 5], max_workers=3))
+
+    assert( [stid for stid, _ in obtained] == [2, 3, 1, 5] )
+    for stid, mask in obtained:
+        assert( np.array_equal(mask, rsp.make_structure_mask([stid])) )
+
+
+def test_relabel_annotation(rsp):
+
+    assert( np.array_equal(rsp.annotation_ids, [0, 2, 3, 4, 5, 6]) )
+    assert( rsp.annotation_labels.dtype == np.uint8 )
+    assert( np.array_equal(rsp.annotation_ids[rsp.annotation_labels], 
+                           rsp.annotation) )
+
+    rsp.annotation = np.full((2, 2, 2), 7)
+    assert( np.array_equal(rsp.annotation_ids, [7]) )
+
+
+def test_relabel_annotation_blocks(rsp):
+
+    expected_ids = rsp.annotation_ids
+    expected_labels = rsp.annotation_labels
+
+    rsp.annotation = rsp.annotation
+    rsp.RELABEL_BLOCK_SIZE = 1
+    assert( len(list(rsp._annotation_blocks())) == rsp.annotation.shape[0] )
+    assert( np.array_equal(rsp.annotation_ids, expected_ids) )
+    assert( np.array_equal(rsp.annotation_labels, expected_labels) )
+
+    # fortran ordered annotations are read along their last axis
+    rsp = ReferenceSpace(rsp.structure_tree, 
+                         np.asfortranarray(rsp.annotation), rsp.resolution)
+    assert( rsp.annotation.flags.f_contiguous )
+    rsp.RELABEL_BLOCK_SIZE = 1
+    assert( len(list(rsp._annotation_blocks())) == rsp.annotation.shape[-1] )
+    assert( np.array_equal(rsp.annotation_ids, expected_ids) )
+    assert( np.array_equal(rsp.annotation_labels, expected_labels) )
+
+
+def test_make_structure_mask_lookup(rsp):
+
+    for stid in [1, 2, 3, 4, 5, 6, 7]:
+        desc = rsp.structure_tree.descendant_ids([stid])[0]
+        expected = np.isin(rsp.annotation, desc)
+        assert( np.array_equal(rsp.make_structure_mask([stid]), expected) )
+
+        direct = rsp.make_structure_mask([stid], direct_only=True)
+        assert( direct.dtype == np.uint8 )
+        assert( np.array_equal(direct, rsp.annotation == stid) )
+
+
 def test_check_coverage(rsp):
     
     mask = np.zeros((10, 10, 10))
@@ -171,6 +248,19 @@ def test_downsample(rsp):
     assert( np.allclose(target.annotation.shape, [10, 5, 5]) )
 
 
+def test_downsample_mode(rsp):
+
+    target = rsp.downsample((20, 20, 20), interpolator='mode')
+
+    assert( np.allclose(target.annotation.shape, [5, 5, 5]) )
+    assert( target.annotation[4, 4, 4] == 3 )
+    assert( target.annotation[2, 2, 2] == 2 )
+    assert( target.resolution == (20, 20, 20) )
+
+    with pytest.raises(ValueError):
+        rsp.downsample((20, 20, 20), interpolator='cubic')
+
+
 def test_get_slice_image(rsp):
 
     cmap = {0: [0, 0, 0], 1: [0, 0, 0], 2: [0, 0, 0], 3: [1, 2, 3], 
@@ -230,3 +320,41 @@ def test_write_itksnap_labels(itksnap_rsp, tmpdir_factory):
     assert os.path.exists(labels_path)
     assert os.path.exists(annot_path)
 
+
+@pytest.mark.parametrize('order', ['C', 'F'])
+@pytest.mark.parametrize('id_type', [np.uint8, np.uint16])
+def test_write_itksnap_labels_blocks(itksnap_rsp, tmpdir_factory, id_type, 
+                                     order):
+
+    tmpdir = str(tmpdir_factory.mktemp('test_write_itksnap_labels_blocks'))
+    annot_path = os.path.join(tmpdir, 'annot.nrrd')
+    labels_path = os.path.join(tmpdir, 'labels.csv')
+
+    # a memory mapped annotation, with an id missing from the tree
+    raw_path = os.path.join(tmpdir, 'annotation.npy')
+    annotation = itksnap_rsp.annotation.astype(np.uint32)
+    annotation[0, 0, 0] = 7
+    np.save(raw_path, np.asarray(annotation, order=order))
+    itksnap_rsp.annotation = np.load(raw_path, mmap_mode='r')
+
+    if order == 'F':
+        # blocks of planes along the last axis are contiguous in the file
+        for _, _, block in itksnap_rsp._itksnap_blocks(None, None, 3):
+            assert block.flags.f_contiguous
+
+    itksnap_rsp.write_itksnap_labels(annot_path, labels_path, 
+                                     id_type=id_type, block_planes=3)
+    exp_annot, _ = itksnap_rsp.export_itksnap_labels(id_type=id_type, 
+                                                     block_planes=4)
+
+    obt_annot, header = nrrd.read(annot_path)
+    assert obt_annot.dtype == exp_annot.dtype
+    assert np.array_equal(obt_annot, exp_annot)
+    assert np.allclose(header['spacings'], [10, 10, 10])
+
+    if id_type == np.uint8:
+        assert obt_annot[0, 0, 0] == 0
+        assert obt_annot[0, 0, 1] == 2
+    else:
+        assert obt_annot[0, 0, 0] == 7
+
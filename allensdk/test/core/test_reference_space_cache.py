@@ -41,7 +41,7 @@ import numpy as np
 import nrrd
 import pandas as pd
 
-from allensdk.core.reference_space_cache import ReferenceSpaceCache
+from allensdk.core.reference_space_cache import ReferenceSpaceCache, _partial_path
 from allensdk.core.structure_tree import StructureTree
 
 
@@ -103,6 +103,86 @@ def test_get_annotation_volume(rsp, fn_temp_dir, rsp_version, resolution):
     assert( os.path.exists(path) )
 
 
+def test_get_annotation_volume_mmap(rsp, fn_temp_dir, rsp_version, resolution):
+
+    volume = np.arange(60, dtype=np.uint32).reshape(3, 4, 5)
+    raw_path = os.path.join(fn_temp_dir, rsp_version, 
+                            'annotation_{0}.npy'.format(resolution))
+
+    rsp.api.retrieve_file_over_http = lambda a, b: nrrd.write(b, volume)
+    obtained, header = rsp.get_annotation_volume(mmap=True)
+
+    assert( isinstance(obtained, np.memmap) )
+    assert( not obtained.flags.writeable )
+    # in the order of the nrrd file
+    assert( obtained.flags.f_contiguous )
+    assert( np.array_equal(obtained, volume) )
+    assert( list(header['sizes']) == [3, 4, 5] )
+    assert( os.path.exists(raw_path) )
+
+    # the raw copy is reused without reading the nrrd volume
+    rsp.api.retrieve_file_over_http = mock.MagicMock()
+    with mock.patch('nrrd.read') as read:
+        again, header = rsp.get_annotation_volume(mmap=True)
+    read.assert_not_called()
+    rsp.api.retrieve_file_over_http.assert_not_called()
+    assert( np.array_equal(again, volume) )
+
+    with mock.patch.object(rsp, 'get_structure_tree', 
+                           return_value=StructureTree([])):
+        space = rsp.get_reference_space(mmap=True)
+    # not copied into memory
+    assert( not space.annotation.flags.owndata )
+
+
+def test_get_annotation_volume_mmap_partial(rsp, fn_temp_dir, rsp_version):
+
+    volume = np.arange(60, dtype=np.uint32).reshape(3, 4, 5)
+    rsp.api.retrieve_file_over_http = lambda a, b: nrrd.write(b, volume)
+    directory = os.path.join(fn_temp_dir, rsp_version)
+
+    # an interrupted copy leaves nothing behind
+    with mock.patch('numpy.save', side_effect=IOError('disk full')):
+        with pytest.raises(IOError):
+            rsp.get_annotation_volume(mmap=True)
+    assert( not any('partial' in name for name in os.listdir(directory)) )
+
+    rsp.get_annotation_volume(mmap=True)
+    assert( not any('partial' in name for name in os.listdir(directory)) )
+
+
+def test_partial_path(fn_temp_dir):
+
+    path = os.path.join(fn_temp_dir, 'volume.npy')
+    first = _partial_path(path)
+    second = _partial_path(path)
+
+    assert( first != second )
+    for partial_path in (first, second):
+        assert( os.path.dirname(partial_path) == fn_temp_dir )
+        assert( partial_path.endswith('.partial.npy') )
+        assert( os.path.exists(partial_path) )
+
+
+def test_get_template_volume_mmap(rsp, fn_temp_dir, resolution):
+
+    volume = np.random.rand(3, 4, 5)
+    nrrd_path = os.path.join(fn_temp_dir, 
+                             'average_template_{0}.nrrd'.format(resolution))
+
+    rsp.api.retrieve_file_over_http = lambda a, b: nrrd.write(b, volume)
+    obtained, _ = rsp.get_template_volume(mmap=True)
+    assert( np.allclose(obtained, volume) )
+
+    # a replaced nrrd file is copied again
+    nrrd.write(nrrd_path, volume * 2)
+    later = os.path.getmtime(nrrd_path) + 10
+    os.utime(nrrd_path, (later, later))
+
+    obtained, _ = rsp.get_template_volume(mmap=True)
+    assert( np.allclose(obtained, volume * 2) )
+
+
 def test_get_template_volume(rsp, fn_temp_dir, resolution):
 
     eye = np.eye(100)
@@ -119,6 +199,26 @@ def test_get_template_volume(rsp, fn_temp_dir, resolution):
     assert( os.path.exists(path) )
 
 
+def test_get_annotation_pyramid(rsp, fn_temp_dir, rsp_version):
+
+    volume = np.zeros((8, 8, 8), dtype=np.uint32)
+    volume[:4] = 5
+
+    rsp.api.retrieve_file_over_http = lambda a, b: nrrd.write(b, volume)
+    pyramid = rsp.get_annotation_pyramid()
+
+    assert( pyramid.resolutions() == [50, 100] )
+    assert( os.path.dirname(pyramid.directory) == 
+            os.path.join(fn_temp_dir, rsp_version) )
+    assert( np.array_equal(pyramid.get_level(50)[:, 0, 0], [5, 5, 0, 0]) )
+
+    # built levels are reused
+    with mock.patch.object(rsp, 'get_annotation_volume') as get_annotation:
+        again = rsp.get_annotation_pyramid([50])
+    get_annotation.assert_not_called()
+    assert( again.coarsest(75) == 50 )
+
+
 def test_get_structure_tree(rsp, fn_temp_dir, new_nodes):
 
     path = os.path.join(fn_temp_dir, 'structures.json')
@@ -196,7 +296,88 @@ def test_get_structure_mesh(rsp, fn_temp_dir, rsp_version):
     assert( os.path.exists(path) )
 
 
-@pytest.mark.parametrize('inp,fails', [(1, False), 
+def test_build_structure_masks(rsp, fn_temp_dir, rsp_version, new_nodes):
+
+    nodes = new_nodes + [{'id': 5, 'structure_id_path': '/0/5/',
+                          'color_hex_triplet': 'ffffff', 'acronym': 'f',
+                          'name': 'five', 'structure_sets': []}]
+    tree = StructureTree(StructureTree.clean_structures(nodes))
+    rsp.get_structure_tree = lambda *a, **k: tree
+
+    volume = np.zeros((4, 4, 4), dtype=np.uint32)
+    volume[:2] = 5
+    volume[2] = 0
+    rsp.api.retrieve_file_over_http = lambda a, b: nrrd.write(b, volume)
+
+    mask_dir = os.path.join(fn_temp_dir, rsp_version, 'structure_masks',
+                            'resolution_25')
+
+    # a leftover from an interrupted build is ignored
+    os.makedirs(mask_dir)
+    nrrd.write(os.path.join(mask_dir, 'structure_5.partial.nrrd'), volume)
+
+    statuses = rsp.build_structure_masks([5, 0], max_workers=2)
+
+    assert( list(statuses) == [5, 0] )
+    assert( statuses[5]['mask'] == 'downloaded' )
+    assert( sorted(os.listdir(mask_dir)) == ['structure_0.nrrd',
+                                             'structure_5.nrrd',
+                                             'structure_5.partial.nrrd'] )
+
+    mask, header = nrrd.read(os.path.join(mask_dir, 'structure_5.nrrd'))
+    assert( header['encoding'] == 'gzip' )
+    assert( np.array_equal(mask, volume == 5) )
+
+    # finished masks are not built again
+    with mock.patch.object(rsp, 'get_reference_space') as get_space:
+        statuses = rsp.build_structure_masks([5, 0])
+    get_space.assert_not_called()
+    assert( statuses[0]['mask'] == 'cached' )
+
+
+def test_build_structure_masks_download(rsp, fn_temp_dir, rsp_version):
+
+    def retrieve(url, path):
+        if 'structure_7' in url:
+            raise ValueError('not found')
+        nrrd.write(path, np.eye(3))
+
+    rsp.api.retrieve_file_over_http = retrieve
+
+    statuses = rsp.build_structure_masks([6, 7], download=True)
+
+    assert( statuses[6]['mask'] == 'downloaded' )
+    assert( statuses[7]['mask'] == 'failed' )
+
+    obtained, _ = rsp.get_structure_mask(6)
+    assert( np.allclose(obtained, np.eye(3)) )
+    # a failed download leaves nothing behind
+    assert( os.listdir(os.path.join(fn_temp_dir, rsp_version, 
+                                    'structure_masks', 'resolution_25')) ==
+            ['structure_6.nrrd'] )
+
+
+def test_build_structure_meshes(rsp, fn_temp_dir, rsp_version):
+
+    def write_obj(path):
+        with open(path, 'w') as fil:
+            fil.write('vn 1 2 4')
+
+    rsp.api.retrieve_file_over_http = lambda a, b: write_obj(b)
+    statuses = rsp.build_structure_meshes([12, 13])
+
+    assert( statuses[13]['mesh'] == 'downloaded' )
+    assert( sorted(os.listdir(os.path.join(fn_temp_dir, rsp_version,
+                                           'structure_meshes'))) ==
+            ['structure_12.obj', 'structure_13.obj'] )
+
+    rsp.api.retrieve_file_over_http = mock.MagicMock()
+    obtained = rsp.get_structure_mesh(12)
+    rsp.api.retrieve_file_over_http.assert_not_called()
+    assert( np.allclose(obtained[1], [1, 2, 4]) )
+
+
+@pytest.mark.parametrize('inp,fails', [(1, False),
                                         (pd.Series([2]), False), 
                                         ('qwerty', True)])
 def test_validate_structure_id(inp, fails):
@@ -166,6 +166,59 @@ def test_children(tree):
     assert( len(obtained[0]) == 2 ) 
     assert( isinstance(obtained[0][0], dict) )
     
+def test_post_order_ids(tree):
+
+    obt = tree.post_order_ids()
+    assert( sorted(obt) == list(range(6)) )
+
+    for nid in obt:
+        for desc in tree.descendant_ids([nid])[0]:
+            assert( obt.index(desc) <= obt.index(nid) )
+
+
+def test_sum_over_descendants(tree):
+
+    values = [node[1] for node in tree.nodes(tree.node_ids())]
+    obt = dict(zip(tree.node_ids(), tree.sum_over_descendants(values)))
+
+    assert( obt == {0: 27, 1: 17, 2: 8, 3: 6, 4: 4, 5: 5} )
+
+    with pytest.raises(ValueError):
+        tree.sum_over_descendants([1, 2])
+
+
+def test_is_descendant(tree):
+
+    obt = tree.is_descendant([3, 3, 5, 0, 7], [1, 0, 1, 0, 0])
+    assert( list(obt) == [True, True, False, True, False] )
+
+
+def test_descends_from_any(tree):
+
+    obt = tree.descends_from_any([0, 1, 2, 3, 4, 5, 9], [3, 1, 5, 9])
+    assert( list(obt) == [False, True, False, True, True, True, False] )
+
+    assert( not tree.descends_from_any([0, 1], []).any() )
+    assert( tree.descends_from_any([5, 3], [0, 2]).all() )
+
+    for ancestor in tree.node_ids():
+        desc = set(tree.descendant_ids([ancestor])[0])
+        obt = tree.descends_from_any(tree.node_ids(), [ancestor])
+        assert( set(nid for nid, in_desc in zip(tree.node_ids(), obt) 
+                    if in_desc) == desc )
+
+
+def test_nodes_by_property_cached(tree):
+
+    tree.value_map = mock.MagicMock(wraps=tree.value_map)
+
+    tree.nodes_by_property('id', [1])
+    obt = tree.nodes_by_property('id', [2, 3], to_fn=lambda x: x['parent'])
+
+    assert( obt == [0, 1] )
+    assert( tree.value_map.call_count == 1 )
+
+
 def test_descendants(tree):
 
     obtained = tree.descendants([0, 3])
@@ -0,0 +1,129 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+
+import numpy as np
+import pytest
+import skimage.io
+
+from allensdk.core.reference_space import ReferenceSpace
+from allensdk.core.structure_tree import StructureTree
+
+
+@pytest.fixture
+def rsp():
+    tree = StructureTree([
+        {'id': 1, 'structure_id_path': [1], 'rgb_triplet': [10, 20, 30]},
+        {'id': 2, 'structure_id_path': [1, 2], 'rgb_triplet': [40, 50, 60]},
+        {'id': 3, 'structure_id_path': [1, 3], 'rgb_triplet': [70, 80, 90]}])
+
+    annotation = np.zeros((6, 9, 7), dtype=np.uint32)
+    annotation[1:5, 2:7, 1:6] = 1
+    annotation[2:4, 3:5, 2:4] = 2
+    annotation[:, 8, :] = 3
+
+    return ReferenceSpace(tree, annotation, [10, 10, 10])
+
+
+def test_render(rsp):
+    renderer = rsp.slice_renderer()
+
+    for axis in range(3):
+        for position in (0, 20, 30):
+            expected = rsp.get_slice_image(axis, position)
+            obtained = renderer.render(axis, position)
+            assert obtained.dtype == np.uint8
+            assert np.array_equal(obtained, expected)
+
+    with pytest.raises(IndexError):
+        renderer.render(0, 1000)
+
+    # slices are colored without relabelling the whole annotation
+    assert not hasattr(rsp, '_annotation_labels')
+
+
+def test_custom_cmap(rsp):
+    renderer = rsp.slice_renderer(cmap={2: [1, 1, 1]})
+    image = renderer.render(0, 20)
+
+    assert (image[3, 2] == 1).all()
+    assert (image[2, 1] == 0).all()
+
+    with pytest.raises(KeyError):
+        rsp.get_slice_image(0, 20, cmap={2: [1, 1, 1]})
+
+
+def test_cache(rsp):
+    renderer = rsp.slice_renderer(cache_size=2)
+
+    first = renderer.render_plane(0, 1)
+    assert renderer.render_plane(0, 1) is first
+    assert not first.flags.writeable
+
+    renderer.render_plane(0, 2)
+    renderer.render_plane(0, 1)
+    renderer.render_plane(0, 3)
+    # plane 2 was least recently used
+    assert list(renderer._cache) == [(0, 1, 1), (0, 3, 1)]
+
+
+def test_render_many(rsp):
+    renderer = rsp.slice_renderer()
+
+    obtained = list(renderer.render_many(2))
+    assert [index for index, _ in obtained] == list(range(7))
+
+    obtained = list(renderer.render_many(1, positions=[80, 0]))
+    assert [index for index, _ in obtained] == [8, 0]
+    assert (obtained[0][1] == [70, 80, 90]).all()
+
+
+def test_write_tiles(rsp, tmpdir_factory):
+    directory = str(tmpdir_factory.mktemp('tiles'))
+    renderer = rsp.slice_renderer()
+
+    written = renderer.write_tiles(directory, 0, positions=[20, 30],
+                                   tile_size=4, max_workers=2)
+
+    assert written == [os.path.join(directory, '0_2'),
+                       os.path.join(directory, '0_3')]
+    # 9 x 7 planes: 3 x 2 tiles, then 2 x 1, then 1 x 1
+    assert sorted(os.listdir(os.path.join(written[0], '0'))) == \
+        ['0_0.png', '0_1.png', '1_0.png', '1_1.png', '2_0.png', '2_1.png']
+    assert os.listdir(os.path.join(written[0], '2')) == ['0_0.png']
+
+    tile = skimage.io.imread(os.path.join(written[0], '0', '1_0.png'))
+    assert np.array_equal(tile, renderer.render_plane(0, 2)[4:8, 0:4])
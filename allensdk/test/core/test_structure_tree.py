@@ -133,6 +133,9 @@ def test_has_overlaps(tree):
     obag = tree.has_overlaps([1, 2])
     assert( not obag )
 
+    assert( tree.has_overlaps([2, 0, 2]) == set([0]) )
+    assert( tree.has_overlaps([1]) == set() )
+
 
 def test_clean_structures(nodes):
 
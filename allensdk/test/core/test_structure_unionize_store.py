@@ -0,0 +1,125 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+import pandas as pd
+import pytest
+
+from allensdk.core.structure_unionize_store import StructureUnionizeStore
+
+
+def make_unionizes(experiment_ids, structure_ids=range(1, 5)):
+    return pd.DataFrame([{'experiment_id': eid,
+                          'structure_id': sid,
+                          'hemisphere_id': hid,
+                          'is_injection': injection,
+                          'projection_volume': eid + sid * 0.01 + hid * 0.001,
+                          'max_voxel_x': 100 * sid}
+                         for eid in experiment_ids
+                         for sid in structure_ids
+                         for hid in (1, 2, 3)
+                         for injection in (True, False)])
+
+
+@pytest.fixture
+def store(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('unionize_store').join('unionizes.h5'))
+    return StructureUnionizeStore(path)
+
+
+def test_append_incremental(store):
+    assert store.experiment_ids() == set()
+    assert len(store.query()) == 0
+
+    store.append(make_unionizes([1, 2]), [1, 2])
+    store.append(make_unionizes([2, 3]), [2, 3, 4])
+
+    assert store.experiment_ids() == {1, 2, 3, 4}
+    # experiment 2 was already stored, 4 has no records
+    assert len(store.query()) == 3 * 24
+    assert store.query()['max_voxel_x'].dtype == np.int64
+
+
+def test_query(store):
+    store.append(make_unionizes(range(1, 50)), range(1, 50))
+
+    obtained = store.query(experiment_ids=list(range(40, 0, -1)),
+                           structure_ids=[2, 3],
+                           hemisphere_ids=[1],
+                           is_injection=False,
+                           columns=['projection_volume'])
+
+    assert sorted(obtained.columns) == sorted(
+        StructureUnionizeStore.INDEX_COLUMNS + ['projection_volume'])
+    assert len(obtained) == 40 * 2
+    assert not obtained['is_injection'].any()
+    assert set(obtained['hemisphere_id']) == {1}
+    # rows come back in the order they were stored
+    assert obtained['experiment_id'].is_monotonic_increasing
+
+
+def test_append_single_experiment(store):
+    unionizes = make_unionizes([7]).drop('experiment_id', axis=1)
+    store.append(unionizes, [7])
+
+    assert set(store.query()['experiment_id']) == {7}
+
+    with pytest.raises(ValueError):
+        store.append(unionizes, [8, 9])
+
+
+def test_append_keeps_columns(store):
+    first = make_unionizes([1]).assign(acronym='MOp')
+    store.append(first, [1])
+
+    # a new column, missing values in an integer column and longer text
+    second = make_unionizes([2]).drop('max_voxel_x', axis=1)
+    second = second.assign(acronym='x' * 100, volume_note=3)
+    store.append(second, [2])
+
+    obtained = store.query()
+    assert len(obtained) == 48
+    assert set(obtained.columns) == set(first.columns) | {'volume_note'}
+
+    one = obtained[obtained['experiment_id'] == 1]
+    two = obtained[obtained['experiment_id'] == 2]
+    assert (one['acronym'] == 'MOp').all()
+    assert (two['acronym'] == 'x' * 100).all()
+    assert one['max_voxel_x'].tolist() == first['max_voxel_x'].tolist()
+    assert two['max_voxel_x'].isnull().all()
+    assert (two['volume_note'] == 3).all()
+
+    store.append(make_unionizes([3]).assign(acronym='SSp'), [3])
+    assert len(store.query(experiment_ids=[3])) == 24
@@ -0,0 +1,179 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+import nrrd
+import pandas as pd
+import pytest
+
+from allensdk.core.reference_space import ReferenceSpace
+from allensdk.core.structure_tree import StructureTree
+from allensdk.core.structure_unionizer import StructureUnionizer
+
+
+@pytest.fixture
+def tree():
+    return StructureTree([{'id': 1, 'structure_id_path': [1]},
+                          {'id': 2, 'structure_id_path': [1, 2]},
+                          {'id': 3, 'structure_id_path': [1, 3]},
+                          {'id': 4, 'structure_id_path': [1, 2, 4]},
+                          {'id': 5, 'structure_id_path': [1, 2, 5]}])
+
+
+@pytest.fixture
+def annotation():
+    annotation = np.zeros((6, 6, 8), dtype=np.uint32)
+    annotation[1:5, 1:5, 1:7] = 2
+    annotation[2:4, 2:4, 2:4] = 4
+    annotation[2:4, 2:4, 5:7] = 5
+    annotation[5, :, :] = 3
+    return annotation
+
+
+@pytest.fixture
+def volumes(annotation):
+    rng = np.random.RandomState(7)
+    injection_fraction = np.zeros(annotation.shape)
+    injection_fraction[2:4, 2:4, 1:4] = rng.rand(2, 2, 3)
+
+    injection_density = injection_fraction * rng.rand(*annotation.shape)
+    projection_density = np.clip(injection_density +
+                                 rng.rand(*annotation.shape) * 0.5, 0, 1)
+    data_mask = (rng.rand(*annotation.shape) > 0.1).astype(np.float64)
+
+    return {'projection_density': projection_density,
+            'injection_density': injection_density,
+            'injection_fraction': injection_fraction,
+            'data_mask': data_mask}
+
+
+def brute_force(tree, annotation, volumes, structure_id, hemisphere_id,
+                is_injection, voxel_volume):
+    mask = ReferenceSpace(tree, annotation, [10] * 3).make_structure_mask(
+        [structure_id]).astype(bool)
+    if hemisphere_id == 1:
+        mask[..., 4:] = False
+    elif hemisphere_id == 2:
+        mask[..., :4] = False
+
+    dm = volumes['data_mask']
+    frac = volumes['injection_fraction']
+    inj = volumes['injection_density']
+    if is_injection:
+        pixels = dm * frac
+        projection = dm * inj
+    else:
+        pixels = dm * (1 - frac)
+        projection = dm * (volumes['projection_density'] - inj)
+
+    injection_volume = np.sum(dm * inj) * voxel_volume
+    return {'volume': pixels[mask].sum() * voxel_volume,
+            'projection_volume': projection[mask].sum() * voxel_volume,
+            'projection_density': projection[mask].sum() / pixels[mask].sum(),
+            'normalized_projection_volume':
+                projection[mask].sum() * voxel_volume / injection_volume}
+
+
+def test_unionize(tree, annotation, volumes):
+    unionizer = StructureUnionizer(tree, annotation, 10)
+    obtained = unionizer.unionize(experiment_id=9, **volumes)
+
+    assert (obtained['experiment_id'] == 9).all()
+    assert set(obtained['structure_id']) == {1, 2, 3, 4, 5}
+    # the injection site is in the left of 1, 2 and 4; 4 and 5 are each in
+    # one hemisphere
+    assert len(obtained) == 3 * 2 + 3 * 5 - 2
+
+    for _, row in obtained.iterrows():
+        expected = brute_force(tree, annotation, volumes, row['structure_id'],
+                               row['hemisphere_id'], row['is_injection'],
+                               1e-6)
+        for key, value in expected.items():
+            assert np.isclose(row[key], value)
+
+
+def test_unionize_custom_structures(tree, annotation, volumes):
+    volumes['projection_energy'] = np.ones(annotation.shape) * 3
+    unionizer = StructureUnionizer(tree, annotation, [10, 10, 10],
+                                   structure_ids=[4, 2])
+    obtained = unionizer.unionize(**volumes)
+
+    assert set(obtained['structure_id']) == {2, 4}
+    assert np.allclose(obtained['projection_energy'], 3)
+
+    with pytest.raises(ValueError):
+        unionizer.unionize(np.zeros((2, 2, 2)), **dict(
+            (k, v) for k, v in volumes.items() if k != 'projection_density'))
+
+
+def test_unionize_reference_space(tree, annotation, volumes):
+    rsp = ReferenceSpace(tree, annotation, [10, 10, 10])
+    labels = rsp.annotation_labels.copy()
+
+    obtained = StructureUnionizer(tree, rsp, 10).unionize(**volumes)
+    expected = StructureUnionizer(tree, annotation, 10).unionize(**volumes)
+
+    pd.testing.assert_frame_equal(obtained, expected)
+    assert np.array_equal(rsp.annotation_labels, labels)
+
+
+def test_unionize_no_files(tree, annotation):
+    obtained = StructureUnionizer(tree, annotation, 10).unionize_files({})
+
+    assert len(obtained) == 0
+    assert list(obtained.columns) == StructureUnionizer.COLUMNS
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_unionize_files(tmpdir_factory, tree, annotation, volumes, processes):
+    base = tmpdir_factory.mktemp('unionizer')
+    paths = {}
+    for eid, scale in ((11, 1.0), (12, 0.5)):
+        paths[eid] = {}
+        for key, volume in volumes.items():
+            path = str(base.join('%d_%s.nrrd' % (eid, key)))
+            nrrd.write(path, volume * (scale if key == 'projection_density'
+                                       else 1.0))
+            paths[eid][key] = path
+
+    unionizer = StructureUnionizer(tree, annotation, 10)
+    obtained = unionizer.unionize_files(paths, processes=processes)
+
+    for eid in (11, 12):
+        expected = unionizer.unionize(experiment_id=eid, **dict(
+            (k, nrrd.read(p)[0]) for k, p in paths[eid].items()))
+        pd.testing.assert_frame_equal(
+            obtained[obtained['experiment_id'] == eid].reset_index(drop=True),
+            expected)
@@ -0,0 +1,138 @@
+# Allen Institute Software License - This software license is the 2-clause BSD
+# license plus a third clause that prohibits redistribution for commercial
+# purposes without further permission.
+#
+# Copyright 2016-2017. Allen Institute. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Redistributions for commercial purposes are not permitted without the
+# Allen Institute's written permission.
+# For purposes of this license, commercial purposes is the incorporation of the
+# Allen Institute's software into anything for which you will charge fees or
+# other compensation. Contact terms@alleninstitute.org for commercial licensing
+# opportunities.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+import pytest
+
+from allensdk.core.volume_stack import VolumeStack
+
+
+SHAPE = (4, 5, 6)
+
+
+def volume(experiment_id):
+    return (np.arange(np.prod(SHAPE), dtype=np.float32).reshape(SHAPE) +
+            1000 * experiment_id)
+
+
+@pytest.fixture(params=[None, 'gzip'])
+def stack(request, tmpdir_factory):
+    path = str(tmpdir_factory.mktemp('stack').join('stack.h5'))
+    stack = VolumeStack.build(path, [3, 1, 2, 7, 5], volume,
+                              compression=request.param, chunks=None
+                              if request.param is None else (2, 16),
+                              attrs={'resolution': 100})
+    yield stack
+    stack.close()
+
+
+def test_build(stack):
+    assert len(stack) == 5
+    assert stack.shape == SHAPE
+    assert stack.attrs['resolution'] == 100
+    assert (stack._memmap is None) == (stack._data.compression is not None)
+
+
+def test_get_experiment(stack):
+    for eid in [1, 2, 3, 5, 7]:
+        assert np.array_equal(stack.get_experiment(eid), volume(eid))
+
+    with pytest.raises(KeyError):
+        stack.get_experiment(4)
+
+
+def test_get_voxels(stack):
+    voxels = [100, 3, 17, 3, 64, 119]
+    obtained = stack.get_voxels(voxels)
+
+    assert obtained.shape == (5, 6)
+    for row, eid in enumerate([3, 1, 2, 7, 5]):
+        assert np.array_equal(obtained[row], volume(eid).ravel()[voxels])
+
+    obtained = stack.get_voxels(voxels, experiment_ids=[5, 1])
+    assert np.array_equal(obtained[0], volume(5).ravel()[voxels])
+    assert np.array_equal(obtained[1], volume(1).ravel()[voxels])
+
+
+def test_get_masked(stack):
+    mask = np.zeros(SHAPE, dtype=np.uint8)
+    mask[1:3, 2, ::2] = 1
+
+    obtained = stack.get_masked(mask, experiment_ids=[7])
+    assert np.array_equal(obtained[0], volume(7)[mask > 0])
+
+    assert np.array_equal(stack.get_voxels(np.nonzero(mask)),
+                          stack.get_masked(mask))
+
+    with pytest.raises(ValueError):
+        stack.get_masked(np.ones((2, 2)))
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_build_resume(tmpdir_factory, compression):
+    path = str(tmpdir_factory.mktemp('stack').join('stack.h5'))
+    calls = []
+
+    def fail_on_5(eid):
+        if eid == 5:
+            raise IOError('download failed')
+        calls.append(eid)
+        return volume(eid)
+
+    with pytest.raises(IOError):
+        VolumeStack.build(path, [1, 2, 3, 5, 6], fail_on_5,
+                          compression=compression, chunks=(2, 16),
+                          max_workers=1)
+
+    with pytest.raises(ValueError):
+        VolumeStack(path)
+
+    del calls[:]
+    with VolumeStack.build(path, [1, 2, 3, 5, 6], volume,
+                           compression=compression) as stack:
+        assert np.array_equal(stack.get_experiment(5), volume(5))
+        assert np.array_equal(stack.get_experiment(1), volume(1))
+
+    # a stack of other experiments is kept unless overwrite is set
+    with pytest.raises(ValueError):
+        VolumeStack.build(path, [2, 8], fail_on_5, compression=compression)
+    with VolumeStack(path) as stack:
+        assert list(stack.experiment_ids) == [1, 2, 3, 5, 6]
+
+    with VolumeStack.build(path, [2, 8], fail_on_5, compression=compression,
+                           overwrite=True) as stack:
+        assert list(stack.experiment_ids) == [2, 8]
+        assert np.array_equal(stack.get_experiment(8), volume(8))
+    assert calls == [2, 8]